@@ -0,0 +1,44 @@
+from argparse import ArgumentParser
+import json
+from pathlib import Path
+import sys
+from typing import Any
+
+# the values compared for each result. p95 and min are kept in the json but too noisy to gate on
+COMPARED_METRICS = ["median", "images_per_s", "rows_per_s", "bytes"]
+
+def load_results(path: str) -> dict[tuple[str, Any], dict[str, Any]]:
+  return { (result["name"], result["size"]): result for result in json.loads(Path(path).read_text())["results"] }
+
+def main():
+  parser = ArgumentParser(description="compare two benchmark results of run.py")
+  parser.add_argument("base", help="results of the base commit")
+  parser.add_argument("head", help="results of the commit to check")
+  parser.add_argument("--threshold", type=float, default=0.2, help="relative change reported as a regression (default: %(default)s)")
+  args = parser.parse_args()
+
+  base, head = load_results(args.base), load_results(args.head)
+  regressions = []
+  print(f"{'benchmark':48} {'metric':14} {'base':>12} {'head':>12} {'change':>8}")
+  for key, head_result in head.items():
+    base_result = base.get(key)
+    if base_result is None: continue
+    name = f"{key[0]} [{key[1]}]" if key[1] is not None else key[0]
+    for metric in COMPARED_METRICS:
+      if metric not in head_result or metric not in base_result or base_result[metric] == 0: continue
+      change = head_result[metric] / base_result[metric] - 1
+      worse = change if head_result["better"] == "lower" else -change
+      mark = ""
+      if worse > args.threshold:
+        mark = " !"
+        regressions.append(f"{name} {metric}")
+      print(f"{name:48} {metric:14} {base_result[metric]:12.6g} {head_result[metric]:12.6g} {change:+8.1%}{mark}")
+  missing = [key for key in base if key not in head]
+  if len(missing) != 0:
+    print(f"not in {args.head}: {', '.join(name for name, _ in missing)}")
+  if len(regressions) != 0:
+    print(f"{len(regressions)} regressions over {args.threshold:.0%}: {', '.join(regressions)}")
+    sys.exit(1)
+
+if __name__ == "__main__":
+  main()
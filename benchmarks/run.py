@@ -0,0 +1,226 @@
+from argparse import ArgumentParser
+from datetime import datetime, timezone
+import gc
+import json
+import os
+from pathlib import Path
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Any, Callable, Optional
+
+from synth import SyntheticIndex, generate_index, sample_digests, sample_image_digests
+
+from preplib.digests import DigestTable
+from preplib.index import ImageIndex, LibIndex, find_suitable_images, index_image
+from preplib.logger import logger
+from preplib.lookup import Lookup
+from preplib.metacache import set_metadata_cache
+from preplib.query import Target
+from preplib.snapshot import Snapshot, export_snapshot
+
+BENCHMARKS_DIR = Path(__file__).absolute().parent
+REPO_DIR = BENCHMARKS_DIR.parent
+FAKE_DOCKER_DIR = BENCHMARKS_DIR / "fake_docker"
+
+class Results:
+  def __init__(self):
+    self.results: list[dict[str, Any]] = []
+
+  # `better` tells compare.py which direction is a regression
+  def add(self, name: str, size: Optional[int], values: dict[str, float], unit: str, better="lower", **extra: Any):
+    self.results.append({ "name": name, "size": size, "unit": unit, "better": better, **values, **extra })
+    shown = ", ".join(f"{key}={value:.6g}" for key, value in values.items() if isinstance(value, float))
+    logger.info(f"{name}{f' [{size}]' if size is not None else ''}: {shown} {unit}")
+
+def measure(fn: Callable[[], Any], repeat: int, warmup=1) -> dict[str, float]:
+  for _ in range(warmup):
+    fn()
+  times = []
+  gc.collect()
+  for _ in range(repeat):
+    start = time.perf_counter()
+    fn()
+    times.append(time.perf_counter() - start)
+  times.sort()
+  return {
+    "median": statistics.median(times),
+    "p95": times[min(len(times) - 1, int(len(times) * 0.95))],
+    "min": times[0],
+    "runs": float(len(times)),
+  }
+
+# peak of the python heap while running fn, which is what grows with the index size
+def peak_memory(fn: Callable[[], Any]) -> float:
+  gc.collect()
+  tracemalloc.start()
+  try:
+    fn()
+    return float(tracemalloc.get_traced_memory()[1])
+  finally:
+    tracemalloc.stop()
+
+# a copy of the fake docker that runs on this interpreter without site, so that every docker call
+# costs an interpreter start up and not the lookup of python3 in PATH (e.g. through pyenv shims) on top
+def install_fake_docker(work_dir: Path) -> Path:
+  bin_dir = work_dir / "bin"
+  bin_dir.mkdir(parents=True, exist_ok=True)
+  docker_path = bin_dir / "docker"
+  source = (FAKE_DOCKER_DIR / "docker").read_text().split("\n", 1)[1]
+  docker_path.write_text(f"#!{sys.executable} -IS\n{source}")
+  docker_path.chmod(0o755)
+  return bin_dir
+
+def fake_docker_env(bin_dir: Path, delay: float) -> dict[str, str]:
+  return {
+    "PATH": f"{bin_dir}{os.pathsep}{os.environ.get('PATH', '')}",
+    "PREPLIB_FAKE_DOCKER_DELAY": str(delay),
+  }
+
+def bench_indexing(results: Results, work_dir: Path, bin_dir: Path, images: int, delay: float):
+  os.environ.update(fake_docker_env(bin_dir, delay))
+  index_dir = work_dir / "indexing"
+  def run():
+    shutil.rmtree(index_dir, ignore_errors=True)
+    image_index = ImageIndex(index_dir)
+    rows = 0
+    for i in range(images):
+      rows += len(index_image(f"bench/indexing:{i}", index_dir, image_index=image_index).entries)
+    return rows
+  rows = run()
+  stats = measure(run, repeat=3, warmup=0)
+  results.add("index_image", images, stats, "s")
+  results.add("index_image.throughput", images, { "images_per_s": images / stats["median"], "rows_per_s": rows / stats["median"] }, "1/s", better="higher")
+  results.add("index_image.peak_memory", images, { "bytes": peak_memory(run) }, "B")
+
+def bench_queries(results: Results, index: SyntheticIndex, repeat: int):
+  size = index.digests
+  lib_index = LibIndex(index.index_dir)
+  digests = sample_digests(index, repeat, seed=1)
+  image_digests = sample_image_digests(index, 4, seed=2)
+  it = iter(range(1 << 62))
+
+  results.add("lib_index.load", size, measure(lambda: lib_index.load(digests[next(it) % len(digests)]), repeat), "s")
+  results.add("lib_index.load_many[100]", size, measure(lambda: lib_index.load_many(digests[:100]), max(10, repeat // 10)), "s")
+  results.add("find_suitable_images[1]", size, measure(lambda: find_suitable_images([("a", digests[next(it) % len(digests)])], lib_index), repeat), "s")
+  multi = [(str(i), digest) for i, digest in enumerate(image_digests)]
+  results.add(f"find_suitable_images[{len(multi)}]", size, measure(lambda: find_suitable_images(multi, lib_index), repeat), "s")
+  lookup = Lookup(index.index_dir, use_daemon=False)
+  targets = [Target(str(i), [digest]) for i, digest in enumerate(image_digests)]
+  results.add(f"lookup.match[{len(targets)}]", size, measure(lambda: lookup.match(targets), repeat), "s")
+  results.add(f"find_suitable_images[{len(multi)}].peak_memory", size, { "bytes": peak_memory(lambda: find_suitable_images(multi, lib_index)) }, "B")
+
+  # writes go to a copy, so that the cached synthetic index stays as generated
+  with tempfile.TemporaryDirectory(prefix="preplib-bench-") as tmp_dir:
+    shutil.copy2(index.index_dir / "lib_index.sqlite3", tmp_dir)
+    write_index = LibIndex(tmp_dir)
+    infos = write_index.load(digests[0])
+    results.add("lib_index.add", size, measure(lambda: write_index.add(f"{next(it):032x}", infos[0]), repeat), "s")
+    results.add("lib_index.dump", size, measure(lambda: write_index.dump(digests[0], infos), repeat), "s")
+    results.add("digest_table.build", size, measure(lambda: DigestTable.build(write_index).close(), 3, warmup=0), "s")
+    table = DigestTable.open(write_index)
+    results.add("digest_table.resolve", size, measure(lambda: table.resolve(digests[next(it) % len(digests)][:12]), repeat), "s")
+    table.close()
+    images = ImageIndex(index.index_dir).load()
+    snapshot_path = Path(tmp_dir) / "snapshot.bin"
+    results.add("snapshot.export", size, measure(lambda: export_snapshot(write_index, images, snapshot_path), 3, warmup=0), "s")
+    snapshot = Snapshot(snapshot_path)
+    results.add("snapshot.open", size, measure(lambda: Snapshot(snapshot_path).close(), repeat), "s")
+    results.add("snapshot.load", size, measure(lambda: snapshot.load(digests[next(it) % len(digests)]), repeat), "s")
+    image_names = list(images)
+    results.add("snapshot.image_tags", size, measure(lambda: snapshot.image_tags(image_names[next(it) % len(image_names)]), repeat), "s")
+    snapshot.close()
+    write_index.close()
+
+  image_names = list(ImageIndex(index.index_dir).load())
+  results.add("image_index.load", size, measure(lambda: ImageIndex(index.index_dir).load(), max(5, repeat // 20)), "s")
+  image_index = ImageIndex(index.index_dir)
+  results.add("image_index.get", size, measure(lambda: image_index.get(image_names[next(it) % len(image_names)]), repeat), "s")
+  results.add("image_index.find_images", size, measure(lambda: image_index.find_images(f"t{next(it) % len(image_names)}"), repeat), "s")
+  lib_index.close()
+
+# a whole `preplib <hash>` run in a new interpreter: import, lookup and extraction through the fake docker
+def bench_cli(results: Results, index: SyntheticIndex, bin_dir: Path, repeat: int, delay: float):
+  digest = sample_digests(index, 1, seed=3)[0]
+  env = { **os.environ, **fake_docker_env(bin_dir, delay), "PYTHONPATH": str(REPO_DIR / "src") }
+  times, max_rss = [], []
+  with tempfile.TemporaryDirectory(prefix="preplib-bench-") as out_dir:
+    command = [sys.executable, "-m", "preplib.main", "--index-dir", str(index.index_dir), "--no-daemon", "--no-cache", "-q", "-o", out_dir, digest]
+    for _ in range(repeat):
+      start = time.perf_counter()
+      proc = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+      _, status, rusage = os.wait4(proc.pid, 0)
+      times.append(time.perf_counter() - start)
+      proc.returncode = os.waitstatus_to_exitcode(status)
+      if proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, command)
+      # kilobytes on linux
+      max_rss.append(rusage.ru_maxrss * 1024)
+  times.sort()
+  results.add("cli.cold_start", index.digests, { "median": statistics.median(times), "p95": times[-1], "min": times[0], "runs": float(len(times)) }, "s")
+  results.add("cli.peak_rss", index.digests, { "bytes": float(max(max_rss)) }, "B")
+
+def git_revision():
+  try:
+    commit = subprocess.check_output(["git", "rev-parse", "HEAD"], cwd=REPO_DIR, stderr=subprocess.DEVNULL).decode().strip()
+    dirty = subprocess.check_output(["git", "status", "--porcelain", "--untracked-files=no"], cwd=REPO_DIR).decode().strip() != ""
+    return commit, dirty
+  except (OSError, subprocess.CalledProcessError):
+    return None, None
+
+def main():
+  parser = ArgumentParser(description="benchmark preplib against the fake docker and synthetic indexes")
+  parser.add_argument("--sizes", default="10000,100000", help="comma-separated digest counts of the synthetic indexes, e.g. 10000,100000,1000000 (default: %(default)s)")
+  parser.add_argument("--work-dir", default=str(Path(tempfile.gettempdir()) / "preplib-bench"), help="where the synthetic indexes are generated and kept between runs (default: %(default)s)")
+  parser.add_argument("--repeat", type=int, default=200, help="iterations of each query benchmark (default: %(default)s)")
+  parser.add_argument("--cli-repeat", type=int, default=5, help="(default: %(default)s)")
+  parser.add_argument("--index-images", type=int, default=20, help="images indexed by the throughput benchmark (default: %(default)s)")
+  parser.add_argument("--docker-delay", type=float, default=0, help="seconds the fake docker sleeps per container (default: %(default)s)")
+  parser.add_argument("--only", help="comma-separated groups to run: indexing, queries, cli (default: all)")
+  parser.add_argument("--output", "-o", default="-", help="where to write the json results, - for stdout (default: %(default)s)")
+  args = parser.parse_args()
+
+  # the metadata cache would turn every docker call after the first into a lookup
+  set_metadata_cache(None)
+  groups = set(args.only.split(",")) if args.only else { "indexing", "queries", "cli" }
+  work_dir = Path(args.work_dir)
+  work_dir.mkdir(parents=True, exist_ok=True)
+  sizes = [int(size) for size in args.sizes.split(",") if size]
+  results = Results()
+  bin_dir = install_fake_docker(work_dir)
+
+  if "indexing" in groups:
+    bench_indexing(results, work_dir, bin_dir, args.index_images, args.docker_delay)
+  for size in sizes:
+    if not groups & { "queries", "cli" }: break
+    index = generate_index(work_dir / f"index-{size}", size)
+    if "queries" in groups:
+      bench_queries(results, index, args.repeat)
+    if "cli" in groups:
+      bench_cli(results, index, bin_dir, args.cli_repeat, args.docker_delay)
+
+  commit, dirty = git_revision()
+  output = {
+    "version": 1,
+    "commit": commit,
+    "dirty": dirty,
+    "date": datetime.now(timezone.utc).isoformat(),
+    "python": platform.python_version(),
+    "platform": platform.platform(),
+    "config": vars(args),
+    "results": results.results,
+  }
+  text = json.dumps(output, indent=2)
+  if args.output == "-":
+    print(text)
+  else:
+    Path(args.output).write_text(text + "\n")
+    logger.info(f"wrote the results into {args.output}")
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,120 @@
+from argparse import ArgumentParser
+import hashlib
+import json
+from os import PathLike
+from pathlib import Path
+import random
+import shutil
+import sys
+import time
+from typing import NamedTuple, Union
+
+# the working tree is benchmarked, not the installed package
+sys.path.insert(0, str(Path(__file__).absolute().parent.parent / "src"))
+
+from preplib.index import ImageIndex, LibIndex, LibInfo
+from preplib.logger import logger
+
+LIB_DIR = "/usr/lib/x86_64-linux-gnu"
+
+class SyntheticIndex(NamedTuple):
+  index_dir: Path
+  digests: int
+  rows: int
+  images: int
+  seed: int
+
+  @property
+  def lib_index(self):
+    return LibIndex(self.index_dir)
+
+# some digests to query, spread over the whole index
+def sample_digests(index: SyntheticIndex, count: int, seed=0) -> list[str]:
+  rng = random.Random(seed)
+  conn = index.lib_index._connect()
+  max_rowid = conn.execute("SELECT MAX(rowid) FROM libs").fetchone()[0]
+  res = []
+  for rowid in sorted(rng.randrange(1, max_rowid + 1) for _ in range(count)):
+    row = conn.execute("SELECT digest FROM libs WHERE rowid >= ? LIMIT 1", (rowid,)).fetchone()
+    res.append(row[0])
+  return res
+
+# digests of `count` libraries of one image, as a multi-library query would have them
+def sample_image_digests(index: SyntheticIndex, count: int, seed=0) -> list[str]:
+  conn = index.lib_index._connect()
+  image_digest = conn.execute("SELECT image_digest FROM libs WHERE digest = ?", (sample_digests(index, 1, seed)[0],)).fetchone()[0]
+  rows = conn.execute(
+    "SELECT digest FROM libs WHERE image_digest = ? AND LENGTH(digest) = 32 ORDER BY rowid LIMIT ?",
+    (image_digest, count)
+  )
+  return [digest for digest, in rows]
+
+# an index of about `digests` distinct digests (md5 and build-id of each library). consecutive tags of a
+# repository share `shared_ratio` of their libraries, so most digests map to several images like the real one
+def generate_index(
+  index_dir: Union[PathLike, str], digests: int, libs_per_image=150, shared_ratio=0.5, images_per_repository=50,
+  seed=0, batch_size=20000
+) -> SyntheticIndex:
+  index_dir = Path(index_dir)
+  params = { "digests": digests, "libs_per_image": libs_per_image, "shared_ratio": shared_ratio, "images_per_repository": images_per_repository, "seed": seed }
+  params_path = index_dir / "synth.json"
+  if params_path.exists():
+    saved = json.loads(params_path.read_text())
+    if saved["params"] == params:
+      logger.debug(f"reusing the synthetic index in {index_dir}")
+      return SyntheticIndex(index_dir, saved["digests"], saved["rows"], saved["images"], seed)
+  if index_dir.exists():
+    shutil.rmtree(index_dir)
+  index_dir.mkdir(parents=True)
+
+  start = time.perf_counter()
+  rng = random.Random(seed)
+  lib_index = LibIndex(index_dir)
+  image_index = ImageIndex(index_dir)
+  pending: list[tuple[str, LibInfo]] = []
+  distinct = rows = images = 0
+  # the (md5, build-id) in each slot of the previous image of the repository
+  previous: list[tuple[str, str]] = []
+  while distinct < digests:
+    repository = f"bench/repo{images // images_per_repository}"
+    if images % images_per_repository == 0:
+      previous = []
+    image_digest = "sha256:" + hashlib.sha256(f"{seed}:{images}".encode()).hexdigest()
+    current = []
+    for slot in range(libs_per_image):
+      if slot < len(previous) and rng.random() < shared_ratio:
+        md5, build_id = previous[slot]
+      else:
+        md5, build_id = f"{rng.getrandbits(128):032x}", f"{rng.getrandbits(160):040x}"
+        distinct += 2
+      current.append((md5, build_id))
+      path = f"{LIB_DIR}/libsynth{slot}.so.1"
+      pending += [(md5, LibInfo(repository, image_digest, path)), (build_id, LibInfo(repository, image_digest, path))]
+    previous = current
+    image_index.add(f"{repository}@{image_digest}", f"t{images}")
+    rows += 2 * libs_per_image
+    images += 1
+    if len(pending) >= batch_size:
+      lib_index.add_many(pending)
+      pending = []
+  if len(pending) != 0:
+    lib_index.add_many(pending)
+  image_index.compact()
+  lib_index.close()
+
+  params_path.write_text(json.dumps({ "params": params, "digests": distinct, "rows": rows, "images": images }))
+  logger.info(f"generated {distinct} digests ({rows} rows, {images} images) in {index_dir} in {time.perf_counter() - start:.1f}s")
+  return SyntheticIndex(index_dir, distinct, rows, images, seed)
+
+def main():
+  parser = ArgumentParser(description="generate a synthetic preplib index")
+  parser.add_argument("index_dir")
+  parser.add_argument("--digests", type=int, default=10000, help="distinct digests (default: %(default)s)")
+  parser.add_argument("--libs-per-image", type=int, default=150, help="(default: %(default)s)")
+  parser.add_argument("--shared-ratio", type=float, default=0.5, help="libraries shared with the previous tag (default: %(default)s)")
+  parser.add_argument("--seed", type=int, default=0)
+  args = parser.parse_args()
+  generate_index(args.index_dir, args.digests, args.libs_per_image, args.shared_ratio, seed=args.seed)
+
+if __name__ == "__main__":
+  main()
@@ -1,56 +1,157 @@
-
-from functools import cache
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
 from pathlib import Path
 import re
 import subprocess
+import threading
+import time
 import logging
+from typing import Any, Callable, NamedTuple, Optional, TypeVar
 import requests
+from requests.adapters import HTTPAdapter
 
 from preplib.logger import logger
-from preplib.index import ImageIndex, index_image
-from preplib.utils import get_image_digest
+from preplib.metacache import set_metadata_cache
+from preplib.digests import DigestTable
+from preplib.index import ImageIndex, ImageScan, LibIndex, LibInfo, ManifestEntry, export_legacy_cache, migrate_legacy_index, scan_image, scan_image_layers
+from preplib.remote import export_shards
+from preplib.snapshot import export_snapshot
+from preplib.sync import export_deltas, sync_local_deltas
+from preplib.timing import Recorder, check_output, set_recorder, span
 
 logger.setLevel(logging.INFO)
+# the crawler pulls and removes images by tag, so cached tag resolutions must not be used
+set_metadata_cache(None)
 
 INDEX_DIR = Path("./preplib-data")
-assert INDEX_DIR.is_dir(), f"index directory not found: {INDEX_DIR}"
 
 IMAGE_INDEX_PATH = INDEX_DIR / "image_index.json"
+# per-repository high-water marks of the incremental crawl. committed together with the index
+CRAWL_STATE_PATH_NAME = "crawl_state.json"
+
+HUB_URL = "https://hub.docker.com"
+ENDOFLIFE_URL = "https://endoflife.date"
+
+# TODO: index arm image
+ARCH = "amd64"
+
+class HttpClient:
+  # one pooled session for every request. responses are kept in cache_dir and revalidated with ETag / Last-Modified
+  def __init__(self, cache_dir: Optional[Path], pool_size=8):
+    self.session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=3)
+    self.session.mount("http://", adapter)
+    self.session.mount("https://", adapter)
+    self.cache_dir = cache_dir
+    self.requests = 0
+    self.not_modified = 0
+
+  def _cache_paths(self, url: str):
+    assert self.cache_dir is not None
+    key = hashlib.sha256(url.encode()).hexdigest()
+    return self.cache_dir / f"{key}.json", self.cache_dir / f"{key}.body"
+
+  def _load_cache(self, url: str):
+    if self.cache_dir is None:
+      return None, None
+    meta_path, body_path = self._cache_paths(url)
+    try:
+      return json.loads(meta_path.read_text()), body_path.read_bytes()
+    except (OSError, ValueError):
+      return None, None
 
-@cache
-def get_name_mapping(product: str):
-  series = requests.get(f"https://endoflife.date/api/{product}.json").json()
+  def _store_cache(self, url: str, meta: dict[str, Any], body: bytes):
+    if self.cache_dir is None:
+      return
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    meta_path, body_path = self._cache_paths(url)
+    body_path.write_bytes(body)
+    tmp_path = meta_path.with_suffix(".tmp")
+    tmp_path.write_text(json.dumps(meta))
+    os.replace(tmp_path, meta_path)
+
+  # max_age: seconds to use the cached response without asking the server
+  def get_json(self, url: str, max_age: float=0):
+    meta, body = self._load_cache(url)
+    if meta is not None and time.time() - meta["fetched_at"] < max_age:
+      return json.loads(body)
+
+    headers = {}
+    if meta is not None:
+      if meta.get("etag"):
+        headers["If-None-Match"] = meta["etag"]
+      if meta.get("last_modified"):
+        headers["If-Modified-Since"] = meta["last_modified"]
+    self.requests += 1
+    res = self.session.get(url, headers=headers, timeout=60)
+    if res.status_code == 304 and meta is not None:
+      self.not_modified += 1
+      meta["fetched_at"] = time.time()
+      self._store_cache(url, meta, body)
+      return json.loads(body)
+    res.raise_for_status()
+    self._store_cache(url, {
+      "url": url,
+      "etag": res.headers.get("ETag"),
+      "last_modified": res.headers.get("Last-Modified"),
+      "fetched_at": time.time(),
+    }, res.content)
+    return res.json()
+
+def get_name_mapping(http: HttpClient, product: str, endoflife_url: str=ENDOFLIFE_URL):
+  # release codenames rarely change, so the cached response is used for a day without revalidation
+  series = http.get_json(f"{endoflife_url}/api/{product}.json", max_age=24 * 60 * 60)
   res = {}
   for val in series:
     res[val["codename"].split()[0].lower()] = val["cycle"]
   return res
 
+def load_crawl_state(index_dir: Path) -> dict[str, dict[str, str]]:
+  path = index_dir / CRAWL_STATE_PATH_NAME
+  if not path.exists(): return {}
+  return json.loads(path.read_text())
+
+def dump_crawl_state(index_dir: Path, state: dict[str, dict[str, str]]):
+  (index_dir / CRAWL_STATE_PATH_NAME).write_text(json.dumps(state, indent=2, sort_keys=True))
+
 def is_date_pinned_tag_name(tag_name: str):
   return re.match(r"\w+-\d+", tag_name)
 
-image_index = ImageIndex(INDEX_DIR)
-indexed_tags = set()
-for tags in image_index.load().values():
-  indexed_tags.update(filter(is_date_pinned_tag_name, tags))
-
-crawl_skipped = set()
+class ImageTask(NamedTuple):
+  repository: str
+  tag_name: str
+  version_name: str
+  product: str
+  # name used for `docker pull`
+  image_name: str
+  # compressed size reported by Docker Hub, used to estimate the local disk usage
+  size: int
+  last_updated: Optional[str]
 
-# TODO: index arm image
-ARCH = "amd64"
-# TODO: index debian and alpine
-for repository in ["amd64/ubuntu", "library/ubuntu"]:
-  print("[+] getting the mapping...")
+# since: stop paging at the first tag updated before this (tags are listed from the newest)
+# newest_seen: updated with the newest last_updated in the listing, which becomes the next high-water mark
+def crawl_tags(http: HttpClient, repository: str, is_indexed: Callable[[str], bool], since: Optional[str]=None, newest_seen: Optional[dict[str, str]]=None, hub_url: str=HUB_URL):
+  if newest_seen is None:
+    newest_seen = {}
   product = repository.split("/")[1]
-  name_to_version: dict[str, str] = get_name_mapping(product)
-
-  nxt = f"https://hub.docker.com/v2/repositories/{repository}/tags?ordering=last_updated&page=1&page_size=100"
+  nxt = f"{hub_url}/v2/repositories/{repository}/tags?ordering=last_updated&page=1&page_size=100"
   while nxt:
     logger.info(f'fetching {nxt}...')
     # not using params={...} here because result.next already contains all query parameters
-    result = requests.get(nxt).json()
+    result = http.get_json(nxt)
     nxt = result["next"]
     for tag_info in result["results"]:
       tag_name = tag_info["name"]
+      last_updated = tag_info.get("last_updated")
+      if last_updated is not None:
+        if since is not None and last_updated < since:
+          logger.info(f"reached the tags indexed in the previous crawl ({since=})")
+          return
+        if last_updated > newest_seen.get(repository, ""):
+          newest_seen[repository] = last_updated
       if not is_date_pinned_tag_name(tag_name):
         continue
       # prevent from pulling v1 image
@@ -74,12 +175,11 @@ for repository in ["amd64/ubuntu", "library/ubuntu"]:
         digest = None
 
       # check to avoid indexing the multi-arch image
-      is_single_arch = any([image_info["digest"] == digest and image_info["architecture"] == ARCH for image_info in tag_info["images"]])
-      if not is_single_arch:
+      arch_images = [image_info for image_info in tag_info["images"] if image_info["digest"] == digest and image_info["architecture"] == ARCH]
+      if len(arch_images) == 0:
         continue
 
-      if tag_name in indexed_tags:
-        crawl_skipped.add(tag_name)
+      if is_indexed(tag_name):
         continue
 
       # For the index, use product instead of arch/product for the sake of the disambiguation.
@@ -89,25 +189,344 @@ for repository in ["amd64/ubuntu", "library/ubuntu"]:
         image_name = f"{product}@{digest}"
       else:
         # We are going to pull image using tag_name from product repository, not using the digest.
-        # Because sometimes we could not pull the image from the digest that given by the Docker Hub. 
+        # Because sometimes we could not pull the image from the digest that given by the Docker Hub.
         # For example, digest given by the Docker Hub for the image yakkety-20170704 is `sha256:7d3f705d...`,
         # but `docker pull ubuntu@sha256:7d3f705d...` does not works for some reason.
         # Instead of, we need to use another digest, which is `sha256:8dc96528...`.
         image_name = f"{product}:{tag_name}"
-      logger.info(f'indexing {tag_name}...')
-      subprocess.check_call(["docker", "pull", image_name])
-      index_image(image_name, INDEX_DIR)
-      
-      # add 
-      digest = get_image_digest(image_name)
-      image_name = f"{product}@{digest}"
-      image_index.add(image_name, version_name)
-      if version_name in name_to_version:
-        image_index.add(image_name, name_to_version[version_name])
-      
-      subprocess.check_call(["docker", "image", "rm", image_name])
-      logger.debug(f'removed image: {image_name=}')
-
-lost_tracked_image = indexed_tags - crawl_skipped
-if len(lost_tracked_image):
-  logger.warning(f"we have some lost tracked images: {lost_tracked_image}")
+      size = arch_images[0].get("size") or tag_info.get("full_size") or 0
+      yield ImageTask(repository, tag_name, version_name, product, image_name, size, last_updated)
+
+T = TypeVar("T")
+
+def retry(fn: Callable[[], T], description: str, attempts: int, backoff: float) -> T:
+  for attempt in range(1, attempts + 1):
+    try:
+      return fn()
+    except (subprocess.CalledProcessError, OSError) as e:
+      if attempts <= attempt:
+        raise
+      logger.warning(f"{description} failed ({e}), retrying ({attempt}/{attempts - 1})...")
+      time.sleep(backoff * 2 ** (attempt - 1))
+  assert False
+
+class DiskBudget:
+  def __init__(self, budget: int):
+    self.budget = budget
+    self.used = 0
+    self._cond = threading.Condition()
+
+  def acquire(self, size: int):
+    with self._cond:
+      # an image larger than the whole budget is still allowed when nothing else is on disk
+      self._cond.wait_for(lambda: self.used == 0 or self.used + size <= self.budget)
+      self.used += size
+
+  def adjust(self, old_size: int, new_size: int):
+    with self._cond:
+      self.used += new_size - old_size
+      self._cond.notify_all()
+
+  def release(self, size: int):
+    with self._cond:
+      self.used -= size
+      self._cond.notify_all()
+
+# uncompressed images are usually 2-3 times larger than the size reported by Docker Hub
+SIZE_ESTIMATE_FACTOR = 3
+
+class Crawler:
+  # daemonless: read the layers from the registry instead of pulling the images
+  def __init__(self, index_dir: Path, http: HttpClient, jobs: int, prefetch: int, max_pulls: int, disk_budget: int, retries: int, batch_size: int, hub_url: str=HUB_URL, endoflife_url: str=ENDOFLIFE_URL, daemonless=False):
+    self.index_dir = index_dir
+    self.http = http
+    self.hub_url = hub_url
+    self.endoflife_url = endoflife_url
+    self.image_index = ImageIndex(index_dir)
+    self.lib_index = LibIndex(index_dir)
+    self.jobs = jobs
+    self.prefetch = prefetch
+    self.retries = retries
+    self.batch_size = batch_size
+    self.pull_semaphore = threading.Semaphore(max_pulls)
+    self.index_semaphore = threading.Semaphore(jobs)
+    self.disk_budget = DiskBudget(disk_budget)
+    self.daemonless = daemonless
+
+    self._batch_lock = threading.Lock()
+    self._pending_images: list[tuple[str, str]] = []
+    self._pending_entries: list[tuple[str, LibInfo]] = []
+    self._pending_manifests: list[tuple[str, ManifestEntry]] = []
+    self._pending_symbols: list[tuple[str, int, str]] = []
+    self._pending_count = 0
+
+    self.indexed: list[str] = []
+    self.failed: list[ImageTask] = []
+
+  def _docker(self, *args: str):
+    return retry(lambda: check_output(["docker", *args], label=f"docker {args[0]}"), f"docker {args[0]} {args[-1]}", self.retries, 2)
+
+  def _image_size(self, image_name: str):
+    try:
+      return int(check_output(["docker", "image", "inspect", "--format={{.Size}}", image_name], label="docker image inspect").strip())
+    except (subprocess.CalledProcessError, ValueError):
+      return None
+
+  def _flush(self):
+    # caller holds _batch_lock
+    if self._pending_count == 0:
+      return
+    logger.info(f"writing index results of {self._pending_count} images...")
+    self.lib_index.add_many(self._pending_entries, self._pending_manifests, self._pending_symbols)
+    for image_identifier, tag in self._pending_images:
+      self.image_index.add(image_identifier, tag)
+    self._pending_images = []
+    self._pending_entries = []
+    self._pending_manifests = []
+    self._pending_symbols = []
+    self._pending_count = 0
+
+  def _record(self, task: ImageTask, scan: ImageScan, name_to_version: dict[str, str]):
+    # the date-pinned tag is recorded even when the image was pulled by digest, so the next crawl skips it
+    tags = [task.tag_name, task.version_name]
+    if task.version_name in name_to_version:
+      tags.append(name_to_version[task.version_name])
+    # the library rows are written before the tags, so a crash never leaves a tagged image without libraries
+    with self._batch_lock:
+      self._pending_entries += scan.entries
+      self._pending_manifests += scan.manifest_rows
+      self._pending_symbols += scan.symbols
+      self._pending_images += [(f"{task.product}@{scan.image_digest}", tag) for tag in tags]
+      self._pending_count += 1
+      if self.batch_size <= self._pending_count:
+        self._flush()
+
+  def process(self, task: ImageTask, name_to_version: dict[str, str]):
+    # the docker calls below are recorded as its children, see report_image_timings
+    with span("image", task.tag_name, image=task.image_name, size=task.size):
+      if self.daemonless:
+        self._process_layers(task, name_to_version)
+      else:
+        self._process(task, name_to_version)
+
+  # nothing is pulled, so neither the disk budget nor the pull slots are taken. the layers indexed for the
+  # previous tags are not fetched again
+  def _process_layers(self, task: ImageTask, name_to_version: dict[str, str]):
+    try:
+      with span("wait", "index slot"):
+        self.index_semaphore.acquire()
+      try:
+        logger.info(f'indexing {task.tag_name} ({task.image_name}) from the registry...')
+        scan = retry(lambda: scan_image_layers(f"docker://{task.image_name}", lib_index=self.lib_index), f"indexing {task.image_name}", self.retries, 2)
+      finally:
+        self.index_semaphore.release()
+      self._record(task, scan, name_to_version)
+      self.indexed.append(task.tag_name)
+    except Exception as e:
+      logger.error(f"failed to index {task.tag_name} ({task.image_name}): {e}")
+      self.failed.append(task)
+
+  def _process(self, task: ImageTask, name_to_version: dict[str, str]):
+    reserved = task.size * SIZE_ESTIMATE_FACTOR
+    with span("wait", "disk budget"):
+      self.disk_budget.acquire(reserved)
+    pulled = False
+    try:
+      with span("wait", "pull slot"):
+        self.pull_semaphore.acquire()
+      try:
+        logger.info(f'pulling {task.tag_name} ({task.image_name})...')
+        self._docker("pull", task.image_name)
+        pulled = True
+      finally:
+        self.pull_semaphore.release()
+      actual_size = self._image_size(task.image_name)
+      if actual_size is not None:
+        self.disk_budget.adjust(reserved, actual_size)
+        reserved = actual_size
+
+      with span("wait", "index slot"):
+        self.index_semaphore.acquire()
+      try:
+        logger.info(f'indexing {task.tag_name}...')
+        scan = retry(lambda: scan_image(task.image_name), f"indexing {task.image_name}", self.retries, 2)
+      finally:
+        self.index_semaphore.release()
+      self._record(task, scan, name_to_version)
+      self.indexed.append(task.tag_name)
+    except Exception as e:
+      logger.error(f"failed to index {task.tag_name} ({task.image_name}): {e}")
+      self.failed.append(task)
+    finally:
+      if pulled:
+        # removing the tag also drops the image unless another reference (e.g. product@digest) still uses it
+        with span("subprocess", "docker image rm", command=f"docker image rm {task.image_name}"):
+          removed = subprocess.run(["docker", "image", "rm", task.image_name], stdout=subprocess.DEVNULL).returncode == 0
+        if removed:
+          logger.debug(f'removed image: {task.image_name}')
+      self.disk_budget.release(reserved)
+
+  # full: ignore the high-water marks and walk every page
+  def run(self, repositories: list[str], indexed_tags: set[str], full=False):
+    crawl_skipped: set[str] = set()
+    scheduled: set[str] = set()
+    def is_indexed(tag_name: str):
+      if tag_name in indexed_tags:
+        crawl_skipped.add(tag_name)
+        return True
+      # the same tag is listed in both amd64/ubuntu and library/ubuntu
+      if tag_name in scheduled:
+        return True
+      scheduled.add(tag_name)
+      return False
+
+    crawl_state = load_crawl_state(self.index_dir)
+    newest_seen: dict[str, str] = {}
+
+    # workers beyond `jobs` are pulling the next images while the others are indexing
+    in_flight = threading.BoundedSemaphore(self.jobs + self.prefetch)
+    with ThreadPoolExecutor(self.jobs + self.prefetch) as executor:
+      for repository in repositories:
+        print("[+] getting the mapping...")
+        product = repository.split("/")[1]
+        name_to_version: dict[str, str] = get_name_mapping(self.http, product, self.endoflife_url)
+
+        since = None if full else crawl_state.get(repository, {}).get("last_updated")
+        for task in crawl_tags(self.http, repository, is_indexed, since, newest_seen, self.hub_url):
+          in_flight.acquire()
+          future = executor.submit(self.process, task, name_to_version)
+          future.add_done_callback(lambda _: in_flight.release())
+
+    with self._batch_lock:
+      self._flush()
+    # fold the append log into image_index.json before the data repository is committed
+    self.image_index.compact()
+
+    for repository, newest in newest_seen.items():
+      # do not move the mark past an image that failed, so that the next crawl retries it
+      failed = [task.last_updated for task in self.failed if task.repository == repository and task.last_updated is not None]
+      mark = min(failed) if len(failed) else newest
+      if mark > crawl_state.get(repository, {}).get("last_updated", ""):
+        crawl_state[repository] = { "last_updated": mark }
+    dump_crawl_state(self.index_dir, crawl_state)
+    return crawl_skipped
+
+# files in the index directory that are not published: the sqlite database changes as a whole every night, and the others
+# are derived from it or describe it. the data repository carries the portable formats only, which a new database is
+# rebuilt from
+UNPUBLISHED_FILES = ["lib_index.sqlite3", "lib_index.sqlite3-wal", "lib_index.sqlite3-shm", "lib_index.sqlite3-journal", "digest_table.bin", "image_index.lock", "sync.json", "*.tmp"]
+
+def ensure_gitignore(index_dir: Path):
+  path = index_dir / ".gitignore"
+  lines = path.read_text().splitlines() if path.exists() else []
+  missing = [name for name in UNPUBLISHED_FILES if name not in lines]
+  if len(missing) != 0:
+    path.write_text("".join(line + "\n" for line in lines + missing))
+
+# [{"tag", "image", "size", "duration", "steps": {"<category> <name>": seconds}}], slowest first
+def image_timings(recorder: Recorder) -> list[dict[str, Any]]:
+  res = []
+  for image_span in recorder.spans:
+    if image_span.category != "image": continue
+    steps: dict[str, float] = {}
+    for child in recorder.children(image_span):
+      key = f"{child.category} {child.name}"
+      steps[key] = steps.get(key, 0) + child.duration
+    res.append({ "tag": image_span.name, **image_span.args, "duration": image_span.duration, "steps": steps })
+  res.sort(key=lambda timing: -timing["duration"])
+  return res
+
+def report_image_timings(timings: list[dict[str, Any]], limit=10):
+  if len(timings) == 0: return
+  logger.info(f"slowest {min(limit, len(timings))} of {len(timings)} images:")
+  for timing in timings[:limit]:
+    steps = sorted(timing["steps"].items(), key=lambda step: -step[1])
+    logger.info(f"- {timing['tag']}: {timing['duration']:.1f}s ({', '.join(f'{name} {seconds:.1f}s' for name, seconds in steps[:4])})")
+
+def main():
+  parser = ArgumentParser()
+  parser.add_argument("--index-dir", default=str(INDEX_DIR), help="index directory (default: %(default)s)")
+  parser.add_argument("--jobs", "-j", type=int, default=2, help="number of images indexed concurrently")
+  parser.add_argument("--prefetch", type=int, default=2, help="number of images pulled ahead of indexing")
+  parser.add_argument("--max-pulls", type=int, default=2, help="maximum number of concurrent docker pulls")
+  parser.add_argument("--disk-budget", type=float, default=10, help="maximum local image disk usage in GB")
+  parser.add_argument("--retries", type=int, default=3, help="attempts for each docker operation before giving up the image")
+  parser.add_argument("--batch-size", type=int, default=16, help="number of images written to the index at once")
+  parser.add_argument("--full", action="store_true", help="rescan the whole tag history instead of stopping at the previous crawl")
+  parser.add_argument("--daemonless", action="store_true", help="read the image layers from the registry instead of pulling the images with docker")
+  parser.add_argument("--http-cache", default="./indexer-http-cache", help="directory for cached HTTP responses (default: %(default)s)")
+  parser.add_argument("--hub-url", default=HUB_URL, help="Docker Hub API base URL (default: %(default)s)")
+  parser.add_argument("--endoflife-url", default=ENDOFLIFE_URL, help="endoflife.date API base URL (default: %(default)s)")
+  parser.add_argument("--timings-output", help="write the time each image spent in pulling, waiting and indexing into this json file")
+  parser.add_argument("--profile-output", help="write the trace of the whole crawl into this file (Trace Event Format)")
+  args = parser.parse_args()
+
+  # cheap enough to be always on, and the per-image timings come from it
+  recorder = Recorder()
+  set_recorder(recorder)
+
+  index_dir = Path(args.index_dir)
+  assert index_dir.is_dir(), f"index directory not found: {index_dir}"
+
+  # lib_index.sqlite3 is the working copy of the indexer, kept out of the data repository. a new one starts from
+  # snapshot.bin, and the legacy layout fills in what is missing. the published delta segments bring back the manifests
+  # and symbols, which only they carry. the legacy layout itself stays for the released clients
+  ensure_gitignore(index_dir)
+  if not LibIndex(index_dir).exists():
+    if sync_local_deltas(index_dir) == 0:
+      migrate_legacy_index(index_dir)
+
+  http = HttpClient(Path(args.http_cache))
+  crawler = Crawler(
+    index_dir,
+    http,
+    jobs=args.jobs,
+    prefetch=args.prefetch,
+    max_pulls=args.max_pulls,
+    disk_budget=int(args.disk_budget * 1024 ** 3),
+    retries=args.retries,
+    batch_size=args.batch_size,
+    hub_url=args.hub_url,
+    endoflife_url=args.endoflife_url,
+    daemonless=args.daemonless,
+  )
+
+  indexed_tags = set()
+  for tags in crawler.image_index.load().values():
+    indexed_tags.update(filter(is_date_pinned_tag_name, tags))
+
+  # TODO: index debian and alpine
+  recorder.phase("crawl")
+  crawl_skipped = crawler.run(["amd64/ubuntu", "library/ubuntu"], indexed_tags, full=args.full)
+
+  logger.info(f"indexed {len(crawler.indexed)} images ({http.requests} HTTP requests, {http.not_modified} not modified)")
+  if len(crawler.failed):
+    logger.warning(f"failed to index some images: {[task.tag_name for task in crawler.failed]}")
+
+  # the shards are what `preplib --server` fetches from the published data repository
+  recorder.phase("export")
+  export_shards(index_dir, index_dir / "shards")
+  export_legacy_cache(index_dir)
+  # what `preplib --sync` follows, so that a mirror only downloads what this crawl added
+  export_deltas(crawler.lib_index, crawler.image_index, index_dir / "deltas")
+  # the same data as one file that preplib reads through mmap, for the clones of the data repository
+  export_snapshot(crawler.lib_index, crawler.image_index.load())
+  # built here so that the first prefix lookup does not have to
+  DigestTable.build(crawler.lib_index).close()
+  recorder.phase(None)
+
+  timings = image_timings(recorder)
+  report_image_timings(timings)
+  if args.timings_output is not None:
+    Path(args.timings_output).write_text(json.dumps(timings, indent=2) + "\n")
+  if args.profile_output is not None:
+    recorder.dump(args.profile_output, "chrome")
+
+  # an incremental crawl stops before reaching the old tags, so it can not tell whether they are lost
+  if args.full:
+    lost_tracked_image = indexed_tags - crawl_skipped
+    if len(lost_tracked_image):
+      logger.warning(f"we have some lost tracked images: {lost_tracked_image}")
+
+if __name__ == "__main__":
+  main()
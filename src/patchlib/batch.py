@@ -0,0 +1,197 @@
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+import hashlib
+import json
+import os
+from pathlib import Path
+import shutil
+from subprocess import CalledProcessError, check_call
+from typing import Any, NamedTuple, Optional
+
+from preplib.elf import ElfError, ElfFile, read_elf_info
+
+# <lib dir>/.patchlib.json: {<sha256 of a binary patched to use the lib dir>: {"interp", "runpath", "rpath"}},
+# where rpath is the RPATH the binary had before
+STATE_NAME = ".patchlib.json"
+
+class PatchTask(NamedTuple):
+  binary: str
+  # the patched copy, or the binary itself
+  output: str
+  lib_dir: str
+  # the value written into DT_RUNPATH is this, followed by the old RPATH
+  lib_path: str
+  interp: Optional[str]
+  force: bool
+  # the state of the lib dir
+  state: dict[str, dict[str, Any]]
+
+def find_ld_candidates(lib_dir: Path) -> list[Path]:
+  return sorted(path for path in lib_dir.iterdir() if path.is_file() and path.name.startswith("ld"))
+
+def file_sha256(path: str):
+  h = hashlib.sha256()
+  with open(path, "rb") as f:
+    while chunk := f.read(1 << 20):
+      h.update(chunk)
+  return h.hexdigest()
+
+# dynamically linked executables: PT_INTERP but no soname (libc.so.6 has a PT_INTERP too)
+def is_patch_target(path: Path):
+  try:
+    with path.open("rb") as f:
+      if f.read(4) != b"\x7fELF": return False
+    info = read_elf_info(path)
+  except (ElfError, OSError):
+    return False
+  return info.interp is not None and info.soname is None
+
+def discover_binaries(root: Path, lib_name: str) -> list[Path]:
+  res = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    # the extracted libraries of each challenge
+    dirnames[:] = sorted(d for d in dirnames if d != lib_name and not d.startswith("."))
+    for filename in sorted(filenames):
+      path = Path(dirpath) / filename
+      if path.is_file() and not path.is_symlink() and is_patch_target(path):
+        res.append(path)
+  return res
+
+def load_state(lib_dir: Path) -> dict[str, dict[str, Any]]:
+  state_path = lib_dir / STATE_NAME
+  if not state_path.exists(): return {}
+  try:
+    return json.loads(state_path.read_text())
+  except ValueError:
+    return {}
+
+def dump_state(lib_dir: Path, state: dict[str, dict[str, Any]]):
+  tmp_path = lib_dir / (STATE_NAME + ".tmp")
+  tmp_path.write_text(json.dumps(state, indent=1))
+  os.replace(tmp_path, lib_dir / STATE_NAME)
+
+# runs in a worker process. PT_INTERP and DT_RUNPATH are rewritten in place when the new strings fit,
+# and patchelf is only run when the file has to grow. a binary without an RPATH or RUNPATH has no room for one, so
+# in place is for the binaries patched before (e.g. after the challenge directory moved) and patchelf does the first patch
+def patch_binary(task: PatchTask) -> dict[str, Any]:
+  res: dict[str, Any] = { "binary": task.binary, "output": task.output, "lib_dir": task.lib_dir }
+  try:
+    digest = file_sha256(task.output) if os.path.exists(task.output) else None
+    recorded = task.state.get(digest) if digest is not None else None
+    if recorded is not None:
+      # patched into this lib dir before, maybe when it was somewhere else. the lib path written then is replaced
+      rpath = recorded["rpath"]
+      runpath = f"{task.lib_path}:{rpath}" if rpath != "" else task.lib_path
+      if runpath == recorded["runpath"] and (task.interp is None or recorded["interp"] == task.interp) and not task.force:
+        return { **res, "status": "skipped", "rpath": rpath, "runpath": runpath, "sha256": digest }
+    else:
+      info = read_elf_info(task.binary)
+      rpath = info.runpath or info.rpath or ""
+      if rpath != "" and not task.force:
+        # patched by something that did not leave a state, e.g. the single binary mode
+        if task.output == task.binary and rpath.split(":")[0] == task.lib_path and (task.interp is None or info.interp == task.interp):
+          return { **res, "status": "skipped", "rpath": ":".join(rpath.split(":")[1:]), "runpath": rpath, "sha256": file_sha256(task.output) }
+        return { **res, "status": "error", "error": f"the binary already patched. ({rpath=}) put --force to patch it anyway" }
+      runpath = f"{task.lib_path}:{rpath}" if rpath != "" else task.lib_path
+      if task.output != task.binary:
+        shutil.copy2(task.binary, task.output)
+
+    with ElfFile.open(task.output, writable=True) as elf:
+      runpath_writes = elf.runpath_patch(runpath)
+      interp_writes = elf.interp_patch(task.interp) if task.interp is not None else []
+      in_place = runpath_writes is not None and interp_writes is not None
+      if in_place:
+        elf.write(runpath_writes + interp_writes)
+    if not in_place:
+      patchelf_args = ["patchelf", "--set-rpath", runpath]
+      if task.interp is not None:
+        patchelf_args += ["--set-interpreter", task.interp]
+      check_call(patchelf_args + [task.output])
+    return {
+      **res, "status": "patched", "method": "in-place" if in_place else "patchelf", "rpath": rpath, "runpath": runpath,
+      "sha256": file_sha256(task.output), "replaced": digest if recorded is not None else None,
+    }
+  except (ElfError, OSError, CalledProcessError) as e:
+    return { **res, "status": "error", "error": f"{type(e).__name__}: {e}" }
+
+def batch_main(argv: list[str]):
+  parser = ArgumentParser(
+    prog="patchlib batch",
+    description="patch the binaries to use the libraries and ld in their lib dir. the binaries patched before are rewritten in place when the new paths are no longer than the old ones. the others (any binary without an RPATH or RUNPATH) are patched with patchelf, which must be in PATH",
+  )
+  parser.add_argument("inputs", nargs="+", help="binaries to patch, or directories to search for dynamically linked executables")
+  parser.add_argument("--lib", "-l", default="lib", help="path to libs. a relative path is looked up from the directory of each binary (default: %(default)s)")
+  parser.add_argument("--relative", action="store_true", help="patch libpath and ld relative to the directory of each binary, for running it from there")
+  parser.add_argument("--no-ld", dest="no_ld", action="store_true", help="Do not patch ld")
+  parser.add_argument("--suffix", help="write the patched binary into <binary><suffix> instead of patching it in place")
+  parser.add_argument("--force", "-f", action="store_true", help="Patch the binaries even if they are already patched.")
+  parser.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1, help="binaries patched in parallel (default: %(default)s)")
+  args = parser.parse_args(argv)
+
+  binaries: list[Path] = []
+  for path in map(Path, args.inputs):
+    if path.is_dir():
+      binaries += discover_binaries(path, Path(args.lib).name)
+    elif path.is_file():
+      binaries.append(path)
+    else:
+      print(f"[!] no such file or directory: {path}")
+      exit(1)
+  if args.suffix is not None:
+    binaries = [binary for binary in binaries if not binary.name.endswith(args.suffix)]
+  if len(binaries) == 0:
+    print("[!] no binaries to patch")
+    exit(1)
+
+  # ld is looked up once per lib dir
+  lib_dirs: dict[Path, tuple[Optional[Path], dict[str, dict[str, Any]]]] = {}
+  tasks: list[PatchTask] = []
+  failed = []
+  for binary in binaries:
+    lib_dir = (binary.parent / args.lib).resolve()
+    if lib_dir not in lib_dirs:
+      if not lib_dir.is_dir():
+        print(f"[!] {binary}: lib dir {lib_dir} does not exist")
+        failed.append(binary)
+        continue
+      candidates = find_ld_candidates(lib_dir)
+      if len(candidates) == 0 and not args.no_ld:
+        print(f"[!] ld does not exists in {lib_dir}")
+      if 2 <= len(candidates) and not args.no_ld:
+        print(f"[!] multiple ld candidates found in {lib_dir}. use {candidates[0].name}")
+      lib_dirs[lib_dir] = (candidates[0] if len(candidates) != 0 else None, load_state(lib_dir))
+    ld_path, state = lib_dirs[lib_dir]
+    if ld_path is None and not args.no_ld:
+      failed.append(binary)
+      continue
+
+    binary_dir = binary.parent.resolve()
+    lib_path = os.path.relpath(lib_dir, binary_dir) if args.relative else str(lib_dir)
+    interp = None
+    if not args.no_ld:
+      assert ld_path is not None
+      interp = os.path.join(".", os.path.relpath(ld_path, binary_dir)) if args.relative else str(ld_path)
+    output = str(binary) + (args.suffix or "")
+    tasks.append(PatchTask(str(binary), output, str(lib_dir), lib_path, interp, args.force, state))
+
+  with ProcessPoolExecutor(max(1, min(args.jobs, len(tasks) or 1))) as executor:
+    results = list(executor.map(patch_binary, tasks, chunksize=4))
+
+  counts: dict[str, int] = {}
+  for task, result in zip(tasks, results):
+    counts[result["status"]] = counts.get(result["status"], 0) + 1
+    state = lib_dirs[Path(task.lib_dir)][1]
+    if result["status"] == "patched":
+      print(f"[*] {result['output']}: patched ({result['method']}, runpath={result['runpath']})")
+      state.pop(result["replaced"], None)
+      state[result["sha256"]] = { "interp": task.interp, "runpath": result["runpath"], "rpath": result["rpath"] }
+    elif result["status"] == "skipped":
+      state.setdefault(result["sha256"], { "interp": task.interp, "runpath": result["runpath"], "rpath": result["rpath"] })
+    else:
+      print(f"[!] {result['binary']}: {result['error']}")
+  for lib_dir, (_, state) in lib_dirs.items():
+    dump_state(lib_dir, state)
+
+  print(f"[*] {counts.get('patched', 0)} patched, {counts.get('skipped', 0)} already patched, {counts.get('error', 0) + len(failed)} failed")
+  if counts.get("error", 0) + len(failed) != 0:
+    exit(1)
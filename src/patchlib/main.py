@@ -1,9 +1,18 @@
 #!/bin/python
 from argparse import ArgumentParser
-from subprocess import check_call, check_output
+from subprocess import check_call
 from pathlib import Path
+import sys
+
+from patchlib.batch import batch_main, find_ld_candidates
+from preplib.elf import read_elf_info
 
 def main():
+  # `patchlib batch` patches many binaries at once, in process where it can
+  if sys.argv[1:2] == ["batch"]:
+    batch_main(sys.argv[2:])
+    return
+
   parser = ArgumentParser()
   parser.add_argument("--output", "-o", help="output directory")
   # TODO: parser.add_argument("--image", "-i", help="image")
@@ -16,7 +25,9 @@ def main():
   parser.add_argument("binary", help="binary to patch")
   args = parser.parse_args()
 
-  rpath = check_output(["patchelf", "--print-rpath", args.binary]).strip().decode()
+  # same as `patchelf --print-rpath`: DT_RUNPATH if exists, otherwise DT_RPATH
+  elf_info = read_elf_info(args.binary)
+  rpath = elf_info.runpath or elf_info.rpath or ""
   if not args.force:
     # TODO: check ld
     if 1 <= len(rpath):
@@ -37,11 +48,7 @@ def main():
     if args.ld is not None:
       ldpath = Path(args.ld)
     else:
-      ld_candidates = []
-      for path in libpath.iterdir():
-        if not path.is_file(): continue
-        if path.name.startswith("ld"):
-          ld_candidates.append(path)
+      ld_candidates = find_ld_candidates(libpath)
       if len(ld_candidates) == 0:
         print("[!] ld does not exists")
       if 2 <= len(ld_candidates):
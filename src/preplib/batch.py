@@ -0,0 +1,219 @@
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+import json
+import logging
+import os
+from os import PathLike
+from pathlib import Path
+import re
+from subprocess import CalledProcessError
+import tempfile
+from typing import Any, NamedTuple, Optional, Union
+
+from preplib.blobcache import BlobCache, default_blob_cache_size, extract_libraries_cached
+from preplib.elf import ElfError, read_elf_info
+from preplib.extract import find_libraries
+from preplib.index import LIBDIGESTINFO_SERVER, default_cache_dir
+from preplib.logger import logger
+from preplib.lookup import Lookup, make_target
+from preplib.metacache import set_metadata_cache
+from preplib.resolve import find_binary_libraries
+from preplib.utils import container_session, copy_file, is_digest_like, parse_image_name
+
+# libc.so.6, libc-2.31.so, ld-linux-x86-64.so.2, ld-musl-x86_64.so.1 ...
+LIBRARY_NAME_PATTERN = re.compile(r"^(lib|ld)[^/]*\.so(\.[0-9.]+)?$")
+
+class BatchTarget(NamedTuple):
+  name: str
+  # library files (or their hashes) that identify the image
+  files: list[str]
+  # the dependencies of these are extracted. if there are none, the default ones (= libc and the loader) are
+  binaries: list[str]
+  image: Optional[str]
+  output: Path
+
+# every directory that contains a library is a target, and the executables next to it are its binaries
+def discover_targets(root: Union[PathLike, str], out_root: Union[PathLike, str]) -> list[BatchTarget]:
+  root = Path(root)
+  out_root = Path(out_root).absolute()
+  targets = []
+  for dirpath, dirnames, filenames in os.walk(root):
+    # the output may be inside the tree, and it is full of libraries
+    dirnames[:] = sorted(d for d in dirnames if (Path(dirpath) / d).absolute() != out_root)
+    files, binaries = [], []
+    for name in sorted(filenames):
+      path = Path(dirpath) / name
+      if not path.is_file(): continue
+      if LIBRARY_NAME_PATTERN.match(name):
+        files.append(str(path))
+        continue
+      try:
+        if read_elf_info(path).interp is not None:
+          binaries.append(str(path))
+      except (ElfError, ValueError, OSError):
+        continue
+    if len(files) == 0: continue
+    rel_path = Path(dirpath).relative_to(root)
+    name = str(rel_path) if rel_path != Path(".") else root.absolute().name
+    targets.append(BatchTarget(name, files, binaries, None, out_root / rel_path))
+  return targets
+
+# {"targets": [{"name": <name>, "files": [<library file or hash>...], "binaries": [<file>...], "image": <image name>, "output": <dir>}]}
+# only "name" is required, and it has to be unique. "image" skips the lookup, and relative paths are relative to the manifest
+def load_batch_manifest(manifest_path: Union[PathLike, str], out_root: Union[PathLike, str]) -> list[BatchTarget]:
+  manifest_path = Path(manifest_path)
+  base_dir = manifest_path.parent
+  def resolve_path(val: str):
+    return val if is_digest_like(val) and not (base_dir / val).exists() else str(base_dir / val)
+  targets = []
+  names: set[str] = set()
+  for target in json.loads(manifest_path.read_text())["targets"]:
+    name = target["name"]
+    # the results are keyed by name
+    if name in names:
+      raise ValueError(f"duplicate target name in {manifest_path}: {name}")
+    names.add(name)
+    output = base_dir / target["output"] if "output" in target else Path(out_root) / name
+    targets.append(BatchTarget(
+      name,
+      [resolve_path(val) for val in target.get("files", [])],
+      [str(base_dir / val) for val in target.get("binaries", [])],
+      target.get("image"),
+      output,
+    ))
+  return targets
+
+def run_batch(
+  targets: list[BatchTarget], index_dir: Union[PathLike, str]=default_cache_dir, server: Optional[str]=None,
+  use_daemon=True, jobs=4, blob_cache: Optional[BlobCache]=None
+) -> dict[str, Any]:
+  results: dict[str, dict[str, Any]] = {
+    target.name: { "name": target.name, "status": "pending", "image": target.image, "output": str(target.output) }
+    for target in targets
+  }
+
+  # all targets are looked up in one pass over the index
+  lookup_targets = []
+  for target in targets:
+    if target.image is not None: continue
+    query = [make_target(val) for val in target.files]
+    if len(query) == 0 or None in query:
+      results[target.name].update(status="error", error=f"no library files or hashes to look up: {target.files}")
+      continue
+    lookup_targets.append((target, query))
+  images: dict[str, str] = {}
+  for target in targets:
+    if target.image is None: continue
+    # by digest, so that it shares the extraction with the targets that were looked up
+    try:
+      repository, _, image_digest = parse_image_name(target.image)
+      images[target.name] = f"{repository}@{image_digest}"
+    except CalledProcessError:
+      images[target.name] = target.image
+  if len(lookup_targets) != 0:
+    logger.info(f"searching images of {len(lookup_targets)} targets from indexed libraries...")
+    lookup = Lookup(index_dir, server, use_daemon)
+    for (target, _), candidates in zip(lookup_targets, lookup.match_many([query for _, query in lookup_targets])):
+      results[target.name]["candidates"] = list(candidates)
+      if len(candidates) == 0:
+        results[target.name].update(status="not_found")
+        continue
+      # last(=usually latest) one, same as the single target mode
+      images[target.name] = list(candidates)[-1]
+      results[target.name]["image"] = images[target.name]
+
+  groups: dict[str, list[BatchTarget]] = {}
+  for target in targets:
+    if target.name in images:
+      groups.setdefault(images[target.name], []).append(target)
+
+  # one extraction per image, shared by all of its targets
+  def process_image(image: str, group: list[BatchTarget]):
+    try:
+      # ldd and the extraction share one container. the binaries are mounted one by one, so their ldd is not
+      with container_session(image):
+        lib_paths: dict[str, list[str]] = {}
+        for target in group:
+          paths = []
+          for binary_path in target.binaries:
+            paths += find_binary_libraries(image, binary_path, index_dir)
+          if len(target.binaries) == 0:
+            paths = find_libraries(image, None)
+          lib_paths[target.name] = sorted(set(paths))
+        all_lib_paths = sorted(set(path for paths in lib_paths.values() for path in paths))
+        with tempfile.TemporaryDirectory(prefix="preplib-batch-") as staging_dir:
+          extract_libraries_cached(image, all_lib_paths, staging_dir, blob_cache)
+          for target in group:
+            target.output.mkdir(parents=True, exist_ok=True)
+            for path in lib_paths[target.name]:
+              extracted = Path(staging_dir) / Path(path).name
+              if extracted.exists():
+                copy_file(extracted, target.output / extracted.name)
+            results[target.name].update(status="ok", libraries=lib_paths[target.name])
+    except Exception as e:
+      logger.warning(f"failed to extract libraries from {image}: {e!r}")
+      for target in group:
+        results[target.name].update(status="error", error=f"{type(e).__name__}: {e}")
+
+  logger.info(f"extracting libraries of {len(groups)} images for {sum(len(group) for group in groups.values())} targets...")
+  with ThreadPoolExecutor(max(1, jobs)) as executor:
+    list(executor.map(lambda item: process_image(*item), groups.items()))
+
+  return {
+    "images": { image: [target.name for target in group] for image, group in groups.items() },
+    "targets": [results[target.name] for target in targets],
+  }
+
+def batch_main(argv: list[str]):
+  parser = ArgumentParser(prog="preplib batch")
+  parser.add_argument("input", help="directory tree of challenges (every directory with a library is a target) | batch manifest (.json)")
+  parser.add_argument("--output", "-o", help="output root directory. each target gets <output>/<target name> (default: %(default)s)", default="./preplib-batch")
+  parser.add_argument("--summary", help="where to write the json summary, - for stdout (default: <output>/summary.json)")
+  parser.add_argument("--jobs", "-j", type=int, default=4, help="images extracted in parallel (default: %(default)s)")
+  parser.add_argument("--index-dir", nargs="?", help="index directory (default: user-cache-dir)", default=str(default_cache_dir))
+  parser.add_argument("--server", nargs="?", const=LIBDIGESTINFO_SERVER, help=f"look up the index shards on the server instead of --index-dir (default server: {LIBDIGESTINFO_SERVER})")
+  parser.add_argument("--no-daemon", action="store_true", help="do not query `preplib serve` even if it is running")
+  parser.add_argument("--no-cache", action="store_true", help="do not use the local library and image metadata caches")
+  parser.add_argument("--cache-size", type=int, default=default_blob_cache_size // 1024 ** 2, help="size limit of the local library cache in MB (default: %(default)s)")
+  parser.add_argument("--verbose", "-v", action="store_true", help="enable verbose output")
+  parser.add_argument("--quiet", "-q", action="store_true", help="enable quiet output")
+  args = parser.parse_args(argv)
+  if args.verbose:
+    logger.setLevel(logging.DEBUG)
+  elif args.quiet:
+    logger.setLevel(logging.WARN)
+  if args.no_cache:
+    set_metadata_cache(None)
+
+  out_root = Path(args.output)
+  if Path(args.input).is_dir():
+    targets = discover_targets(args.input, out_root)
+  elif Path(args.input).is_file():
+    try:
+      targets = load_batch_manifest(args.input, out_root)
+    except ValueError as e:
+      logger.error(str(e))
+      exit(1)
+  else:
+    logger.error(f"no such directory or manifest: {args.input}")
+    exit(1)
+  if len(targets) == 0:
+    logger.error(f"no targets found in {args.input}")
+    exit(1)
+
+  blob_cache = None if args.no_cache else BlobCache(size_limit=args.cache_size * 1024 ** 2)
+  summary = run_batch(targets, args.index_dir, args.server, not args.no_daemon, args.jobs, blob_cache)
+
+  summary_text = json.dumps(summary, indent=2)
+  if args.summary == "-":
+    print(summary_text)
+  else:
+    summary_path = Path(args.summary) if args.summary is not None else out_root / "summary.json"
+    summary_path.parent.mkdir(parents=True, exist_ok=True)
+    summary_path.write_text(summary_text + "\n")
+    logger.info(f"wrote the summary into {summary_path}")
+
+  failed = [result["name"] for result in summary["targets"] if result["status"] != "ok"]
+  if len(failed) != 0:
+    logger.warning(f"{len(failed)} of {len(targets)} targets failed: {', '.join(failed)}")
+    exit(1)
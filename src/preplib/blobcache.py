@@ -0,0 +1,124 @@
+import json
+import os
+from os import PathLike
+from pathlib import Path
+import shutil
+import stat
+from subprocess import CalledProcessError
+import tempfile
+from typing import Optional, Union
+
+from preplib.elf import file_digest
+from preplib.extract import extract_libraries
+from preplib.index import default_cache_dir
+from preplib.logger import logger
+from preplib.timing import traced
+from preplib.utils import copy_file, parse_image_name
+
+default_blob_cache_dir = default_cache_dir.with_name(default_cache_dir.name + "-blobs")
+default_blob_cache_size = 2 * 1024 ** 3
+
+# blobs/<md5>: extracted library files, read-only and copied (reflinked where possible) into the output
+# images/<image digest>.json: {"files": {<path in image>: <md5>}}
+class BlobCache:
+  def __init__(self, cache_dir: Union[PathLike, str]=default_blob_cache_dir, size_limit: int=default_blob_cache_size):
+    self.cache_dir = Path(cache_dir)
+    self.size_limit = size_limit
+
+  def _get_blob_path(self, digest: str):
+    return self.cache_dir / "blobs" / digest
+
+  def _get_image_path(self, image_digest: str):
+    return self.cache_dir / "images" / f"{image_digest.replace(':', '_')}.json"
+
+  def _load_image(self, image_digest: str) -> dict[str, dict]:
+    image_path = self._get_image_path(image_digest)
+    if not image_path.exists(): return { "files": {} }
+    try:
+      return json.loads(image_path.read_text())
+    except ValueError:
+      logger.debug(f"corrupt blob cache entry: {image_path}")
+      return { "files": {} }
+
+  def _dump_image(self, image_digest: str, image: dict[str, dict]):
+    image_path = self._get_image_path(image_digest)
+    image_path.parent.mkdir(parents=True, exist_ok=True)
+    # other preplib processes may read it at the same time
+    with tempfile.NamedTemporaryFile("w", dir=image_path.parent, delete=False) as f:
+      f.write(json.dumps(image))
+    os.replace(f.name, image_path)
+
+  # copy the cached files of the image into outdir. returns False without touching outdir unless all of them are cached
+  @traced("cache")
+  def populate(self, image_digest: str, lib_paths: list[str], outdir: Union[PathLike, str]):
+    files = self._load_image(image_digest)["files"]
+    blob_paths = []
+    for lib_path in lib_paths:
+      digest = files.get(lib_path)
+      if digest is None or not self._get_blob_path(digest).exists():
+        return False
+      blob_paths.append((lib_path, self._get_blob_path(digest)))
+
+    outdir = Path(outdir)
+    outdir.mkdir(parents=True, exist_ok=True)
+    for lib_path, blob_path in blob_paths:
+      target = outdir / Path(lib_path).name
+      copy_file(blob_path, target)
+      # the access time is used for LRU eviction
+      os.utime(blob_path)
+      logger.debug(f"cache hit: {lib_path} -> {target}")
+    return True
+
+  # store the files that extract_libraries wrote into outdir
+  @traced("cache")
+  def store(self, image_digest: str, lib_paths: list[str], outdir: Union[PathLike, str]):
+    image = self._load_image(image_digest)
+    blob_dir = self.cache_dir / "blobs"
+    blob_dir.mkdir(parents=True, exist_ok=True)
+    for lib_path in lib_paths:
+      extracted = Path(outdir) / Path(lib_path).name
+      if not extracted.is_file(): continue
+      digest = file_digest(extracted, "md5")
+      blob_path = self._get_blob_path(digest)
+      if not blob_path.exists():
+        with tempfile.NamedTemporaryFile(dir=blob_dir, delete=False) as f:
+          tmp_path = Path(f.name)
+        shutil.copy2(extracted, tmp_path)
+        # read-only, so that only store writes into the cache
+        tmp_path.chmod(stat.S_IMODE(extracted.stat().st_mode) & ~0o222)
+        os.replace(tmp_path, blob_path)
+      image["files"][lib_path] = digest
+    self._dump_image(image_digest, image)
+    self.evict()
+
+  def evict(self):
+    blob_dir = self.cache_dir / "blobs"
+    if not blob_dir.is_dir(): return
+    blobs = [(path, path.stat()) for path in blob_dir.iterdir() if path.is_file()]
+    total = sum(st.st_size for _, st in blobs)
+    if total <= self.size_limit: return
+    # least recently used first
+    blobs.sort(key=lambda blob: blob[1].st_mtime)
+    for path, st in blobs:
+      if total <= self.size_limit: break
+      logger.debug(f"evict {path} from the blob cache")
+      path.unlink(missing_ok=True)
+      total -= st.st_size
+
+# extract_libraries, served from the cache when every library of the image is already there
+def extract_libraries_cached(image_name: str, lib_paths: list[str], outdir: Union[PathLike, str], blob_cache: Optional[BlobCache]):
+  image_digest = None
+  if blob_cache is not None:
+    try:
+      _, _, image_digest = parse_image_name(image_name)
+    except CalledProcessError:
+      logger.debug(f"could not resolve the digest of {image_name}. the library cache is not used")
+
+  if blob_cache is not None and image_digest is not None and blob_cache.populate(image_digest, lib_paths, outdir):
+    logger.info(f"copied {len(lib_paths)} libraries of image {image_name} from the cache")
+    return
+
+  logger.info(f"extracting {len(lib_paths)} libraries from image {image_name}...")
+  extract_libraries(image_name, lib_paths, outdir)
+  if blob_cache is not None and image_digest is not None:
+    blob_cache.store(image_digest, lib_paths, outdir)
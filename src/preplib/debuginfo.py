@@ -0,0 +1,191 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+from os import PathLike
+from pathlib import Path
+import shutil
+import stat
+import tempfile
+import time
+from typing import Optional, Union
+from urllib.error import HTTPError, URLError
+from urllib.request import urlopen
+
+from preplib.elf import ElfError, ElfFile
+from preplib.index import ManifestEntry, default_cache_dir
+from preplib.logger import logger
+from preplib.timing import span, traced
+from preplib.utils import copy_file
+
+DEBUGINFOD_SERVERS = ["https://debuginfod.elfutils.org"]
+default_debug_cache_dir = default_cache_dir.with_name(default_cache_dir.name + "-debuginfo")
+default_debug_cache_size = 4 * 1024 ** 3
+# a build id that no server has is asked again after this many seconds
+MISSING_TTL = 24 * 60 * 60
+
+# the servers in $DEBUGINFOD_URLS (space separated, as elfutils reads it), or the public one
+def debuginfod_urls() -> list[str]:
+  urls = os.environ.get("DEBUGINFOD_URLS", "").split()
+  return urls if len(urls) != 0 else DEBUGINFOD_SERVERS
+
+# where gdb looks for the debug file of a build id under its debug-file-directory
+def build_id_debug_path(build_id: str):
+  return Path(".build-id") / build_id[:2] / f"{build_id[2:]}.debug"
+
+def _place(src: Path, dest: Path):
+  dest.parent.mkdir(parents=True, exist_ok=True)
+  copy_file(src, dest)
+
+def _read_build_id(path: Union[PathLike, str]) -> Optional[str]:
+  try:
+    with ElfFile.open(path) as elf:
+      return elf.build_id()
+  except (ElfError, OSError, ValueError):
+    return None
+
+# <build id>/debuginfo, the layout of the elfutils client cache.
+# <build id>/missing records when no server had it, so that it is not asked on every run
+class DebugInfoCache:
+  def __init__(self, cache_dir: Union[PathLike, str]=default_debug_cache_dir, size_limit: int=default_debug_cache_size):
+    self.cache_dir = Path(cache_dir)
+    self.size_limit = size_limit
+
+  def _get_path(self, build_id: str):
+    return self.cache_dir / build_id / "debuginfo"
+
+  def _get_missing_path(self, build_id: str):
+    return self.cache_dir / build_id / "missing"
+
+  def get(self, build_id: str) -> Optional[Path]:
+    path = self._get_path(build_id)
+    if not path.exists(): return None
+    # the access time is used for LRU eviction
+    os.utime(path)
+    return path
+
+  def is_missing(self, build_id: str):
+    missing_path = self._get_missing_path(build_id)
+    try:
+      return time.time() - missing_path.stat().st_mtime < MISSING_TTL
+    except FileNotFoundError:
+      return False
+
+  def mark_missing(self, build_id: str):
+    missing_path = self._get_missing_path(build_id)
+    missing_path.parent.mkdir(parents=True, exist_ok=True)
+    missing_path.touch()
+
+  def tmp_dir(self):
+    self.cache_dir.mkdir(parents=True, exist_ok=True)
+    return self.cache_dir
+
+  # move a downloaded file into the cache
+  def store(self, build_id: str, tmp_path: Path) -> Path:
+    path = self._get_path(build_id)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # read-only, so that only store writes into the cache
+    tmp_path.chmod(stat.S_IMODE(tmp_path.stat().st_mode) & ~0o222)
+    os.replace(tmp_path, path)
+    self._get_missing_path(build_id).unlink(missing_ok=True)
+    return path
+
+  def evict(self):
+    if not self.cache_dir.is_dir(): return
+    files = [(path, path.stat()) for path in self.cache_dir.glob("*/debuginfo")]
+    total = sum(st.st_size for _, st in files)
+    if total <= self.size_limit: return
+    # least recently used first
+    files.sort(key=lambda file: file[1].st_mtime)
+    for path, st in files:
+      if total <= self.size_limit: break
+      logger.debug(f"evict {path} from the debuginfo cache")
+      path.unlink(missing_ok=True)
+      total -= st.st_size
+
+# GET <server>/buildid/<build id>/debuginfo from each server in turn, into a temporary file in tmp_dir.
+# the file is only kept if it has the build id that was asked for
+def download_debuginfo(build_id: str, urls: list[str], tmp_dir: Union[PathLike, str]) -> Optional[Path]:
+  for base_url in urls:
+    url = f"{base_url.rstrip('/')}/buildid/{build_id}/debuginfo"
+    logger.debug(f"fetching {url}...")
+    with tempfile.NamedTemporaryFile(dir=tmp_dir, prefix=".debuginfo-", delete=False) as f:
+      tmp_path = Path(f.name)
+      try:
+        with span("remote", "debuginfod", url=url) as span_args, urlopen(url, timeout=60) as res:
+          shutil.copyfileobj(res, f, 1 << 20)
+          span_args["bytes_read"] = f.tell()
+      except HTTPError as e:
+        tmp_path.unlink()
+        # 404 is the usual answer for a build id the server does not know
+        if e.code != 404:
+          logger.warning(f"failed to fetch {url}: {e}")
+        continue
+      except (URLError, OSError) as e:
+        tmp_path.unlink(missing_ok=True)
+        logger.warning(f"failed to fetch {url}: {e}")
+        continue
+    if _read_build_id(tmp_path) != build_id:
+      logger.warning(f"{url} is not the debug file of {build_id}")
+      tmp_path.unlink()
+      continue
+    return tmp_path
+  return None
+
+# build id of each extracted library, from the image manifest or else from the extracted file
+def library_build_ids(lib_paths: list[str], outdir: Union[PathLike, str], manifest: list[ManifestEntry]) -> dict[str, str]:
+  by_path = { entry.path: entry.build_id for entry in manifest }
+  build_ids = {}
+  for lib_path in lib_paths:
+    build_id = by_path.get(lib_path) or _read_build_id(Path(outdir) / Path(lib_path).name)
+    if build_id is not None:
+      build_ids[lib_path] = build_id
+    else:
+      logger.debug(f"{lib_path} has no build id")
+  return build_ids
+
+# place the debug files of the build ids under <outdir>/.debug/.build-id, which gdb reads with
+# `set debug-file-directory <outdir>/.debug`. returns the placed path of each build id, None if no server had it
+@traced("debuginfo")
+def fetch_debuginfo(build_ids: list[str], outdir: Union[PathLike, str], urls: list[str], cache: Optional[DebugInfoCache], jobs=8) -> dict[str, Optional[Path]]:
+  debug_dir = Path(outdir) / ".debug"
+  res: dict[str, Optional[Path]] = {}
+  pending = []
+  for build_id in sorted(set(build_ids)):
+    dest = debug_dir / build_id_debug_path(build_id)
+    if _read_build_id(dest) == build_id:
+      res[build_id] = dest
+      continue
+    cached = cache.get(build_id) if cache is not None else None
+    if cached is not None:
+      _place(cached, dest)
+      res[build_id] = dest
+    elif cache is not None and cache.is_missing(build_id):
+      res[build_id] = None
+    else:
+      pending.append(build_id)
+
+  def fetch(build_id: str):
+    dest = debug_dir / build_id_debug_path(build_id)
+    if cache is not None:
+      tmp_dir = cache.tmp_dir()
+    else:
+      debug_dir.mkdir(parents=True, exist_ok=True)
+      tmp_dir = debug_dir
+    tmp_path = download_debuginfo(build_id, urls, tmp_dir)
+    if tmp_path is None:
+      if cache is not None:
+        cache.mark_missing(build_id)
+      return None
+    if cache is not None:
+      _place(cache.store(build_id, tmp_path), dest)
+    else:
+      dest.parent.mkdir(parents=True, exist_ok=True)
+      os.replace(tmp_path, dest)
+    return dest
+
+  if len(pending) != 0:
+    logger.info(f"fetching debug files of {len(pending)} libraries from {', '.join(urls)}...")
+    with ThreadPoolExecutor(max(1, min(jobs, len(pending)))) as executor:
+      res.update(zip(pending, executor.map(fetch, pending)))
+    if cache is not None:
+      cache.evict()
+  return res
@@ -0,0 +1,112 @@
+from bisect import bisect_left
+import mmap
+import os
+from pathlib import Path
+import struct
+from typing import Iterator, Optional, Protocol
+
+from preplib.logger import logger
+from preplib.timing import traced
+
+# digest_table.bin: header, then every distinct digest of the libs table in sorted order,
+# as NUL-padded hex of `width` bytes each, so that the n-th digest is at a fixed offset
+DIGEST_TABLE_MAGIC = b"PLDT"
+DIGEST_TABLE_VERSION = 1
+# magic, version, width, count, and the max rowid / row count of the libs table it was built from
+DIGEST_TABLE_HEADER = struct.Struct("<4sIIQQQ")
+
+# LibIndex
+class DigestSource(Protocol):
+  cache_dir: Path
+  def max_rowid(self) -> int: ...
+  def row_count(self) -> int: ...
+  def max_digest_length(self) -> int: ...
+  def iter_digests(self) -> Iterator[str]: ...
+
+class AmbiguousDigestError(ValueError):
+  def __init__(self, prefix: str, matches: list[str]):
+    super().__init__(f"{prefix} is ambiguous: {', '.join(matches)}")
+    self.prefix = prefix
+    self.matches = matches
+
+class DigestTable:
+  def __init__(self, path: Path):
+    self.path = path
+    with open(path, "rb") as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    magic, version, self.width, self.count, self.max_rowid, self.row_count = DIGEST_TABLE_HEADER.unpack_from(self._mmap, 0)
+    if magic != DIGEST_TABLE_MAGIC or version != DIGEST_TABLE_VERSION:
+      self._mmap.close()
+      raise ValueError(f"not a digest table: {path}")
+
+  @staticmethod
+  def get_path(index: DigestSource):
+    return index.cache_dir / "digest_table.bin"
+
+  @classmethod
+  @traced("index")
+  def build(cls, index: DigestSource):
+    path = cls.get_path(index)
+    max_rowid, row_count = index.max_rowid(), index.row_count()
+    width = max(index.max_digest_length(), 1)
+    count = 0
+    tmp_path = path.with_name(path.name + ".tmp")
+    # the index directory does not exist before anything is indexed
+    path.parent.mkdir(parents=True, exist_ok=True)
+    with open(tmp_path, "wb") as f:
+      f.write(DIGEST_TABLE_HEADER.pack(DIGEST_TABLE_MAGIC, DIGEST_TABLE_VERSION, width, 0, max_rowid, row_count))
+      for digest in index.iter_digests():
+        f.write(digest.encode().ljust(width, b"\0"))
+        count += 1
+      f.seek(0)
+      f.write(DIGEST_TABLE_HEADER.pack(DIGEST_TABLE_MAGIC, DIGEST_TABLE_VERSION, width, count, max_rowid, row_count))
+    os.replace(tmp_path, path)
+    logger.debug(f"built the digest table of {count} digests in {path}")
+    return cls(path)
+
+  # the table of the index, rebuilt if rows were added or removed since it was written
+  @classmethod
+  def open(cls, index: DigestSource):
+    path = cls.get_path(index)
+    if path.exists():
+      try:
+        table = cls(path)
+        if (table.max_rowid, table.row_count) == (index.max_rowid(), index.row_count()):
+          return table
+        table.close()
+      except ValueError as e:
+        logger.debug(f"rebuilding the digest table: {e}")
+    return cls.build(index)
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i: int) -> str:
+    if not 0 <= i < self.count:
+      raise IndexError(i)
+    offset = DIGEST_TABLE_HEADER.size + i * self.width
+    return self._mmap[offset:offset + self.width].rstrip(b"\0").decode()
+
+  def find_prefix(self, prefix: str, limit: Optional[int]=None) -> list[str]:
+    res = []
+    i = bisect_left(self, prefix)
+    while i < self.count and (limit is None or len(res) < limit):
+      digest = self[i]
+      if not digest.startswith(prefix): break
+      res.append(digest)
+      i += 1
+    return res
+
+  # the only digest that starts with `prefix`
+  @traced("index")
+  def resolve(self, prefix: str, report_limit=10) -> str:
+    prefix = prefix.lower()
+    matches = self.find_prefix(prefix, report_limit)
+    if len(matches) == 0:
+      raise ValueError(f"no indexed digest starts with {prefix}")
+    if len(matches) != 1:
+      raise AmbiguousDigestError(prefix, matches)
+    return matches[0]
+
+  def close(self):
+    self._mmap.close()
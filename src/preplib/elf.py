@@ -0,0 +1,296 @@
+from contextlib import contextmanager
+import hashlib
+import mmap
+from os import PathLike
+import struct
+from typing import Iterator, NamedTuple, Optional, Union
+
+# only the headers, notes and the dynamic section are parsed; see elf(5)
+
+EI_CLASS = 4
+EI_DATA = 5
+ELFCLASS32 = 1
+ELFCLASS64 = 2
+ELFDATA2LSB = 1
+ELFDATA2MSB = 2
+
+PT_LOAD = 1
+PT_DYNAMIC = 2
+PT_INTERP = 3
+PT_NOTE = 4
+
+SHT_NOTE = 7
+SHT_DYNSYM = 11
+
+STT_OBJECT = 1
+STT_FUNC = 2
+STT_GNU_IFUNC = 10
+
+DT_NULL = 0
+DT_NEEDED = 1
+DT_STRTAB = 5
+DT_SONAME = 14
+DT_RPATH = 15
+DT_RUNPATH = 29
+DT_VERNEED = 0x6ffffffe
+DT_VERNEEDNUM = 0x6fffffff
+
+NT_GNU_BUILD_ID = 3
+
+class ElfError(ValueError):
+  pass
+
+class ProgramHeader(NamedTuple):
+  type: int
+  offset: int
+  vaddr: int
+  filesz: int
+  memsz: int
+
+class SectionHeader(NamedTuple):
+  name: int
+  type: int
+  addr: int
+  offset: int
+  size: int
+  link: int
+
+class DynamicEntry(NamedTuple):
+  tag: int
+  value: int
+  # file offset of the entry itself
+  offset: int
+
+class ElfInfo(NamedTuple):
+  build_id: Optional[str]
+  interp: Optional[str]
+  soname: Optional[str]
+  needed: list[str]
+  rpath: Optional[str]
+  runpath: Optional[str]
+
+class ElfFile:
+  def __init__(self, data: Union[bytes, bytearray, memoryview, mmap.mmap]):
+    self.data = data
+    if len(data) < 16 or data[:4] != b"\x7fELF":
+      raise ElfError("not an ELF file")
+    if data[EI_CLASS] == ELFCLASS64:
+      self.is64 = True
+    elif data[EI_CLASS] == ELFCLASS32:
+      self.is64 = False
+    else:
+      raise ElfError(f"unknown ELF class: {data[EI_CLASS]}")
+    self.endian = ">" if data[EI_DATA] == ELFDATA2MSB else "<"
+    self.word = "Q" if self.is64 else "I"
+
+    # e_type .. e_shstrndx
+    ehdr_format = self.endian + ("HHIQQQIHHHHHH" if self.is64 else "HHIIIIIHHHHHH")
+    if len(data) < 16 + struct.calcsize(ehdr_format):
+      raise ElfError("truncated ELF header")
+    (_, self.machine, _, _, self.phoff, self.shoff, _, _,
+     self.phentsize, self.phnum, self.shentsize, self.shnum, _) = struct.unpack_from(ehdr_format, data, 16)
+
+  @classmethod
+  @contextmanager
+  def open(cls, path: Union[PathLike, str], writable=False):
+    with open(path, "r+b" if writable else "rb") as f:
+      with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ) as m:
+        yield cls(m)
+
+  def _unpack(self, fmt: str, offset: int):
+    fmt = self.endian + fmt
+    if offset < 0 or len(self.data) < offset + struct.calcsize(fmt):
+      raise ElfError(f"out of bounds read at {offset:#x}")
+    return struct.unpack_from(fmt, self.data, offset)
+
+  def program_headers(self) -> Iterator[ProgramHeader]:
+    for i in range(self.phnum):
+      offset = self.phoff + i * self.phentsize
+      if self.is64:
+        p_type, _, p_offset, p_vaddr, _, p_filesz, p_memsz, _ = self._unpack("IIQQQQQQ", offset)
+      else:
+        p_type, p_offset, p_vaddr, _, p_filesz, p_memsz, _, _ = self._unpack("IIIIIIII", offset)
+      yield ProgramHeader(p_type, p_offset, p_vaddr, p_filesz, p_memsz)
+
+  def section_headers(self) -> Iterator[SectionHeader]:
+    for i in range(self.shnum if self.shoff else 0):
+      offset = self.shoff + i * self.shentsize
+      if self.is64:
+        sh_name, sh_type, _, sh_addr, sh_offset, sh_size, sh_link, _, _, _ = self._unpack("IIQQQQIIQQ", offset)
+      else:
+        sh_name, sh_type, _, sh_addr, sh_offset, sh_size, sh_link, _, _, _ = self._unpack("IIIIIIIIII", offset)
+      yield SectionHeader(sh_name, sh_type, sh_addr, sh_offset, sh_size, sh_link)
+
+  def vaddr_to_offset(self, vaddr: int) -> Optional[int]:
+    for ph in self.program_headers():
+      if ph.type == PT_LOAD and ph.vaddr <= vaddr < ph.vaddr + ph.filesz:
+        return vaddr - ph.vaddr + ph.offset
+    return None
+
+  def read_cstring(self, offset: int) -> bytes:
+    end = self.data.find(b"\0", offset)
+    if offset < 0 or end < 0:
+      raise ElfError(f"unterminated string at {offset:#x}")
+    return bytes(self.data[offset:end])
+
+  def _notes(self, offset: int, size: int):
+    end = min(offset + size, len(self.data))
+    while offset + 12 <= end:
+      namesz, descsz, note_type = self._unpack("III", offset)
+      name_offset = offset + 12
+      desc_offset = name_offset + ((namesz + 3) & ~3)
+      next_offset = desc_offset + ((descsz + 3) & ~3)
+      if end < next_offset: break
+      yield bytes(self.data[name_offset:name_offset + namesz]).rstrip(b"\0"), note_type, bytes(self.data[desc_offset:desc_offset + descsz])
+      offset = next_offset
+
+  def build_id(self) -> Optional[str]:
+    # same lookup order as scripts/scan: note sections, then PT_NOTE for stripped section headers
+    note_ranges = [(sh.offset, sh.size) for sh in self.section_headers() if sh.type == SHT_NOTE]
+    note_ranges += [(ph.offset, ph.filesz) for ph in self.program_headers() if ph.type == PT_NOTE]
+    for offset, size in note_ranges:
+      for name, note_type, desc in self._notes(offset, size):
+        if name == b"GNU" and note_type == NT_GNU_BUILD_ID:
+          return desc.hex()
+    return None
+
+  def interp_segment(self) -> Optional[ProgramHeader]:
+    return next((ph for ph in self.program_headers() if ph.type == PT_INTERP), None)
+
+  def interp(self) -> Optional[str]:
+    ph = self.interp_segment()
+    if ph is None:
+      return None
+    return bytes(self.data[ph.offset:ph.offset + ph.filesz]).split(b"\0")[0].decode(errors="surrogateescape")
+
+  def dynamic_entries(self) -> list[DynamicEntry]:
+    ph = next((ph for ph in self.program_headers() if ph.type == PT_DYNAMIC), None)
+    if ph is None:
+      return []
+    entry_format = "qQ" if self.is64 else "iI"
+    entry_size = struct.calcsize(entry_format)
+    res = []
+    for offset in range(ph.offset, ph.offset + ph.filesz - entry_size + 1, entry_size):
+      tag, value = self._unpack(entry_format, offset)
+      if tag == DT_NULL: break
+      res.append(DynamicEntry(tag, value, offset))
+    return res
+
+  def dynamic_strtab_offset(self, entries: Optional[list[DynamicEntry]]=None) -> Optional[int]:
+    if entries is None:
+      entries = self.dynamic_entries()
+    strtab = next((e.value for e in entries if e.tag == DT_STRTAB), None)
+    if strtab is None:
+      return None
+    return self.vaddr_to_offset(strtab)
+
+  def dynamic_string(self, entry: DynamicEntry, strtab_offset: int) -> str:
+    return self.read_cstring(strtab_offset + entry.value).decode(errors="surrogateescape")
+
+  # (name, st_value) of the defined functions and objects in .dynsym, like scripts/scan reports them
+  def dynamic_symbols(self) -> list[tuple[str, int]]:
+    sections = list(self.section_headers())
+    dynsym = next((sh for sh in sections if sh.type == SHT_DYNSYM), None)
+    if dynsym is None or len(sections) <= dynsym.link:
+      return []
+    strtab = sections[dynsym.link]
+    # Elf64_Sym: name, info, other, shndx, value, size / Elf32_Sym: name, value, size, info, other, shndx
+    entry_format = "IBBHQQ" if self.is64 else "IIIBBH"
+    entry_size = struct.calcsize(self.endian + entry_format)
+    res = []
+    for offset in range(dynsym.offset, dynsym.offset + dynsym.size - entry_size + 1, entry_size):
+      if self.is64:
+        name, info, _, shndx, value, _ = self._unpack(entry_format, offset)
+      else:
+        name, value, _, info, _, shndx = self._unpack(entry_format, offset)
+      if shndx == 0 or name == 0 or strtab.size <= name: continue
+      if info & 0xf not in (STT_FUNC, STT_OBJECT, STT_GNU_IFUNC): continue
+      res.append((self.read_cstring(strtab.offset + name).decode(errors="surrogateescape"), value))
+    return res
+
+  def info(self) -> ElfInfo:
+    entries = self.dynamic_entries()
+    strtab_offset = self.dynamic_strtab_offset(entries)
+    soname, rpath, runpath = None, None, None
+    needed = []
+    if strtab_offset is not None:
+      for entry in entries:
+        if entry.tag == DT_NEEDED:
+          needed.append(self.dynamic_string(entry, strtab_offset))
+        elif entry.tag == DT_SONAME:
+          soname = self.dynamic_string(entry, strtab_offset)
+        elif entry.tag == DT_RPATH:
+          rpath = self.dynamic_string(entry, strtab_offset)
+        elif entry.tag == DT_RUNPATH:
+          runpath = self.dynamic_string(entry, strtab_offset)
+    return ElfInfo(self.build_id(), self.interp(), soname, needed, rpath, runpath)
+
+  # offsets into the dynamic string table that something refers to, or None if they can not all be found
+  # (.dynsym is only found through the section headers)
+  def dynamic_string_refs(self, entries: list[DynamicEntry]) -> Optional[list[int]]:
+    refs = [e.value for e in entries if e.tag in (DT_NEEDED, DT_SONAME, DT_RPATH, DT_RUNPATH)]
+    sections = list(self.section_headers())
+    dynsym = next((sh for sh in sections if sh.type == SHT_DYNSYM), None)
+    if dynsym is None:
+      return None
+    entry_size = 24 if self.is64 else 16
+    for offset in range(dynsym.offset, dynsym.offset + dynsym.size - entry_size + 1, entry_size):
+      refs.append(self._unpack("I", offset)[0])
+    verneed = next((e.value for e in entries if e.tag == DT_VERNEED), None)
+    verneed_count = next((e.value for e in entries if e.tag == DT_VERNEEDNUM), 0)
+    offset = self.vaddr_to_offset(verneed) if verneed is not None else None
+    for _ in range(verneed_count if offset is not None else 0):
+      # Elf_Verneed: version, cnt, file, aux, next / Elf_Vernaux: hash, flags, other, name, next
+      _, aux_count, file, aux, next_offset = self._unpack("HHIII", offset)
+      refs.append(file)
+      aux_offset = offset + aux
+      for _ in range(aux_count):
+        _, _, _, name, aux_next = self._unpack("IHHII", aux_offset)
+        refs.append(name)
+        aux_offset += aux_next
+      offset += next_offset
+    return refs
+
+  # the (offset, bytes) writes that set PT_INTERP in place, or None if the new path does not fit in the segment
+  def interp_patch(self, interp: str) -> Optional[list[tuple[int, bytes]]]:
+    ph = self.interp_segment()
+    new = interp.encode(errors="surrogateescape")
+    if ph is None or ph.filesz < len(new) + 1:
+      return None
+    return [(ph.offset, new.ljust(ph.filesz, b"\0"))]
+
+  # the writes that set DT_RUNPATH in place like `patchelf --set-rpath` (which also turns DT_RPATH into DT_RUNPATH),
+  # or None if it needs a longer string than the old one. other strings may be tail-merged into the old one,
+  # so it is only overwritten when nothing else points into it
+  def runpath_patch(self, runpath: str) -> Optional[list[tuple[int, bytes]]]:
+    entries = self.dynamic_entries()
+    strtab_offset = self.dynamic_strtab_offset(entries)
+    entry = next((e for e in entries if e.tag == DT_RUNPATH), None) or next((e for e in entries if e.tag == DT_RPATH), None)
+    if strtab_offset is None or entry is None:
+      return None
+    old = self.read_cstring(strtab_offset + entry.value)
+    new = runpath.encode(errors="surrogateescape")
+    if len(old) < len(new):
+      return None
+    refs = self.dynamic_string_refs([e for e in entries if e.offset != entry.offset])
+    if refs is None or any(entry.value <= ref <= entry.value + len(old) for ref in refs):
+      return None
+    writes = [(strtab_offset + entry.value, new.ljust(len(old) + 1, b"\0"))]
+    if entry.tag == DT_RPATH:
+      writes.append((entry.offset, struct.pack(self.endian + ("q" if self.is64 else "i"), DT_RUNPATH)))
+    return writes
+
+  def write(self, writes: list[tuple[int, bytes]]):
+    for offset, data in writes:
+      self.data[offset:offset + len(data)] = data
+
+def read_elf_info(path: Union[PathLike, str]) -> ElfInfo:
+  with ElfFile.open(path) as elf:
+    return elf.info()
+
+def file_digest(path: Union[PathLike, str], hash_type="md5", chunk_size=1 << 20) -> str:
+  h = hashlib.new(hash_type)
+  with open(path, "rb") as f:
+    while chunk := f.read(chunk_size):
+      h.update(chunk)
+  return h.hexdigest()
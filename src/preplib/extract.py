@@ -1,14 +1,54 @@
 
+from functools import wraps
+import os
 from os import PathLike
 from pathlib import Path
-from typing import Optional, Union
+import shutil
+import subprocess
+import tarfile
+import tempfile
+from subprocess import CalledProcessError
+from typing import Callable, NamedTuple, Optional, Tuple, Union
 
-from preplib.utils import MountOption, get_script_path, run_docker
+from preplib.elf import file_digest
+from preplib.logger import logger
+from preplib.metacache import get_metadata_cache
+from preplib.timing import check_output, span
+from preplib.utils import MountOption, docker_command, get_container_session, get_script_path, parse_image_name, run_docker
 
+# the results only depend on the image digest (and the key, e.g. the hash of the binary),
+# so they are kept in the metadata cache across runs
+def cached_by_image(kind: str, key: Callable[..., str]=lambda *args: ""):
+  def decorator(fn):
+    @wraps(fn)
+    def wrapper(image_name: str, *args):
+      cache = get_metadata_cache()
+      if cache is None:
+        return fn(image_name, *args)
+      cache_key = key(*args)
+      try:
+        _, _, image_digest = parse_image_name(image_name)
+      except CalledProcessError:
+        # not pulled yet. `docker run` pulls it, and then the digest is known
+        image_digest = None
+      if image_digest is not None:
+        res = cache.get(image_digest, kind, cache_key)
+        if res is not None:
+          logger.debug(f"{kind} of {image_name} is cached")
+          return res
+      res = fn(image_name, *args)
+      if image_digest is None:
+        _, _, image_digest = parse_image_name(image_name)
+      cache.put(image_digest, kind, cache_key, res)
+      return res
+    return wrapper
+  return decorator
+
+@cached_by_image("musl_libraries")
 def list_musl_libraries(image_name: str):
   lib_paths: list[str] = []
   for path in ["/lib", "/usr/lib"]:
-    output = run_docker(image_name, "ls", "-la", path).decode()
+    output = run_docker(image_name, "ls", "-la", path, label="ls").decode()
     for line in output.splitlines():
       # extract like like -rwxr-xr-x
       if not line.startswith("-r"): continue
@@ -18,9 +58,10 @@ def list_musl_libraries(image_name: str):
         lib_paths.append(f"{path}/{name}")
   return lib_paths
 
+@cached_by_image("libraries")
 def list_libraries(image_name: str):
   try:
-    output = run_docker(image_name, "sh", "-c", "ldconfig; ldconfig -p").decode()
+    output = run_docker(image_name, "sh", "-c", "ldconfig; ldconfig -p", label="ldconfig").decode()
   except:
     return list_musl_libraries(image_name)
 
@@ -32,22 +73,92 @@ def list_libraries(image_name: str):
     lib_paths.append(path.strip().split()[0])
   return lib_paths
 
+class LibRecord(NamedTuple):
+  path: str
+  digests: dict[str, str]
+  size: Optional[int] = None
+  # <ELF class>-<e_machine>, e.g. 64-62 for x86-64
+  arch: Optional[str] = None
+  soname: Optional[str] = None
+  needed: Optional[list[str]] = None
+  rpath: Optional[str] = None
+  runpath: Optional[str] = None
+  # (name, st_value) of .dynsym, with the symbols type. only the first path of each file has them
+  symbols: Optional[list[Tuple[str, int]]] = None
+
+# list the libraries by ldconfig (or /lib and /usr/lib for musl) and hash all of them in one container.
+# "$0" is the scanner, "$1" is the comma-separated hash types and "$2" is the symbols to report (empty for all)
+SCAN_LIBRARIES_SCRIPT = """
+ldconfig > /dev/null 2>&1
+if out=$(ldconfig -p 2> /dev/null) && [ -n "$out" ]; then
+  printf '%s\\n' "$out" | "$0" -t "$1" -y "$2" -
+else
+  "$0" -t "$1" -y "$2" /lib /usr/lib
+fi
+"""
+
+def parse_scan_output(output: str):
+  res: list[LibRecord] = []
+  for l in output.splitlines():
+    if l.startswith("sym\t"):
+      # sym\t<hex value>\t<name>, following the record of the file
+      _, value, name = l.split("\t", 2)
+      if len(res) != 0:
+        symbols = res[-1].symbols
+        if symbols is None:
+          symbols = []
+          res[-1] = res[-1]._replace(symbols=symbols)
+        symbols.append((name, int(value, 16)))
+      continue
+    # <type>=<hex>\t...\tsize=<bytes>\tarch=..\tsoname=..\tneeded=<a>,<b>\trpath=..\trunpath=..\t<path>
+    fields = l.split("\t")
+    if len(fields) < 2: continue
+    digests = {}
+    for field in fields[:-1]:
+      hash_type, _, digest = field.partition("=")
+      digests[hash_type] = digest
+    size = digests.pop("size", None)
+    needed = digests.pop("needed", None)
+    res.append(LibRecord(
+      fields[-1], digests,
+      size=int(size) if size is not None else None,
+      arch=digests.pop("arch", None),
+      soname=digests.pop("soname", None),
+      needed=needed.split(",") if needed else ([] if needed is not None else None),
+      rpath=digests.pop("rpath", None),
+      runpath=digests.pop("runpath", None),
+    ))
+  return res
+
+def scan_libraries(image_name: str, hash_types: list[str]=["build-id", "md5"], symbol_names: Optional[list[str]]=None):
+  output = run_docker(
+    image_name,
+    "sh", "-c", SCAN_LIBRARIES_SCRIPT, get_script_path("scan"), ",".join(hash_types), ",".join(symbol_names or []),
+    mount_scripts=True, label="scan"
+  ).decode()
+  return parse_scan_output(output)
+
+# ldd runs the binary at /target, so $ORIGIN of the binary is "/"
+BINARY_PATH_IN_IMAGE = "/target"
+
+# what find_libraries mounts for the binary. a container_session with these serves its ldd too
+def binary_mounts(binary_path: Optional[Union[PathLike, str]]) -> list[MountOption]:
+  if binary_path is None:
+    return []
+  return [MountOption(Path(binary_path).absolute(), BINARY_PATH_IN_IMAGE)]
+
+@cached_by_image("ldd", key=lambda binary_path: file_digest(binary_path, "md5") if binary_path is not None else "default")
 def find_libraries(image_name: str, binary_path: Optional[Union[PathLike, str]]):
-  mounts = []
-  bin_name = None
-  if binary_path is not None:
-    target_path = Path(binary_path).absolute()
-    bin_name = "/target"
-    mounts.append(MountOption(target_path, bin_name))
-  else:
-    bin_name = "/bin/cat"
+  mounts = binary_mounts(binary_path)
+  bin_name = BINARY_PATH_IN_IMAGE if binary_path is not None else "/bin/cat"
 
   output = run_docker(
     image_name,
     get_script_path("ldd"),
     bin_name,
     mounts=mounts,
-    mount_scripts=True
+    mount_scripts=True,
+    label="ldd"
   ).decode()
 
   lib_paths: list[str] = []
@@ -60,3 +171,71 @@ def find_libraries(image_name: str, binary_path: Optional[Union[PathLike, str]])
     lib_paths.append(line.split(" => ", 1)[1].strip().split(" (")[0])
   return lib_paths
 
+
+def _copy_libraries_by_docker_cp(image_name: str, lib_paths: list[str], outdir: Path):
+  # the running container of the session can be copied from as well
+  session = get_container_session(image_name)
+  if session is not None and session.container_id is not None:
+    container_id, created = session.container_id, False
+  else:
+    container_id, created = check_output(["docker", "create", image_name], label="docker create").strip().decode(), True
+    logger.debug(f"created. {container_id=}")
+  try:
+    for lib_path in lib_paths:
+      logger.debug(f"cp {container_id}:{lib_path} -> {outdir}")
+      with span("subprocess", "docker cp", command=f"docker cp -L {container_id}:{lib_path} {outdir}") as span_args:
+        subprocess.check_output(["docker", "cp", "-L", f"{container_id}:{lib_path}", str(outdir)])
+        copied = outdir / Path(lib_path).name
+        span_args["bytes_read"] = copied.stat().st_size if copied.exists() else 0
+  finally:
+    if created:
+      with span("subprocess", "docker rm", command=f"docker rm -f {container_id}"):
+        subprocess.run(["docker", "rm", "-f", container_id], stdout=subprocess.DEVNULL)
+
+# copy the libraries into outdir by their file names, like `docker cp -L` does
+def extract_libraries(image_name: str, lib_paths: list[str], outdir: Union[PathLike, str]):
+  outdir = Path(outdir)
+  outdir.mkdir(parents=True, exist_ok=True)
+
+  # every file comes out of one container in a single tar stream. -h stores the symlink targets as files
+  command, how = docker_command(image_name, "tar", "-ch", "-f", "-", *lib_paths)
+  logger.debug(f"{command=}")
+  extracted: dict[str, Path] = {}
+  # stderr goes into a file. a pipe that is only read at the end fills up and blocks tar when it reports many errors
+  with span("subprocess", f"docker {how} tar", command=" ".join(command)[:1000]) as span_args, \
+       tempfile.TemporaryFile() as stderr_file, \
+       subprocess.Popen(command, stdout=subprocess.PIPE, stderr=stderr_file) as proc:
+    assert proc.stdout is not None
+    bytes_written = 0
+    try:
+      with tarfile.open(fileobj=proc.stdout, mode="r|") as tar:
+        for member in tar:
+          target = outdir / Path(member.name).name
+          if member.isfile():
+            src = tar.extractfile(member)
+            assert src is not None
+            with src, open(target, "wb") as dst:
+              shutil.copyfileobj(src, dst)
+            bytes_written += member.size
+          elif member.islnk() and member.linkname in extracted:
+            # a path referring to the file already in the stream (e.g. libc.so.6 and libc-2.31.so)
+            if extracted[member.linkname] != target:
+              shutil.copyfile(extracted[member.linkname], target)
+              bytes_written += target.stat().st_size
+          else:
+            continue
+          os.chmod(target, member.mode)
+          extracted[member.name] = target
+    except tarfile.TarError as e:
+      logger.debug(f"broken tar stream: {e}")
+    proc.communicate()
+    stderr_file.seek(0)
+    stderr = stderr_file.read()
+    # the file contents. the headers and the padding of the tar stream are not counted
+    span_args.update(bytes_read=bytes_written, bytes_written=bytes_written)
+
+  missing = [lib_path for lib_path in lib_paths if lib_path.lstrip("/") not in extracted]
+  if proc.returncode != 0 or len(missing):
+    # images without tar (or with a tar that can not dereference) fall back to copying one by one
+    logger.debug(f"tar extraction failed ({proc.returncode=}, {missing=}): {stderr.decode(errors='replace')}")
+    _copy_libraries_by_docker_cp(image_name, missing, outdir)
@@ -1,13 +1,30 @@
 from ast import literal_eval
+from contextlib import contextmanager
+import fcntl
+from fnmatch import fnmatch
 import json
+import os
 from os import PathLike
 from pathlib import Path
-from typing import NamedTuple, Optional, Tuple, Union
+import shutil
+import sqlite3
+from subprocess import CalledProcessError
+from itertools import groupby, islice
+import threading
+import zlib
+from typing import TYPE_CHECKING, Iterable, Iterator, NamedTuple, Optional, Protocol, Tuple, Union
 import appdirs
 
-from preplib.extract import list_libraries
-from preplib.utils import get_script_path, parse_image_name, run_docker
+from preplib.digests import DigestTable
+from preplib.extract import LibRecord, scan_libraries
+from preplib.utils import is_digest_like, is_digest_prefix_like, parse_image_name
 from preplib.logger import logger
+from preplib.snapshot import Snapshot
+from preplib.timing import traced
+
+# preplib.layers pulls in tarfile and the http client, so it is only imported when layers are read
+if TYPE_CHECKING:
+  from preplib.layers import LayerEntry
 
 class LibInfo(NamedTuple):
   image_name: str
@@ -17,129 +34,697 @@ class LibInfo(NamedTuple):
   def image_identifier(self):
     return f"{self.image_name}@{self.image_digest}"
 
-class LibDigest(NamedTuple):
+# one library of an image, as recorded at index time
+class ManifestEntry(NamedTuple):
   path: str
-  digest: str
-
-def hash_parser(output: str):
-  res: list[LibDigest] = []
-  for l in output.strip().splitlines():
-    s = l.strip().split()
-    if len(s) < 2:
-      continue
-    res.append(LibDigest(s[1], s[0]))
-  return res
+  soname: Optional[str]
+  build_id: Optional[str]
+  md5: Optional[str]
+  size: Optional[int]
+  arch: Optional[str] = None
+  # None if unknown (indexed by an older scanner)
+  needed: Optional[list[str]] = None
+  rpath: Optional[str] = None
+  runpath: Optional[str] = None
+
+MANIFEST_COLUMNS = ["path", "soname", "build_id", "md5", "size", "arch", "needed", "rpath", "runpath"]
 
-index_commands = {
-  "build-id": ([get_script_path("build-id")], hash_parser, True),
-  "md5": (["md5sum"], hash_parser, False),
-  "sha1": (["sha1sum"], hash_parser, False),
-  "sha256": (["sha256sum"], hash_parser, False),
-  "sha512": (["sha512sum"], hash_parser, False),
-}
+def _manifest_row(entry: ManifestEntry):
+  return (*entry[:6], ",".join(entry.needed) if entry.needed is not None else None, *entry[7:])
+
+def _manifest_entry(row: Tuple):
+  needed = row[6]
+  return ManifestEntry(*row[:6], needed.split(",") if needed else ([] if needed is not None else None), *row[7:])
 
 default_cache_dir = Path(appdirs.user_cache_dir("extract-lib"))
+# the published index (shards and deltas)
+LIBDIGESTINFO_SERVER = "https://key-moon.github.io/preplib-data"
+
+# legacy layout: one file per digest under cache/, each line should be: <image@image-digest> <path>
+def parse_legacy_cache(text: str) -> list[LibInfo]:
+  res = []
+  for l in text.splitlines():
+    splitted = l.strip().split(" ", maxsplit=1)
+    if len(splitted) < 2: continue # TODO: report error?
+    image, path = splitted[0], splitted[1]
+    splitted = image.split("@", maxsplit=1)
+    if len(splitted) < 2: continue # TODO: report error?
+    name, digest = splitted[0], splitted[1]
+    res.append(LibInfo(name, digest, str(literal_eval(path))))
+  return res
+
+LIB_INDEX_SCHEMA = """
+CREATE TABLE IF NOT EXISTS libs (
+  digest TEXT NOT NULL,
+  image_name TEXT NOT NULL,
+  image_digest TEXT NOT NULL,
+  path TEXT NOT NULL,
+  UNIQUE (digest, image_name, image_digest, path)
+);
+CREATE TABLE IF NOT EXISTS manifests (
+  image_digest TEXT NOT NULL,
+  path TEXT NOT NULL,
+  soname TEXT,
+  build_id TEXT,
+  md5 TEXT,
+  size INTEGER,
+  arch TEXT,
+  needed TEXT,
+  rpath TEXT,
+  runpath TEXT,
+  PRIMARY KEY (image_digest, path)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS symbols (
+  name TEXT NOT NULL,
+  low12 INTEGER NOT NULL,
+  md5 TEXT NOT NULL,
+  offset INTEGER NOT NULL,
+  PRIMARY KEY (name, low12, md5, offset)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS layers (
+  layer_digest TEXT PRIMARY KEY,
+  options TEXT NOT NULL,
+  entries BLOB NOT NULL
+) WITHOUT ROWID;
+"""
+
+# symbols are recorded for the libraries whose file name or soname matches these, unless specified.
+# leaked addresses almost always point into libc
+default_symbol_libraries = ["libc.so*", "libc-*.so", "libc.musl*", "ld-musl*"]
 
-# each line should be: <image@image-digest> <path>
+# columns added after the table was first created
+MANIFEST_ADDED_COLUMNS = ["arch", "needed", "rpath", "runpath"]
 
+# a published index may have only snapshot.bin (see preplib.snapshot) or the legacy cache/ layout. they are read
+# while there is no sqlite file, and become the content of the sqlite file when something is written
 class LibIndex:
   def __init__(self, cache_dir: Union[PathLike, str]):
     self.cache_dir = Path(cache_dir)
+    # sqlite connections must not be shared between threads
+    self._local = threading.local()
+    self._snapshot: Optional[Snapshot] = None
+    self._snapshot_checked = False
+    self._legacy_seeded = 0
+
+  def _get_db_path(self):
+    return self.cache_dir / "lib_index.sqlite3"
+
+  def _get_legacy_dir(self):
+    return self.cache_dir / "cache"
 
-  def _get_cache_path(self, digest: str):
-    return self.cache_dir / "cache" / digest
+  def _get_legacy_cache_path(self, digest: str):
+    return self._get_legacy_dir() / digest
 
+  def _connect(self) -> sqlite3.Connection:
+    conn = getattr(self._local, "conn", None)
+    if conn is not None:
+      return conn
+    db_path = self._get_db_path()
+    db_path.parent.mkdir(parents=True, exist_ok=True)
+    created = not db_path.exists()
+    seed = self.snapshot() if created else None
+    # isolation_level=None: transactions are handled explicitly by `_transaction`
+    conn = sqlite3.connect(db_path, timeout=60, isolation_level=None)
+    # WAL allows readers to proceed while another process is writing
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.executescript(LIB_INDEX_SCHEMA)
+    columns = [row[1] for row in conn.execute("PRAGMA table_info(manifests)")]
+    for column in MANIFEST_ADDED_COLUMNS:
+      if column not in columns:
+        conn.execute(f"ALTER TABLE manifests ADD COLUMN {column} TEXT")
+    self._local.conn = conn
+    if seed is not None:
+      logger.info(f"copying {seed.path} into {db_path}...")
+      self.add_many((digest, LibInfo(*info)) for digest, info in seed.iter_all())
+    # the legacy layout fills in what the snapshot is missing
+    if created and self._get_legacy_dir().is_dir():
+      self._legacy_seeded = self.add_legacy_cache()
+    return conn
+
+  @contextmanager
+  def _transaction(self):
+    conn = self._connect()
+    # take the write lock up front so concurrent writers wait on busy timeout instead of failing on upgrade
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+      yield conn
+    except:
+      conn.execute("ROLLBACK")
+      raise
+    conn.execute("COMMIT")
+
+  def exists(self):
+    return self._get_db_path().exists()
+
+  def snapshot(self) -> Optional[Snapshot]:
+    if not self._snapshot_checked:
+      self._snapshot = Snapshot.open(self.cache_dir)
+      self._snapshot_checked = True
+    return self._snapshot
+
+  @traced("index")
   def load(self, digest: str) -> list[LibInfo]:
-    cache_path = self._get_cache_path(digest)
-    if not cache_path.exists(): return []
-    res = []
-    for l in cache_path.read_text().splitlines():
-      splitted = l.strip().split(" ", maxsplit=1)
-      if len(splitted) < 2: continue # TODO: report error?
-      image, path = splitted[0], splitted[1]
-      splitted = image.split("@", maxsplit=1)
-      if len(splitted) < 2: continue # TODO: report error?
-      name, digest = splitted[0], splitted[1]
-      res.append(LibInfo(name, digest, str(literal_eval(path))))
+    if not self.exists():
+      snapshot = self.snapshot()
+      if snapshot is not None:
+        return [LibInfo(*info) for info in snapshot.load(digest)]
+      legacy_path = self._get_legacy_cache_path(digest)
+      if legacy_path.exists():
+        logger.warning(f"reading legacy index layout in {self.cache_dir}. run `preplib --migrate-index` to convert it")
+        return parse_legacy_cache(legacy_path.read_text())
+      return []
+    rows = self._connect().execute(
+      "SELECT image_name, image_digest, path FROM libs WHERE digest = ? ORDER BY rowid",
+      (digest,)
+    )
+    return [LibInfo(*row) for row in rows]
+
+  @traced("index")
+  def load_many(self, digests: list[str]) -> dict[str, list[LibInfo]]:
+    res: dict[str, list[LibInfo]] = { digest: [] for digest in digests }
+    if not self.exists():
+      for digest in digests:
+        res[digest] = self.load(digest)
+      return res
+    unique_digests = list(set(digests))
+    # keep the number of bound parameters below SQLITE_MAX_VARIABLE_NUMBER
+    for i in range(0, len(unique_digests), 500):
+      chunk = unique_digests[i:i + 500]
+      rows = self._connect().execute(
+        f"SELECT digest, image_name, image_digest, path FROM libs WHERE digest IN ({', '.join('?' * len(chunk))}) ORDER BY rowid",
+        chunk
+      )
+      for digest, *info in rows:
+        res[digest].append(LibInfo(*info))
     return res
 
+  # rows inserted after `rowid`, with their rowids. rows are never updated in place, so this is enough to follow additions
+  @traced("index")
+  def rows_after(self, rowid: int) -> list[Tuple[int, str, LibInfo]]:
+    if not self.exists():
+      # the rows of the snapshot are numbered in its order
+      snapshot = self.snapshot()
+      if snapshot is None: return []
+      return [(row_id, digest, LibInfo(*info)) for row_id, (digest, info) in enumerate(islice(snapshot.iter_all(), rowid, None), rowid + 1)]
+    rows = self._connect().execute("SELECT rowid, digest, image_name, image_digest, path FROM libs WHERE rowid > ? ORDER BY rowid", (rowid,))
+    return [(row_id, digest, LibInfo(*info)) for row_id, digest, *info in rows]
+
+  def row_count(self) -> int:
+    if not self.exists():
+      snapshot = self.snapshot()
+      return snapshot.posting_count if snapshot is not None else 0
+    return self._connect().execute("SELECT COUNT(*) FROM libs").fetchone()[0]
+
+  def max_rowid(self) -> int:
+    if not self.exists():
+      snapshot = self.snapshot()
+      return snapshot.posting_count if snapshot is not None else 0
+    return self._connect().execute("SELECT COALESCE(MAX(rowid), 0) FROM libs").fetchone()[0]
+
+  def max_digest_length(self) -> int:
+    if not self.exists():
+      snapshot = self.snapshot()
+      return snapshot.width if snapshot is not None else max(map(len, self._legacy_digests()), default=0)
+    return self._connect().execute("SELECT COALESCE(MAX(LENGTH(digest)), 0) FROM libs").fetchone()[0]
+
+  # the file names of the legacy layout, which is read while there is neither a database nor a snapshot
+  def _legacy_digests(self) -> list[str]:
+    legacy_dir = self._get_legacy_dir()
+    if not legacy_dir.is_dir(): return []
+    return sorted(path.name for path in legacy_dir.iterdir() if path.is_file())
+
+  # distinct digests in sorted order, read off the (digest, ...) unique index
+  def iter_digests(self) -> Iterator[str]:
+    if not self.exists():
+      snapshot = self.snapshot()
+      if snapshot is not None:
+        yield from snapshot.iter_digests()
+      else:
+        yield from self._legacy_digests()
+      return
+    for digest, in self._connect().execute("SELECT DISTINCT digest FROM libs ORDER BY digest"):
+      yield digest
+
+  # changes whenever another connection commits to the database
+  def data_version(self) -> int:
+    if not self.exists(): return 0
+    return self._connect().execute("PRAGMA data_version").fetchone()[0]
+
+  def iter_all(self) -> Iterator[Tuple[str, LibInfo]]:
+    if not self.exists():
+      snapshot = self.snapshot()
+      if snapshot is not None:
+        for digest, info in snapshot.iter_all():
+          yield digest, LibInfo(*info)
+      return
+    for digest, *info in self._connect().execute("SELECT digest, image_name, image_digest, path FROM libs ORDER BY digest, rowid"):
+      yield digest, LibInfo(*info)
+
+  # the libraries of the image. empty if the image is not indexed (or was indexed before manifests were recorded)
+  @traced("index")
+  def load_manifest(self, image_digest: str) -> list[ManifestEntry]:
+    if not self.exists(): return []
+    rows = self._connect().execute(
+      f"SELECT {', '.join(MANIFEST_COLUMNS)} FROM manifests WHERE image_digest = ? ORDER BY path",
+      (image_digest,)
+    )
+    return [_manifest_entry(row) for row in rows]
+
+  # (md5, offset) of the libraries that define `name` at an offset ending with `low12`.
+  # the primary key is (name, low12, ...), so this is a binary search on the table
+  @traced("index")
+  def find_symbol(self, name: str, low12: int) -> list[Tuple[str, int]]:
+    if not self.exists(): return []
+    rows = self._connect().execute("SELECT md5, offset FROM symbols WHERE name = ? AND low12 = ?", (name, low12))
+    return [(md5, offset) for md5, offset in rows]
+
+  # the symbols of the libraries with these md5s, as (name, offset, md5) like add_many takes them.
+  # md5 is not a prefix of the primary key, so the table is read once
+  @traced("index")
+  def load_symbols(self, md5s: set[str]) -> list[Tuple[str, int, str]]:
+    if not self.exists() or len(md5s) == 0: return []
+    rows = self._connect().execute("SELECT name, offset, md5 FROM symbols")
+    return [(name, offset, md5) for name, offset, md5 in rows if md5 in md5s]
+
+  @traced("index")
   def dump(self, digest: str, info: list[LibInfo]):
-    cache_path = self._get_cache_path(digest)
-    cache_path.parent.mkdir(parents=True, exist_ok=True)
-    cache_path.write_text("\n".join([f"{i.image_name}@{i.image_digest} {repr(i.path)}" for i in info]))
+    with self._transaction() as conn:
+      conn.execute("DELETE FROM libs WHERE digest = ?", (digest,))
+      conn.executemany(
+        "INSERT OR IGNORE INTO libs (digest, image_name, image_digest, path) VALUES (?, ?, ?, ?)",
+        [(digest, *i) for i in info]
+      )
 
   def add(self, digest: str, new_info: LibInfo):
-    caches = self.load(digest)
-    if any(cache == new_info for cache in caches):
-      return
-    caches.append(new_info)
-    self.dump(digest, caches)
+    self.add_many([(digest, new_info)])
+
+  # manifests are (image digest, entry) pairs and symbols are (name, offset, md5 of the library),
+  # written in the same transaction as the digests
+  @traced("index")
+  def add_many(self, entries: Iterable[Tuple[str, LibInfo]], manifests: Iterable[Tuple[str, ManifestEntry]]=(), symbols: Iterable[Tuple[str, int, str]]=()):
+    with self._transaction() as conn:
+      conn.executemany(
+        "INSERT OR IGNORE INTO libs (digest, image_name, image_digest, path) VALUES (?, ?, ?, ?)",
+        ((digest, *info) for digest, info in entries)
+      )
+      conn.executemany(
+        f"INSERT OR REPLACE INTO manifests (image_digest, {', '.join(MANIFEST_COLUMNS)}) VALUES ({', '.join('?' * (len(MANIFEST_COLUMNS) + 1))})",
+        ((image_digest, *_manifest_row(entry)) for image_digest, entry in manifests)
+      )
+      conn.executemany(
+        "INSERT OR IGNORE INTO symbols (name, low12, md5, offset) VALUES (?, ?, ?, ?)",
+        ((name, offset & 0xfff, md5, offset) for name, offset, md5 in symbols)
+      )
+
+  # the entries of a layer scanned by scan_image_layers with the same options, or None.
+  # layers are keyed by their diff id, and the entries are kept as compressed json
+  @traced("index")
+  def load_layer(self, layer_digest: str, options: str) -> Optional[list["LayerEntry"]]:
+    from preplib.layers import layer_entry_from_json
+    if not self.exists(): return None
+    row = self._connect().execute("SELECT options, entries FROM layers WHERE layer_digest = ?", (layer_digest,)).fetchone()
+    if row is None or row[0] != options:
+      return None
+    return [layer_entry_from_json(value) for value in json.loads(zlib.decompress(row[1]))]
+
+  def add_layer(self, layer_digest: str, options: str, entries: list["LayerEntry"]):
+    from preplib.layers import layer_entry_to_json
+    data = zlib.compress(json.dumps([layer_entry_to_json(entry) for entry in entries]).encode())
+    with self._transaction() as conn:
+      conn.execute("INSERT OR REPLACE INTO layers (layer_digest, options, entries) VALUES (?, ?, ?)", (layer_digest, options, data))
+
+  # copy the legacy cache/ layout in. rows that are already indexed are skipped
+  def add_legacy_cache(self, batch_size=10000) -> int:
+    legacy_dir = self._get_legacy_dir()
+    logger.info(f"copying {legacy_dir} into {self._get_db_path()}...")
+    migrated = 0
+    batch: list[Tuple[str, LibInfo]] = []
+    for cache_path in legacy_dir.iterdir():
+      if not cache_path.is_file(): continue
+      batch += [(cache_path.name, info) for info in parse_legacy_cache(cache_path.read_text())]
+      migrated += 1
+      if batch_size <= len(batch):
+        self.add_many(batch)
+        batch = []
+    self.add_many(batch)
+    return migrated
+
+  def close(self):
+    conn = getattr(self._local, "conn", None)
+    if conn is not None:
+      conn.close()
+      self._local.conn = None
+
+def migrate_legacy_index(index_dir: Union[PathLike, str], remove_legacy=False, batch_size=10000):
+  index = LibIndex(index_dir)
+  legacy_dir = index._get_legacy_dir()
+  if not legacy_dir.is_dir():
+    return 0
+
+  if index.exists():
+    migrated = index.add_legacy_cache(batch_size)
+  else:
+    # a new database copies cache/ in when it is created
+    index._connect()
+    migrated = index._legacy_seeded
+  logger.info(f"migrated {migrated} digests into {index._get_db_path()}")
+
+  if remove_legacy:
+    shutil.rmtree(legacy_dir)
+  return migrated
+
+def _legacy_cache_text(info: list[LibInfo]):
+  return "\n".join(f"{i.image_name}@{i.image_digest} {repr(i.path)}" for i in info)
+
+# write the index back into the legacy cache/ layout, which the released clients read from the data repository.
+# only the files whose content changed are written, and the digests that are no longer indexed are left alone
+@traced("index")
+def export_legacy_cache(index_dir: Union[PathLike, str]):
+  index = LibIndex(index_dir)
+  legacy_dir = index._get_legacy_dir()
+  legacy_dir.mkdir(parents=True, exist_ok=True)
+  changed = 0
+  for digest, rows in groupby(index.iter_all(), key=lambda row: row[0]):
+    text = _legacy_cache_text([LibInfo(*info) for _, info in rows])
+    legacy_path = legacy_dir / digest
+    if legacy_path.exists() and legacy_path.read_text() == text: continue
+    legacy_path.write_text(text)
+    changed += 1
+  logger.info(f"updated {changed} files of the legacy layout in {legacy_dir}")
 
 class ImageIndex:
-  def __init__(self, cache_dir: Union[PathLike, str]):
+  # image_index.json is the compacted snapshot, and image_index.log holds the entries added after it
+  # as one json `[image, tag]` per line. both are read once into memory.
+  # appends and compactions of every process take image_index.lock, and a compaction runs in the background
+  # once the log has compact_threshold entries.
+  # without image_index.json, the tags in snapshot.bin take its place. while there is no log either, get and
+  # find_images are answered from the mmap-ed snapshot without reading anything
+  def __init__(self, cache_dir: Union[PathLike, str], compact_threshold=1000):
     self.cache_dir = Path(cache_dir)
+    self.compact_threshold = compact_threshold
+    self._images: Optional[dict[str, list[str]]] = None
+    self._tags: dict[str, list[str]] = {}
+    self._log_entries = 0
+    self._lock = threading.Lock()
+    self._snapshot: Optional[Snapshot] = None
+    self._snapshot_checked = False
+    self._compactor: Optional[threading.Thread] = None
 
   def _get_cache_path(self):
     return self.cache_dir / "image_index.json"
 
-  def load(self) -> dict[str, list[str]]:
+  def _get_log_path(self):
+    return self.cache_dir / "image_index.log"
+
+  @contextmanager
+  def _file_lock(self):
+    lock_path = self.cache_dir / "image_index.lock"
+    lock_path.parent.mkdir(parents=True, exist_ok=True)
+    # released when the file is closed
+    with lock_path.open("a") as f:
+      fcntl.flock(f, fcntl.LOCK_EX)
+      yield
+
+  def _binary_snapshot(self) -> Optional[Snapshot]:
+    if not self._snapshot_checked:
+      self._snapshot = Snapshot.open(self.cache_dir)
+      self._snapshot_checked = True
+    return self._snapshot
+
+  # the snapshot if it is all there is
+  def _frozen(self) -> Optional[Snapshot]:
+    if self._images is not None or self._get_cache_path().exists() or self._get_log_path().exists():
+      return None
+    return self._binary_snapshot()
+
+  @traced("index")
+  def _read_snapshot(self) -> dict[str, list[str]]:
     cache_path = self._get_cache_path()
-    if not cache_path.exists(): return {}
+    if not cache_path.exists():
+      snapshot = self._binary_snapshot()
+      return snapshot.images() if snapshot is not None else {}
     try:
       return json.loads(cache_path.read_text())
     except:
-      # TODO: report error
-      cache_path.rename(self._get_cache_path() / ".corrupt")
+      logger.warning(f"corrupt image index: {cache_path}")
+      cache_path.rename(cache_path.with_name(cache_path.name + ".corrupt"))
       return {}
 
+  @traced("index")
+  def _read_log(self) -> list[Tuple[str, str]]:
+    log_path = self._get_log_path()
+    if not log_path.exists(): return []
+    res = []
+    for l in log_path.read_text().splitlines():
+      try:
+        image_name, tag = json.loads(l)
+      except:
+        # a torn write of the last line
+        logger.debug(f"skip broken image index log line: {l!r}")
+        continue
+      res.append((image_name, tag))
+    return res
+
+  def _insert(self, image_name: str, tag: str):
+    assert self._images is not None
+    tags = self._images.setdefault(image_name, [])
+    if tag in tags:
+      return False
+    tags.append(tag)
+    images = self._tags.setdefault(tag, [])
+    if image_name not in images:
+      images.append(image_name)
+    return True
+
+  def _ensure_loaded(self) -> dict[str, list[str]]:
+    if self._images is None:
+      self._images = {}
+      self._tags = {}
+      # the log is read first. a compaction replaces the json before it removes the log, so either the log
+      # entries are read here or they are in the json read next
+      log = self._read_log()
+      for image_name, tags in self._read_snapshot().items():
+        if not isinstance(tags, list): continue
+        for tag in tags:
+          self._insert(image_name, tag)
+      for image_name, tag in log:
+        self._insert(image_name, tag)
+      self._log_entries = len(log)
+    return self._images
+
+  # changes when another process writes the snapshot or the log
+  def signature(self):
+    res = []
+    for path in [self._get_cache_path(), self._get_log_path(), Snapshot.get_path(self.cache_dir)]:
+      try:
+        st = path.stat()
+        res.append((st.st_mtime_ns, st.st_size))
+      except FileNotFoundError:
+        res.append(None)
+    return tuple(res)
+
+  def reload(self):
+    with self._lock:
+      self._images = None
+      self._snapshot_checked = False
+      self._ensure_loaded()
+
+  def load(self) -> dict[str, list[str]]:
+    with self._lock:
+      return self._ensure_loaded()
+
   def dump(self, cache: dict[str, list[str]]):
-    cache_path = self._get_cache_path()
-    cache_path.parent.mkdir(parents=True, exist_ok=True)
-    cache_path.write_text(json.dumps(cache))
+    with self._lock:
+      self._images = {}
+      self._tags = {}
+      for image_name, tags in cache.items():
+        for tag in tags:
+          self._insert(image_name, tag)
+      with self._file_lock():
+        self._write_cache(self._images)
+        self._get_log_path().unlink(missing_ok=True)
+      self._log_entries = 0
 
   def get(self, image_name: str):
+    snapshot = self._frozen()
+    if snapshot is not None:
+      return snapshot.image_tags(image_name)
     return self.load().get(image_name, [])
 
+  def find_images(self, tag: str) -> list[str]:
+    snapshot = self._frozen()
+    if snapshot is not None:
+      return snapshot.find_images(tag)
+    with self._lock:
+      self._ensure_loaded()
+      return self._tags.get(tag, [])
+
   def add(self, image_name: str, new_tag: str):
-    caches = self.load()
-    if image_name not in caches or not isinstance(caches[image_name], list):
-      caches[image_name] = []
-    caches[image_name].append(new_tag)
-    self.dump(caches)
+    with self._lock:
+      self._ensure_loaded()
+      if not self._insert(image_name, new_tag):
+        return
+      log_path = self._get_log_path()
+      log_path.parent.mkdir(parents=True, exist_ok=True)
+      with self._file_lock(), log_path.open("a") as f:
+        f.write(json.dumps([image_name, new_tag]) + "\n")
+      self._log_entries += 1
+      if self.compact_threshold <= self._log_entries and (self._compactor is None or not self._compactor.is_alive()):
+        self._log_entries = 0
+        self._compactor = threading.Thread(target=self._compact, name="image-index-compact")
+        self._compactor.start()
 
-def get_lib_digests(image_name: str, lib_paths: list[str], index_type: str):
-  commands, parser, mount_scripts = index_commands[index_type]
-  logger.debug(f"{index_type=} {commands=}")
-  command_res = run_docker(image_name, *commands, *lib_paths, mount_scripts=mount_scripts)
-  return parser(command_res.decode())
+  def compact(self):
+    compactor = self._compactor
+    if compactor is not None:
+      compactor.join()
+    self._compact()
 
+  def _write_cache(self, images: dict[str, list[str]]):
+    cache_path = self._get_cache_path()
+    tmp_path = cache_path.with_name(cache_path.name + ".tmp")
+    tmp_path.write_text(json.dumps(images))
+    os.replace(tmp_path, cache_path)
+
+  # folds the log on disk into image_index.json. the log is read under the lock, so that it has the entries
+  # appended by other processes too, and nothing is appended between reading and removing it
+  @traced("index")
+  def _compact(self):
+    with self._file_lock():
+      log = self._read_log()
+      if len(log) == 0: return
+      images = self._read_snapshot()
+      for image_name, tag in log:
+        tags = images.setdefault(image_name, [])
+        if tag not in tags:
+          tags.append(tag)
+      self._write_cache(images)
+      self._get_log_path().unlink(missing_ok=True)
 
-def index_image(image_name: str, index_dir: Union[PathLike, str]=default_cache_dir, index_types=["build-id", "md5"]):
+class ImageScan(NamedTuple):
+  repository_name: str
+  image_tag: Optional[str]
+  image_digest: str
+  entries: list[Tuple[str, LibInfo]]
+  manifest: list[ManifestEntry]
+  # (name, offset, md5 of the library)
+  symbols: list[Tuple[str, int, str]]
+  @property
+  def image_identifier(self):
+    return f"{self.repository_name}@{self.image_digest}"
+  @property
+  def manifest_rows(self):
+    return [(self.image_digest, entry) for entry in self.manifest]
+
+def is_symbol_library(record: LibRecord, symbol_libraries: list[str]):
+  names = [os.path.basename(record.path)] + ([record.soname] if record.soname is not None else [])
+  return any(fnmatch(name, pattern) for name in names for pattern in symbol_libraries)
+
+def _image_scan(repository_name: str, image_tag: Optional[str], image_digest: str, records: list[LibRecord], index_types: list[str], symbol_libraries: list[str]):
+  entries: list[Tuple[str, LibInfo]] = []
+  manifest: list[ManifestEntry] = []
+  symbols: list[Tuple[str, int, str]] = []
+  for record in records:
+    # symbols are keyed by the md5 of the file, so that the libs table maps them to images
+    md5 = record.digests.get("md5")
+    if record.symbols is not None and md5 is not None and is_symbol_library(record, symbol_libraries):
+      symbols += [(name, offset, md5) for name, offset in record.symbols]
+    for index_type in index_types:
+      digest = record.digests.get(index_type)
+      if digest is None: continue
+      logger.debug(f"{record.path=} {index_type=} {digest=}")
+      entries.append((digest, LibInfo(repository_name, image_digest, record.path)))
+    manifest.append(ManifestEntry(
+      record.path, record.soname, record.digests.get("build-id"), record.digests.get("md5"), record.size,
+      record.arch, record.needed, record.rpath, record.runpath
+    ))
+  return ImageScan(repository_name, image_tag, image_digest, entries, manifest, symbols)
+
+def scan_image(image_name: str, index_types=["build-id", "md5", "symbols"], symbol_libraries: list[str]=default_symbol_libraries, symbol_names: Optional[list[str]]=None):
   repository_name, image_tag, image_digest = parse_image_name(image_name)
+  # one container lists and hashes every library for all index types at once
+  records = scan_libraries(image_name, index_types, symbol_names)
+  return _image_scan(repository_name, image_tag, image_digest, records, index_types, symbol_libraries)
 
-  if image_tag is not None:
-    ImageIndex(index_dir).add(f"{repository_name}@{image_digest}", image_tag)
+# the same scan as scan_image, read from the layers of the image without docker (see preplib.layers for the names).
+# the layers already in lib_index are not fetched again, and the new ones are recorded there
+def scan_image_layers(image_name: str, index_types=["build-id", "md5", "symbols"], symbol_libraries: list[str]=default_symbol_libraries, lib_index: Optional[LibIndex]=None, platform: Optional[str]=None):
+  from preplib.layers import DEFAULT_PLATFORM, image_libraries, merge_layers, open_image_source, scan_layer
+  options = f"{','.join(index_types)};{','.join(symbol_libraries)}"
+  layers: list[list[LayerEntry]] = []
+  with open_image_source(image_name, platform or DEFAULT_PLATFORM) as source:
+    image_layers = source.layers()
+    for descriptor, diff_id in image_layers.layers:
+      entries = lib_index.load_layer(diff_id, options) if lib_index is not None else None
+      if entries is not None:
+        logger.debug(f"layer {diff_id} is already indexed")
+      else:
+        with source.open_layer(descriptor) as f:
+          entries = scan_layer(f, index_types, lambda record: is_symbol_library(record, symbol_libraries))
+        if lib_index is not None:
+          lib_index.add_layer(diff_id, options, entries)
+      layers.append(entries)
+  records = image_libraries(merge_layers(layers))
+  return _image_scan(source.repository_name, source.image_tag, image_layers.image_digest, records, index_types, symbol_libraries)
 
-  index = LibIndex(index_dir)
+# images named like docker://ubuntu:22.04 or oci:<dir> are read from their layers, and do not need docker
+def index_image(image_name: str, index_dir: Union[PathLike, str]=default_cache_dir, index_types=["build-id", "md5", "symbols"], image_index: Optional[ImageIndex]=None):
+  from preplib.layers import is_image_source
+  if is_image_source(image_name):
+    scan = scan_image_layers(image_name, index_types, lib_index=LibIndex(index_dir))
+  else:
+    scan = scan_image(image_name, index_types)
 
-  lib_paths = list_libraries(image_name)  
-  for index_type in index_types:
-    for path, digest in get_lib_digests(image_name, lib_paths, index_type):
-      logger.debug(f"{path=} {digest=}")
-      index.add(digest, LibInfo(repository_name, image_digest, path))
+  if scan.image_tag is not None:
+    if image_index is None:
+      image_index = ImageIndex(index_dir)
+    image_index.add(scan.image_identifier, scan.image_tag)
 
+  # all libraries of the image are committed in one transaction
+  LibIndex(index_dir).add_many(scan.entries, scan.manifest_rows, scan.symbols)
+  return scan
+
+# the manifest of the image if it is indexed. no container is started
+def find_manifest(image_name: str, index_dir: Union[PathLike, str]=default_cache_dir) -> list[ManifestEntry]:
+  try:
+    _, _, image_digest = parse_image_name(image_name)
+  except CalledProcessError:
+    logger.debug(f"could not resolve the digest of {image_name}")
+    return []
+  return LibIndex(index_dir).load_manifest(image_digest)
+
+# the libraries of an image from the index, or from a scan of the image if it is not indexed
+def load_manifest(image_name: str, index_dir: Union[PathLike, str]=default_cache_dir) -> list[ManifestEntry]:
+  manifest = find_manifest(image_name, index_dir)
+  if len(manifest) != 0:
+    return manifest
+  logger.debug(f"{image_name} has no manifest in {index_dir}, scanning it...")
+  return scan_image(image_name, ["build-id", "md5"]).manifest
+
+# `library_digest` may be a prefix of at least MIN_DIGEST_PREFIX_LENGTH characters. raises AmbiguousDigestError if it
+# matches more than one digest, and ValueError if it matches none
 def find_image(library_digest: str, index_dir: Union[PathLike, str]=default_cache_dir):
   lib_index = LibIndex(index_dir)
+  if not is_digest_like(library_digest) and is_digest_prefix_like(library_digest):
+    library_digest = DigestTable.open(lib_index).resolve(library_digest)
   return lib_index.load(library_digest)
 
 def get_image_index(index_dir: Union[PathLike, str]=default_cache_dir):
   return ImageIndex(index_dir)
 
-def find_suitable_images(digests: list[Tuple[str, str]], index: LibIndex):
+class LibIndexLike(Protocol):
+  def load(self, digest: str) -> list[LibInfo]: ...
+  def load_many(self, digests: list[str]) -> dict[str, list[LibInfo]]: ...
+
+@traced("index")
+def find_suitable_images(digests: list[Tuple[str, str]], index: LibIndexLike):
   candidate_images: Optional[dict[str, dict[str, str]]] = None
+  logger.debug(f"{digests=}")
+  # fetched at once, so that the backend can batch the lookups
+  loaded = index.load_many([digest for _, digest in digests])
   for key, digest in digests:
-    logger.debug(f"{digests=}")
-    images = index.load(digest)
+    images = loaded[digest]
     logger.debug(f"{digest} -> {images}")
     if candidate_images is None:
       candidate_images = {}
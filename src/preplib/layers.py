@@ -0,0 +1,500 @@
+from contextlib import contextmanager
+from fnmatch import fnmatch
+import hashlib
+import json
+from os import PathLike
+from pathlib import Path
+import posixpath
+import re
+import tarfile
+from typing import IO, Any, Callable, Iterator, NamedTuple, Optional, Protocol, Union
+from urllib.error import HTTPError
+from urllib.parse import urlencode, urlparse
+from urllib.request import HTTPRedirectHandler, Request, build_opener
+
+from preplib.elf import ElfError, ElfFile
+from preplib.extract import LibRecord
+from preplib.logger import logger
+from preplib.timing import span, traced
+
+# indexing without a docker daemon: the layers of an image are read from a registry, an OCI image layout or a
+# `docker save` archive. each layer is streamed once, and only the files named like libraries are read into memory.
+# image names are given with the transports of skopeo:
+#   docker://<name>                 e.g. docker://ubuntu:22.04, docker://localhost:5000/foo@sha256:...
+#   oci:<directory>[:<ref>]         <ref> is the org.opencontainers.image.ref.name annotation
+#   docker-archive:<file>[:<ref>]   <ref> is one of RepoTags
+
+SOURCE_TRANSPORTS = ("docker://", "oci:", "docker-archive:")
+DEFAULT_PLATFORM = "linux/amd64"
+
+DOCKER_HUB_REGISTRY = "registry-1.docker.io"
+INDEX_MEDIA_TYPES = [
+  "application/vnd.oci.image.index.v1+json",
+  "application/vnd.docker.distribution.manifest.list.v2+json",
+]
+MANIFEST_MEDIA_TYPES = INDEX_MEDIA_TYPES + [
+  "application/vnd.oci.image.manifest.v1+json",
+  "application/vnd.docker.distribution.manifest.v2+json",
+]
+
+WHITEOUT_PREFIX = ".wh."
+OPAQUE_WHITEOUT = ".wh..wh..opq"
+ELF_MAGIC = b"\x7fELF"
+LD_SO_CONF = "/etc/ld.so.conf"
+# listed by ldconfig after the directories of ld.so.conf. musl images have only these
+DEFAULT_LIBRARY_DIRS = ["/lib", "/usr/lib", "/lib64", "/usr/lib64"]
+HASH_TYPES = ["md5", "sha1", "sha256", "sha512"]
+
+# one file of a layer that matters for the libraries of the image
+class LayerEntry(NamedTuple):
+  path: str
+  # "lib": an ELF file named like a library, with its record
+  # "link": a symlink to `target`
+  # "conf": ld.so.conf or a file in ld.so.conf.d, with the text in `target`
+  # "other": a file named like a library that is not ELF (e.g. the linker script libc.so)
+  # "whiteout": `path` of the lower layers is removed
+  # "opaque": everything under `path` of the lower layers is removed
+  kind: str
+  target: Optional[str] = None
+  record: Optional[LibRecord] = None
+
+def layer_entry_to_json(entry: LayerEntry):
+  return [entry.path, entry.kind, entry.target, list(entry.record) if entry.record is not None else None]
+
+def layer_entry_from_json(value: list[Any]):
+  path, kind, target, record = value
+  if record is not None:
+    symbols = record[-1]
+    record = LibRecord(*record[:-1], symbols=[(name, offset) for name, offset in symbols] if symbols is not None else None)
+  return LayerEntry(path, kind, target, record)
+
+def _member_path(name: str):
+  return posixpath.normpath("/" + name)
+
+def _is_ld_so_conf(path: str):
+  return path == LD_SO_CONF or posixpath.dirname(path) == LD_SO_CONF + ".d"
+
+def _read_library(path: str, f: IO[bytes], hash_types: list[str], want_symbols: Callable[[LibRecord], bool]):
+  head = f.read(len(ELF_MAGIC))
+  if head != ELF_MAGIC:
+    # the rest of the member is skipped by tarfile
+    return LayerEntry(path, "other")
+  hashes = { hash_type: hashlib.new(hash_type, head) for hash_type in hash_types if hash_type in HASH_TYPES }
+  data = bytearray(head)
+  while chunk := f.read(1 << 20):
+    data += chunk
+    for h in hashes.values():
+      h.update(chunk)
+  try:
+    elf = ElfFile(data)
+    info = elf.info()
+  except ElfError as e:
+    logger.debug(f"failed to parse {path}: {e}")
+    return LayerEntry(path, "other")
+  # the same fields as scripts/scan reports
+  digests: dict[str, str] = {}
+  if "build-id" in hash_types and info.build_id is not None:
+    digests["build-id"] = info.build_id
+  for hash_type, h in hashes.items():
+    digests[hash_type] = h.hexdigest()
+  record = LibRecord(
+    path, digests, size=len(data), arch=f"{64 if elf.is64 else 32}-{elf.machine}",
+    soname=info.soname, needed=info.needed, rpath=info.rpath, runpath=info.runpath,
+  )
+  if "symbols" in hash_types and want_symbols(record):
+    record = record._replace(symbols=elf.dynamic_symbols())
+  return LayerEntry(path, "lib", record=record)
+
+# the libraries, symlinks, ld.so.conf and whiteouts of a layer tar (compressed or not), read as a stream.
+# want_symbols decides which libraries get their .dynsym recorded
+@traced("index")
+def scan_layer(fileobj: IO[bytes], hash_types: list[str], want_symbols: Callable[[LibRecord], bool]=lambda _: True) -> list[LayerEntry]:
+  entries: dict[str, LayerEntry] = {}
+  hard_links: list[tuple[str, str]] = []
+  with tarfile.open(fileobj=fileobj, mode="r|*") as tar:
+    for member in tar:
+      path = _member_path(member.name)
+      parent, name = posixpath.split(path)
+      if name == OPAQUE_WHITEOUT:
+        entries[parent] = LayerEntry(parent, "opaque")
+      elif name.startswith(WHITEOUT_PREFIX):
+        removed = posixpath.join(parent, name[len(WHITEOUT_PREFIX):])
+        entries[removed] = LayerEntry(removed, "whiteout")
+      elif member.issym():
+        # every symlink is kept, as directories like /lib may be links too
+        entries[path] = LayerEntry(path, "link", member.linkname)
+      elif member.islnk():
+        hard_links.append((path, _member_path(member.linkname)))
+      elif member.isfile() and _is_ld_so_conf(path):
+        f = tar.extractfile(member)
+        assert f is not None
+        entries[path] = LayerEntry(path, "conf", f.read().decode(errors="replace"))
+      elif member.isfile() and ".so" in name:
+        f = tar.extractfile(member)
+        assert f is not None
+        entries[path] = _read_library(path, f, hash_types, want_symbols)
+      elif ".so" in name:
+        # it still hides a library of the lower layers at the same path
+        entries[path] = LayerEntry(path, "other")
+  # a hard link refers to a file earlier in the same layer
+  for path, target in hard_links:
+    entry = entries.get(target)
+    if entry is not None and entry.kind in ("lib", "conf"):
+      record = entry.record._replace(path=path, symbols=None) if entry.record is not None else None
+      entries[path] = entry._replace(path=path, record=record)
+    elif ".so" in posixpath.basename(path) or _is_ld_so_conf(path):
+      entries[path] = LayerEntry(path, "other")
+  return list(entries.values())
+
+# the files of the image as the layers (the lowest first) are stacked by the overlay filesystem
+def merge_layers(layers: list[list[LayerEntry]]) -> dict[str, LayerEntry]:
+  fs: dict[str, LayerEntry] = {}
+  for entries in layers:
+    removed = [entry for entry in entries if entry.kind in ("whiteout", "opaque")]
+    for entry in removed:
+      if entry.kind == "whiteout":
+        fs.pop(entry.path, None)
+    # a file in place of a directory of the lower layers hides everything under it too
+    dirs: set[str] = set()
+    for path in fs:
+      while (path := posixpath.dirname(path)) != "/" and path not in dirs:
+        dirs.add(path)
+    prefixes = tuple(entry.path.rstrip("/") + "/" for entry in entries if entry.kind in ("whiteout", "opaque") or entry.path in dirs)
+    if len(prefixes) != 0:
+      fs = { path: entry for path, entry in fs.items() if not path.startswith(prefixes) }
+    for entry in entries:
+      if entry.kind not in ("whiteout", "opaque"):
+        fs[entry.path] = entry
+  return fs
+
+# follows the symlinks of the image in every component of `path`. None on a symlink loop
+def resolve_path(fs: dict[str, LayerEntry], path: str, max_links=40) -> Optional[str]:
+  components = path.split("/")[::-1]
+  resolved = "/"
+  while len(components) != 0:
+    component = components.pop()
+    if component in ("", "."): continue
+    if component == "..":
+      resolved = posixpath.dirname(resolved)
+      continue
+    candidate = posixpath.join(resolved, component)
+    entry = fs.get(candidate)
+    if entry is not None and entry.kind == "link":
+      assert entry.target is not None
+      max_links -= 1
+      if max_links < 0:
+        return None
+      if entry.target.startswith("/"):
+        resolved = "/"
+      components += entry.target.split("/")[::-1]
+      continue
+    resolved = candidate
+  return resolved
+
+# the directories of ld.so.conf (following its includes), then the default ones
+def library_dirs(fs: dict[str, LayerEntry]) -> list[str]:
+  res: list[str] = []
+  def read_conf(path: str, depth: int):
+    entry = fs.get(path)
+    if entry is None or entry.kind != "conf" or 8 < depth: return
+    assert entry.target is not None
+    for line in entry.target.splitlines():
+      line = line.split("#", 1)[0].strip()
+      if line == "" or line.startswith("hwcap "): continue
+      if line.startswith("include "):
+        pattern = posixpath.join(posixpath.dirname(path), line.split(None, 1)[1].strip())
+        for conf_path in sorted(conf_path for conf_path in fs if fnmatch(conf_path, pattern)):
+          read_conf(conf_path, depth + 1)
+        continue
+      # the old `dir=TYPE` form
+      d = line.split("=", 1)[0].strip()
+      if d.startswith("/"):
+        res.append(posixpath.normpath(d))
+  read_conf(LD_SO_CONF, 0)
+  return res + DEFAULT_LIBRARY_DIRS
+
+# what ldconfig -p would list: the libraries in each library directory by their path under that directory (e.g.
+# /lib/x86_64-linux-gnu/libc.so.6 even if /lib links to usr/lib). the symbols are kept on the first path of each file
+def image_libraries(fs: dict[str, LayerEntry]) -> list[LibRecord]:
+  by_dir: dict[str, list[str]] = {}
+  for path, entry in fs.items():
+    if entry.kind in ("lib", "link") and ".so" in posixpath.basename(path):
+      by_dir.setdefault(posixpath.dirname(path), []).append(path)
+  res: list[LibRecord] = []
+  seen_dirs: set[str] = set()
+  seen_files: set[str] = set()
+  for d in library_dirs(fs):
+    real_dir = resolve_path(fs, d)
+    if real_dir is None or real_dir in seen_dirs: continue
+    seen_dirs.add(real_dir)
+    for path in sorted(by_dir.get(real_dir, [])):
+      real_path = resolve_path(fs, path)
+      entry = fs.get(real_path) if real_path is not None else None
+      if entry is None or entry.kind != "lib": continue
+      assert entry.record is not None and real_path is not None
+      symbols = entry.record.symbols if real_path not in seen_files else None
+      seen_files.add(real_path)
+      res.append(entry.record._replace(path=posixpath.join(d, posixpath.basename(path)), symbols=symbols))
+  return res
+
+class ImageLayers(NamedTuple):
+  # the digest the image is recorded by. for registries it is what `docker inspect` reports in RepoDigests
+  image_digest: str
+  # (descriptor, diff id) from the lowest layer. the diff id (digest of the uncompressed tar) identifies the
+  # layer whatever the compression is
+  layers: list[tuple[dict[str, Any], str]]
+
+class ImageSource(Protocol):
+  repository_name: str
+  image_tag: Optional[str]
+  def layers(self) -> ImageLayers: ...
+  def open_layer(self, descriptor: dict[str, Any]) -> Any: ...
+  def close(self): ...
+
+def _is_index(manifest: dict[str, Any]):
+  return manifest.get("mediaType") in INDEX_MEDIA_TYPES or ("manifests" in manifest and "layers" not in manifest)
+
+def _select_platform(index: dict[str, Any], platform: str) -> dict[str, Any]:
+  os_name, architecture, *variant = platform.split("/")
+  for descriptor in index.get("manifests", []):
+    descriptor_platform = descriptor.get("platform", {})
+    if descriptor_platform.get("os") != os_name or descriptor_platform.get("architecture") != architecture: continue
+    if len(variant) != 0 and descriptor_platform.get("variant") != variant[0]: continue
+    return descriptor
+  raise ValueError(f"the image has no {platform} manifest")
+
+def _check_layer_media_type(descriptor: dict[str, Any]):
+  # tarfile reads plain, gzip, bzip2 and xz tars
+  if "zstd" in descriptor.get("mediaType", ""):
+    raise ValueError(f"zstd compressed layers are not supported: {descriptor['digest']}")
+
+# docker.io/library/ubuntu -> ubuntu, as docker names it
+def short_image_name(name: str):
+  for prefix in ["docker.io/", "index.docker.io/"]:
+    if name.startswith(prefix):
+      name = name[len(prefix):]
+      if name.startswith("library/") and name.count("/") == 1:
+        name = name[len("library/"):]
+  return name
+
+def split_image_name(image_name: str) -> tuple[str, Optional[str], Optional[str]]:
+  repository_and_tag, _, digest = image_name.partition("@")
+  if ":" in repository_and_tag.split("/")[-1]:
+    repository, tag = repository_and_tag.rsplit(":", 1)
+    return repository, tag, digest or None
+  return repository_and_tag, None, digest or None
+
+# checks the digest of a blob while it is read
+class DigestReader:
+  def __init__(self, f: IO[bytes], digest: str):
+    self.f = f
+    self.digest = digest
+    algorithm, _, self.expected = digest.partition(":")
+    self.hash = hashlib.new(algorithm)
+    self.size = 0
+
+  def read(self, size=-1) -> bytes:
+    data = self.f.read(size)
+    self.hash.update(data)
+    self.size += len(data)
+    return data
+
+  # the reader of the blob may stop before its end, e.g. at the end-of-archive blocks of a tar
+  def verify(self):
+    while self.read(1 << 20): pass
+    if self.hash.hexdigest() != self.expected:
+      raise ValueError(f"the content of {self.digest} does not match its digest")
+
+class _RedirectHandler(HTTPRedirectHandler):
+  # blobs are redirected to storage that rejects the token of the registry
+  def redirect_request(self, req, fp, code, msg, headers, newurl):
+    new_req = super().redirect_request(req, fp, code, msg, headers, newurl)
+    if new_req is not None and urlparse(newurl).netloc != urlparse(req.full_url).netloc:
+      new_req.remove_header("Authorization")
+    return new_req
+
+# the registry HTTP API v2, with anonymous bearer tokens as Docker Hub hands them out.
+# localhost registries are spoken to over plain HTTP, as docker does
+class RegistrySource:
+  def __init__(self, image_name: str, platform=DEFAULT_PLATFORM):
+    name, self.image_tag, digest = split_image_name(image_name)
+    self.repository_name = name = short_image_name(name)
+    first, _, rest = name.partition("/")
+    if rest != "" and ("." in first or ":" in first or first == "localhost"):
+      self.registry, self.repository = first, rest
+    else:
+      self.registry = DOCKER_HUB_REGISTRY
+      self.repository = name if "/" in name else f"library/{name}"
+    self.reference = digest or self.image_tag or "latest"
+    host = self.registry.split(":")[0]
+    self.scheme = "http" if host in ("localhost", "127.0.0.1", "::1") else "https"
+    self.platform = platform
+    self._token: Optional[str] = None
+    self._opener = build_opener(_RedirectHandler)
+
+  def _authenticate(self, challenge: str):
+    scheme, _, params = challenge.partition(" ")
+    if scheme.lower() != "bearer":
+      raise ValueError(f"{self.registry} asks for {scheme} authentication, which is not supported")
+    fields = dict(re.findall(r'(\w+)="([^"]*)"', params))
+    query = urlencode({ key: fields[key] for key in ["service", "scope"] if key in fields })
+    with span("remote", "registry token"):
+      with self._opener.open(f"{fields['realm']}?{query}", timeout=60) as res:
+        body = json.loads(res.read())
+    self._token = body.get("token") or body.get("access_token")
+
+  def _open(self, path: str, accept: Optional[str]=None):
+    url = f"{self.scheme}://{self.registry}/v2/{self.repository}/{path}"
+    def request():
+      headers = {}
+      if accept is not None:
+        headers["Accept"] = accept
+      if self._token is not None:
+        headers["Authorization"] = f"Bearer {self._token}"
+      return self._opener.open(Request(url, headers=headers), timeout=60)
+    try:
+      return request()
+    except HTTPError as e:
+      if e.code != 401 or self._token is not None:
+        raise
+      self._authenticate(e.headers.get("WWW-Authenticate", ""))
+      return request()
+
+  def _get_manifest(self, reference: str):
+    with span("remote", "registry manifest", reference=f"{self.repository}:{reference}"):
+      with self._open(f"manifests/{reference}", ", ".join(MANIFEST_MEDIA_TYPES)) as res:
+        body = res.read()
+        digest = res.headers.get("Docker-Content-Digest")
+    return json.loads(body), digest or f"sha256:{hashlib.sha256(body).hexdigest()}"
+
+  def layers(self):
+    manifest, image_digest = self._get_manifest(self.reference)
+    if _is_index(manifest):
+      manifest, _ = self._get_manifest(_select_platform(manifest, self.platform)["digest"])
+    with span("remote", "registry config"):
+      with self._open(f"blobs/{manifest['config']['digest']}") as res:
+        config = json.loads(res.read())
+    return ImageLayers(image_digest, list(zip(manifest["layers"], config["rootfs"]["diff_ids"])))
+
+  @contextmanager
+  def open_layer(self, descriptor: dict[str, Any]) -> Iterator[IO[bytes]]:
+    _check_layer_media_type(descriptor)
+    with span("remote", "registry layer", digest=descriptor["digest"], bytes_read=descriptor.get("size", 0)):
+      with self._open(f"blobs/{descriptor['digest']}") as res:
+        reader = DigestReader(res, descriptor["digest"])
+        yield reader
+        reader.verify()
+
+  def close(self):
+    pass
+
+class OCILayoutSource:
+  def __init__(self, path: Union[PathLike, str], ref: Optional[str]=None, platform=DEFAULT_PLATFORM):
+    self.path = Path(path)
+    self.platform = platform
+    manifests = json.loads((self.path / "index.json").read_text())["manifests"]
+    ref_names = [descriptor.get("annotations", {}).get("org.opencontainers.image.ref.name") for descriptor in manifests]
+    if ref is not None:
+      candidates = [descriptor for descriptor, ref_name in zip(manifests, ref_names) if ref_name == ref]
+    else:
+      candidates = manifests
+    if len(candidates) != 1:
+      raise ValueError(f"{self.path} has {len(candidates)} images{f' named {ref}' if ref is not None else ''}. choose one by oci:{self.path}:<ref> from {[name for name in ref_names if name is not None]}")
+    self.descriptor = candidates[0]
+    # containerd and buildkit record the whole name. skopeo only records the tag, and then the directory is the repository
+    annotations = self.descriptor.get("annotations", {})
+    name = annotations.get("io.containerd.image.name") or annotations.get("org.opencontainers.image.ref.name")
+    if name is None or ("/" not in name and ":" not in name):
+      name = f"{self.path.absolute().name}:{name}" if name is not None else self.path.absolute().name
+    name, self.image_tag, _ = split_image_name(name)
+    self.repository_name = short_image_name(name)
+
+  def _blob_path(self, digest: str):
+    algorithm, _, encoded = digest.partition(":")
+    return self.path / "blobs" / algorithm / encoded
+
+  def _read_json(self, digest: str):
+    return json.loads(self._blob_path(digest).read_bytes())
+
+  def layers(self):
+    manifest = self._read_json(self.descriptor["digest"])
+    if _is_index(manifest):
+      manifest = self._read_json(_select_platform(manifest, self.platform)["digest"])
+    config = self._read_json(manifest["config"]["digest"])
+    return ImageLayers(self.descriptor["digest"], list(zip(manifest["layers"], config["rootfs"]["diff_ids"])))
+
+  @contextmanager
+  def open_layer(self, descriptor: dict[str, Any]) -> Iterator[IO[bytes]]:
+    _check_layer_media_type(descriptor)
+    with open(self._blob_path(descriptor["digest"]), "rb") as f:
+      reader = DigestReader(f, descriptor["digest"])
+      yield reader
+      reader.verify()
+
+  def close(self):
+    pass
+
+# `docker save` output. it has no repository digest, so the image is recorded by its id (the digest of the config)
+class DockerArchiveSource:
+  def __init__(self, path: Union[PathLike, str], ref: Optional[str]=None):
+    self.path = Path(path)
+    self.tar = tarfile.open(self.path)
+    manifest = json.loads(self._read("manifest.json"))
+    if ref is not None:
+      candidates = [image for image in manifest if ref in (image.get("RepoTags") or [])]
+    else:
+      candidates = manifest
+    if len(candidates) != 1:
+      self.tar.close()
+      raise ValueError(f"{self.path} has {len(candidates)} images{f' tagged {ref}' if ref is not None else ''}. choose one by docker-archive:{self.path}:<ref>")
+    self.image = candidates[0]
+    repo_tags = self.image.get("RepoTags") or []
+    name = ref or (repo_tags[0] if len(repo_tags) != 0 else self.path.stem)
+    name, self.image_tag, _ = split_image_name(name)
+    self.repository_name = short_image_name(name)
+
+  def _read(self, name: str):
+    f = self.tar.extractfile(name)
+    if f is None:
+      raise ValueError(f"{name} is not a file in {self.path}")
+    return f.read()
+
+  def layers(self):
+    config = self._read(self.image["Config"])
+    diff_ids = json.loads(config)["rootfs"]["diff_ids"]
+    return ImageLayers(f"sha256:{hashlib.sha256(config).hexdigest()}", [({ "path": path }, diff_id) for path, diff_id in zip(self.image["Layers"], diff_ids)])
+
+  @contextmanager
+  def open_layer(self, descriptor: dict[str, Any]) -> Iterator[IO[bytes]]:
+    f = self.tar.extractfile(descriptor["path"])
+    if f is None:
+      raise ValueError(f"{descriptor['path']} is not a file in {self.path}")
+    yield f
+
+  def close(self):
+    self.tar.close()
+
+def is_image_source(image_name: str):
+  return image_name.startswith(SOURCE_TRANSPORTS)
+
+def _split_path_ref(spec: str) -> tuple[str, Optional[str]]:
+  if ":" in spec and not Path(spec).exists():
+    path, ref = spec.rsplit(":", 1)
+    return path, ref
+  return spec, None
+
+@contextmanager
+def open_image_source(image_name: str, platform=DEFAULT_PLATFORM) -> Iterator[ImageSource]:
+  source: ImageSource
+  if image_name.startswith("docker://"):
+    source = RegistrySource(image_name[len("docker://"):], platform)
+  elif image_name.startswith("oci:"):
+    source = OCILayoutSource(*_split_path_ref(image_name[len("oci:"):]), platform=platform)
+  elif image_name.startswith("docker-archive:"):
+    source = DockerArchiveSource(*_split_path_ref(image_name[len("docker-archive:"):]))
+  else:
+    raise ValueError(f"unknown image source: {image_name}. use one of {', '.join(SOURCE_TRANSPORTS)}")
+  try:
+    yield source
+  finally:
+    source.close()
@@ -0,0 +1,67 @@
+import os
+from os import PathLike
+from typing import Optional, Union
+
+from preplib.digests import DigestTable
+from preplib.elf import ElfError, file_digest, read_elf_info
+from preplib.index import LibIndex, get_image_index
+from preplib.logger import logger
+from preplib.query import InvertedIndex, Target
+from preplib.utils import is_digest_like, is_digest_prefix_like
+
+# a hash prefix that has to be completed from the digest table of the local index
+def is_digest_prefix_target(val: str):
+  return not os.path.exists(val) and not is_digest_like(val) and is_digest_prefix_like(val)
+
+# a library file is looked up by its md5 and build-id, a hash by itself.
+# raises AmbiguousDigestError or ValueError if a hash prefix does not complete to exactly one digest
+def make_target(val: str, digest_table: Optional[DigestTable]=None) -> Optional[Target]:
+  if os.path.exists(val):
+    digests = [file_digest(val, "md5")]
+    try:
+      build_id = read_elf_info(val).build_id
+      if build_id is not None:
+        digests.append(build_id)
+    except (ElfError, ValueError) as e:
+      logger.debug(f"failed to read build-id of {val}: {e}")
+    return Target(val, digests)
+  if is_digest_like(val):
+    # either md5 or build-id
+    return Target(val, [val])
+  if digest_table is not None and is_digest_prefix_like(val):
+    return Target(val, [digest_table.resolve(val)])
+  return None
+
+# the daemon if it is running, the shards on `server`, or the local index
+class Lookup:
+  def __init__(self, index_dir: Union[PathLike, str], server: Optional[str]=None, use_daemon=True):
+    self.daemon = None
+    if server is None and use_daemon:
+      from preplib.server import DaemonClient, default_socket_path
+      self.daemon = DaemonClient.connect(default_socket_path(index_dir))
+    if self.daemon is not None:
+      logger.debug(f"using the daemon for {index_dir}")
+      self.image_index = self.daemon
+    elif server is not None:
+      from preplib.remote import RemoteImageIndex, RemoteIndexClient, RemoteLibIndex
+      client = RemoteIndexClient(server)
+      self.lib_index = RemoteLibIndex(client)
+      self.image_index = RemoteImageIndex(client)
+    else:
+      self.lib_index = LibIndex(cache_dir=index_dir)
+      self.image_index = get_image_index(index_dir)
+
+  # the images that contain all targets of each group: [{image identifier: {target key: path}}]
+  def match_many(self, target_groups: list[list[Target]]) -> list[dict[str, dict[str, str]]]:
+    if self.daemon is not None:
+      return [self.daemon.match(targets) for targets in target_groups]
+    # md5 and build-id of every target are looked up at once
+    digests = [digest for targets in target_groups for target in targets for digest in target.digests]
+    inverted_index = InvertedIndex.from_lib_index(self.lib_index, digests)
+    return [inverted_index.match(targets) for targets in target_groups]
+
+  def match(self, targets: list[Target]) -> dict[str, dict[str, str]]:
+    return self.match_many([targets])[0]
+
+  def tags(self, image_identifier: str) -> list[str]:
+    return self.image_index.get(image_identifier)
@@ -1,17 +1,23 @@
 #!/bin/python
 from argparse import ArgumentParser
-import hashlib
+import atexit
 import logging
 import os
-from subprocess import check_output
-from pathlib import Path
+import sys
 from typing import Optional
 
-from preplib.index import LibIndex, find_suitable_images, get_image_index, index_image, default_cache_dir
+from preplib.index import LIBDIGESTINFO_SERVER, LibIndex, index_image, default_cache_dir, find_manifest, load_manifest, migrate_legacy_index
 
+from preplib.blobcache import BlobCache, default_blob_cache_size, extract_libraries_cached
+from preplib.digests import AmbiguousDigestError, DigestTable
 from preplib.logger import logger
-from preplib.extract import find_libraries, list_libraries
-from preplib.utils import parse_image_name, is_digest_like
+from preplib.lookup import Lookup, is_digest_prefix_target, make_target
+from preplib.metacache import set_metadata_cache
+from preplib.query import SymbolQuery, Target, rank_symbol_matches
+from preplib.resolve import find_binary_libraries
+from preplib.timing import Recorder, phase, set_recorder
+from preplib.extract import binary_mounts, find_libraries, list_libraries
+from preplib.utils import container_session, parse_image_name, is_digest_like, is_digest_prefix_like
 
 # TODO: コンフィグファイルを作る / TUI でコンフィグをいじれるようにする
 #       コンフィグ内容: index の位置s / デフォルトの output / index を自動で clone および pull するか / index server の URLs
@@ -19,21 +25,46 @@ from preplib.utils import parse_image_name, is_digest_like
 
 # TODO: 複数の index を使うように（特にURL）
 # TODO: debuginfod で引っ張ってきたシンボルを使ってpatch
-# TODO: サーバーを使うようにする / サーバーの URL を configurable にする
 # TODO: ierae CTF で壊れたやつの調査
-LIBDIGESTINFO_SERVER = "https://key-moon.github.io/preplib-data"
 
-# TODO: extract .debug into the same directory
+# the subcommands, the remote index, the deltas and debuginfod are imported where they are used,
+# so that a plain lookup does not pay for their imports
 def main():
+  # `preplib serve` keeps the index in memory and answers the lookups of the other invocations
+  if sys.argv[1:2] == ["serve"]:
+    from preplib.server import serve_main
+    serve_main(sys.argv[2:])
+    return
+  # `preplib batch` handles a whole directory of challenges at once
+  if sys.argv[1:2] == ["batch"]:
+    from preplib.batch import batch_main
+    batch_main(sys.argv[2:])
+    return
+
   parser = ArgumentParser()
   parser.add_argument("--output", "-o", help="output directory", default="./lib")
   parser.add_argument("--binary", "-b", help="extract all of binary dependencies using ldd (exclusive to --libs)")
   parser.add_argument("--libs", "-l", nargs="*", help="specify library names to extract (exclusive to --binary)")
-  parser.add_argument("--index", action="store_true", help="index libraries in the specified image and exit")
+  parser.add_argument("--index", action="store_true", help="index libraries in the specified image and exit. docker://<name>, oci:<dir>[:<ref>] and docker-archive:<file>[:<ref>] are read from their layers without docker")
+  parser.add_argument("--symbols", "-s", nargs="+", help="find images by leaked symbol addresses, e.g. puts:e50 printf:6f0 (local index only)")
+  parser.add_argument("--list", action="store_true", help="list libraries in the image (from the index if it is indexed) and exit")
   parser.add_argument("--index-dir", nargs="?", help="index directory (default: user-cache-dir)", default=str(default_cache_dir))
+  parser.add_argument("--server", nargs="?", const=LIBDIGESTINFO_SERVER, help=f"look up the index shards on the server instead of --index-dir (default server: {LIBDIGESTINFO_SERVER})")
+  parser.add_argument("--no-daemon", action="store_true", help="do not query `preplib serve` even if it is running")
+  parser.add_argument("--migrate-index", action="store_true", help="convert the legacy one-file-per-digest index in --index-dir into the single-file store and exit")
+  parser.add_argument("--sync", nargs="?", const=LIBDIGESTINFO_SERVER, metavar="SOURCE", help=f"apply the index deltas published after the last sync into --index-dir and exit. SOURCE is a directory or a URL (default: {LIBDIGESTINFO_SERVER})")
+  parser.add_argument("--no-cache", action="store_true", help="do not use the local library and image metadata caches")
+  parser.add_argument("--cache-size", type=int, default=default_blob_cache_size // 1024 ** 2, help="size limit of the local library cache in MB (default: %(default)s)")
+  parser.add_argument("--debuginfo", "-g", action="store_true", help="also fetch the debug files of the extracted libraries from debuginfod into <output>/.debug")
+  parser.add_argument("--debuginfod", nargs="+", metavar="URL", help="debuginfod servers, asked in order (default: $DEBUGINFOD_URLS or the elfutils server)")
+  parser.add_argument("--debuginfo-jobs", type=int, default=8, help="debug files downloaded in parallel (default: %(default)s)")
+  parser.add_argument("--debuginfo-cache-size", type=int, help="size limit of the local debug file cache in MB (default: 4096)")
+  parser.add_argument("--profile", action="store_true", help="print the time spent in each phase, docker call and index operation on exit")
+  parser.add_argument("--profile-output", help="write the profile into this file (implies --profile)")
+  parser.add_argument("--profile-format", choices=["chrome", "json"], default="chrome", help="chrome: Trace Event Format for chrome://tracing or Perfetto, json: the breakdown and every span (default: %(default)s)")
   parser.add_argument("--verbose", "-v", action="store_true", help="enable verbose output")
   parser.add_argument("--quiet", "-q", action="store_true", help="enable quiet output")
-  parser.add_argument("image_or_libinfo", nargs="+", help="image tag(ubuntu:jammy) | library path(/path/to/libc.so.6) | build-id(89c3cb85...) | md5sum")
+  parser.add_argument("image_or_libinfo", nargs="*", help="image tag(ubuntu:jammy) | library path(/path/to/libc.so.6) | build-id(89c3cb85...) | md5sum | a prefix of either (8+ chars)")
 
   args = parser.parse_args()
   if args.verbose:
@@ -43,76 +74,139 @@ def main():
   else:
     logger.setLevel(logging.INFO)
 
+  if args.no_cache:
+    set_metadata_cache(None)
+
+  if args.profile or args.profile_output is not None:
+    recorder = Recorder()
+    set_recorder(recorder)
+    # also on exit(1), which is where a slow lookup usually ends
+    def report_profile():
+      recorder.phase(None)
+      recorder.print_breakdown()
+      if args.profile_output is not None:
+        recorder.dump(args.profile_output, args.profile_format)
+        logger.info(f"wrote the profile into {args.profile_output}")
+    atexit.register(report_profile)
+
+  if args.migrate_index:
+    migrate_legacy_index(args.index_dir, remove_legacy=True)
+    exit(0)
+
+  if args.sync is not None:
+    phase("sync")
+    from preplib.sync import sync_index
+    try:
+      sync_index(args.sync, args.index_dir)
+    except (ValueError, OSError) as e:
+      logger.error(f"failed to sync from {args.sync}: {e}")
+      exit(1)
+    exit(0)
+
+  # a clone of the data repository carries the manifests and symbols in its delta segments only, so they are applied
+  # when something reads them, and kept applied once there is a database
+  uses_manifests = args.symbols is not None or args.list or args.libs is not None or args.binary is not None or args.debuginfo
+  if args.server is None and os.path.exists(os.path.join(args.index_dir, "deltas", "manifest.json")) and (uses_manifests or LibIndex(args.index_dir).exists()):
+    phase("sync")
+    from preplib.sync import sync_local_deltas
+    try:
+      sync_local_deltas(args.index_dir)
+    except (ValueError, OSError) as e:
+      logger.warning(f"failed to apply the delta segments in {args.index_dir}: {e}")
+
+  if len(args.image_or_libinfo) == 0 and args.symbols is None:
+    parser.error("the following arguments are required: image_or_libinfo")
+
   if args.index:
-    index_image(args.image_or_libinfo[0], args.index_dir)
+    phase("index")
+    try:
+      index_image(args.image_or_libinfo[0], args.index_dir)
+    except (ValueError, OSError) as e:
+      # e.g. a registry or a layer that can not be read
+      logger.error(f"failed to index {args.image_or_libinfo[0]}: {e}")
+      exit(1)
     exit(0)
 
   outdir = args.output
 
   lib_paths = []
 
-  if len(args.image_or_libinfo) != 1 or os.path.exists(args.image_or_libinfo[0]) or is_digest_like(args.image_or_libinfo[0]):
+  if args.symbols is not None or len(args.image_or_libinfo) != 1 or os.path.exists(args.image_or_libinfo[0]) or is_digest_like(args.image_or_libinfo[0]) or is_digest_prefix_like(args.image_or_libinfo[0]):
     logger.info(f"searching images from indexed libraries...")
+    phase("lookup")
     image = None
-    candidate_images: Optional[dict[str, dict[str, str]]] = None
-    md5_digests = []
-    buildid_digests = []
+    targets: list[Target] = []
+    digest_table = None
+    if any(is_digest_prefix_target(str(val)) for val in args.image_or_libinfo):
+      if args.server is not None:
+        logger.error("hash prefixes are only completed from the local index. use --index-dir instead of --server")
+        exit(1)
+      digest_table = DigestTable.open(LibIndex(args.index_dir))
     for val in args.image_or_libinfo:
-      val = str(val)
-      if os.path.exists(val):
-        md5_digests.append((val, hashlib.md5(open(val, "rb").read()).hexdigest()))
-        try:
-          flag = False
-          # extract the line after the `NT_GNU_BUILD_ID`
-          for line in check_output(["readelf", "-n", val]).decode().splitlines():
-            if flag:
-              buildid_digests.append((val, line.split(": ")[-1].strip()))
-              break
-            else:
-              flag = "NT_GNU_BUILD_ID" in line
-        except:
-          pass
-      elif is_digest_like(val):
-        md5_digests.append((val, val))
-        buildid_digests.append((val, val))
-      else:
-        logger.error("invalid library file or hash", val)
+      try:
+        target = make_target(str(val), digest_table)
+      except AmbiguousDigestError as e:
+        logger.error(f"{e.prefix} matches more than one indexed hash:")
+        for digest in e.matches:
+          logger.error(f"- {digest}")
+        exit(1)
+      except ValueError as e:
+        logger.error(str(e))
+        exit(1)
+      if target is None:
+        logger.error(f"invalid library file or hash: {val}")
+        exit(1)
+      targets.append(target)
+
+    if args.symbols is not None:
+      if args.server is not None:
+        logger.error("symbols are only indexed locally. use --index-dir instead of --server")
+        exit(1)
+      try:
+        queries = [SymbolQuery.parse(query) for query in args.symbols]
+      except ValueError as e:
+        logger.error(str(e))
+        exit(1)
+      ranked = rank_symbol_matches(LibIndex(args.index_dir), queries)
+      # the libraries that have all of the symbols are one target, and the other targets narrow them down further
+      matched = [md5 for md5, offsets in ranked if len(offsets) == len(queries)]
+      if len(matched) == 0:
+        logger.error("no indexed library has all of the symbols")
+        for md5, offsets in ranked[:5]:
+          logger.warning(f"- {md5} has {', '.join(f'{query.name}@{offset:#x}' for query, offset in offsets.items())}")
+        exit(1)
+      for md5, offsets in ranked[:len(matched)]:
+        logger.debug(f"{md5}: {', '.join(f'{query.name}@{offset:#x}' for query, offset in offsets.items())}")
+      targets.append(Target(" ".join(args.symbols), matched))
 
-    lib_count = len(args.image_or_libinfo)
-    index = LibIndex(cache_dir=args.index_dir) # ここで直接index触ってるのかなりキモい
-    image_index = get_image_index(args.index_dir)
+    lookup = Lookup(args.index_dir, args.server, use_daemon=not args.no_daemon)
+    # manifests are only recorded in the local index
+    manifest_index = LibIndex(args.index_dir) if args.server is None else None
     def show_image(image_identifier: str, file_paths: dict[str, str], level=logging.INFO):
       repository, _, digest = parse_image_name(image_identifier)
-      tags = [f"\"{tag}\"" for tag in image_index.get(image_identifier)]
+      tags = [f"\"{tag}\"" for tag in lookup.tags(image_identifier)]
       tags_str = ", ".join(tags) if len(tags) <= 3 else ", ".join(tags[:3]) + "..."
+      manifest = { entry.path: entry for entry in manifest_index.load_manifest(digest) } if manifest_index is not None else {}
 
       logger.log(level, f"found in image \"{repository}\" once tagged as {tags_str} (image digest: {digest})")
       for val, path in file_paths.items():
-        logger.log(level, f"- {val} => {path}")
-
-    for digests, method in [(md5_digests, "md5"), (buildid_digests, "build_id")]:
-      if lib_count != len(digests): continue
-      candidate_images = find_suitable_images(digests, index)
-
-      candidates: list[tuple[str, dict[str, str]]] = []
-      for image_identifier, candidatess in candidate_images.items():
-        if len(candidatess) == lib_count:
-          candidates.append((image_identifier, candidatess))
-
-      if len(candidates) == 0:
-        logger.warning(f"no candidates found by {method}")
-        continue
-      elif len(candidates) == 1:
-        show_image(*candidates[0])
-        image = candidates[-1][0]
-        break
-      else:
-        logger.warning(f"multiple images contains the same libraries:")
-        for candidate in candidates:
-          show_image(*candidate, level=logging.WARNING)
-        logger.warning(f"for a now, use last(=usually latest) one") # TODO: affinityみたいなのを使う
-        image = candidates[-1][0]
-        break
+        entry = manifest.get(path)
+        if entry is not None:
+          logger.log(level, f"- {val} => {path} (soname: {entry.soname or '-'}, size: {entry.size})")
+        else:
+          logger.log(level, f"- {val} => {path}")
+
+    candidates = list(lookup.match(targets).items())
+
+    if len(candidates) == 1:
+      show_image(*candidates[0])
+      image = candidates[-1][0]
+    elif 2 <= len(candidates):
+      logger.warning(f"multiple images contains the same libraries:")
+      for candidate in candidates:
+        show_image(*candidate, level=logging.WARNING)
+      logger.warning(f"for a now, use last(=usually latest) one") # TODO: affinityみたいなのを使う
+      image = candidates[-1][0]
     if image is None:
       logger.error(f"no candidates found")
       exit(1)
@@ -120,32 +214,53 @@ def main():
     image = args.image_or_libinfo[0]
     logger.debug(f"use {image} as a image name")
 
-  if args.libs is not None:
-    def checker(name: str):
-      for lib in args.libs:
-        if name.startswith(lib):
-          return True
-    lib_paths += list(filter(checker, list_libraries(image)))
-  if args.binary is not None:
-    lib_paths = find_libraries(image, args.binary)
+  # ldd, the listing and the extraction below share one container of the image
+  with container_session(image, mounts=binary_mounts(args.binary)):
+    phase("libraries")
+    if args.list:
+      for entry in load_manifest(image, args.index_dir):
+        print("\t".join([entry.path, entry.soname or "-", entry.build_id or "-", entry.md5 or "-", str(entry.size)]))
+      exit(0)
+
+    if args.libs is not None:
+      def checker(path: str, soname: Optional[str]=None):
+        # "libc" matches /lib/x86_64-linux-gnu/libc.so.6 by its file name or soname
+        names = [path, os.path.basename(path)] + ([soname] if soname is not None else [])
+        return any(name.startswith(lib) for lib in args.libs for name in names)
+      manifest = find_manifest(image, args.index_dir)
+      if len(manifest) != 0:
+        lib_paths += [entry.path for entry in manifest if checker(entry.path, entry.soname)]
+      else:
+        lib_paths += list(filter(checker, list_libraries(image)))
+    if args.binary is not None:
+      lib_paths = find_binary_libraries(image, args.binary, args.index_dir)
 
-  if args.binary is None and args.libs is None:
-    lib_paths = find_libraries(image, None)
+    if args.binary is None and args.libs is None:
+      lib_paths = find_libraries(image, None)
 
-  if len(lib_paths) == 0:
-    logger.error("library not found")
-    exit(1)
+    if len(lib_paths) == 0:
+      logger.error("library not found")
+      exit(1)
 
-  lib_paths = list(set(lib_paths))
+    lib_paths = sorted(set(lib_paths))
 
-  logger.info(f"spawning container for image {image}...")
-  container_id = check_output(["docker", "run", "--rm", "-d", image, "sleep", "1000"]).strip().decode()
-  logger.info(f"spawned. {container_id=}")
+    phase("extract")
+    blob_cache = None if args.no_cache else BlobCache(size_limit=args.cache_size * 1024 ** 2)
+    extract_libraries_cached(image, lib_paths, outdir, blob_cache)
 
-  Path(outdir).mkdir(exist_ok=True)
-  for lib_path in lib_paths:
-    logger.debug(f"cp {container_id}:{lib_path} -> {outdir}")
-    check_output(["docker", "cp", "-L", f"{container_id}:{lib_path}", outdir]).strip().decode()
+    if args.debuginfo:
+      phase("debuginfo")
+      from preplib.debuginfo import DebugInfoCache, debuginfod_urls, fetch_debuginfo, library_build_ids
+      build_ids = library_build_ids(lib_paths, outdir, find_manifest(image, args.index_dir))
+      debug_cache = None
+      if not args.no_cache:
+        debug_cache = DebugInfoCache() if args.debuginfo_cache_size is None else DebugInfoCache(size_limit=args.debuginfo_cache_size * 1024 ** 2)
+      fetched = fetch_debuginfo(list(build_ids.values()), outdir, args.debuginfod or debuginfod_urls(), debug_cache, args.debuginfo_jobs)
+      for lib_path, build_id in build_ids.items():
+        if fetched[build_id] is None:
+          logger.warning(f"no debug file found for {lib_path} (build-id: {build_id})")
+      found = sum(path is not None for path in fetched.values())
+      logger.info(f"placed {found} debug files into {os.path.join(outdir, '.debug')}. use them with `set debug-file-directory {os.path.join(outdir, '.debug')}` in gdb")
 
 if __name__ == "__main__":
   main()
@@ -0,0 +1,57 @@
+import json
+import os
+from os import PathLike
+from pathlib import Path
+import tempfile
+import threading
+from typing import Any, Optional, Union
+import appdirs
+
+from preplib.logger import logger
+
+default_metadata_cache_dir = Path(appdirs.user_cache_dir("extract-lib-meta"))
+
+# images/<image digest>.json: {<kind>: {<key>: <value>}}. everything under an image digest never changes.
+# tags are not cached: a tag moves to another digest on `docker pull`, so it is resolved by `docker inspect` every run
+class MetadataCache:
+  def __init__(self, cache_dir: Union[PathLike, str]=default_metadata_cache_dir):
+    self.cache_dir = Path(cache_dir)
+    self._lock = threading.Lock()
+
+  def _write_json(self, path: Path, value: Any):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    # other preplib processes may read it at the same time
+    with tempfile.NamedTemporaryFile("w", dir=path.parent, delete=False) as f:
+      f.write(json.dumps(value))
+    os.replace(f.name, path)
+
+  def _read_json(self, path: Path) -> dict[str, Any]:
+    if not path.exists(): return {}
+    try:
+      return json.loads(path.read_text())
+    except ValueError:
+      logger.debug(f"corrupt metadata cache: {path}")
+      return {}
+
+  def _get_image_path(self, image_digest: str):
+    return self.cache_dir / "images" / f"{image_digest.replace(':', '_')}.json"
+
+  def get(self, image_digest: str, kind: str, key: str="") -> Optional[Any]:
+    return self._read_json(self._get_image_path(image_digest)).get(kind, {}).get(key)
+
+  def put(self, image_digest: str, kind: str, key: str, value: Any):
+    with self._lock:
+      path = self._get_image_path(image_digest)
+      entries = self._read_json(path)
+      entries.setdefault(kind, {})[key] = value
+      self._write_json(path, entries)
+
+_metadata_cache: Optional[MetadataCache] = MetadataCache()
+
+def get_metadata_cache():
+  return _metadata_cache
+
+# None disables the cache, e.g. for the indexer, which must see the tags as they are now
+def set_metadata_cache(cache: Optional[MetadataCache]):
+  global _metadata_cache
+  _metadata_cache = cache
@@ -0,0 +1,150 @@
+from array import array
+from bisect import bisect_left
+from typing import Iterable, NamedTuple, Optional, Protocol, Tuple
+
+from preplib.index import LibIndexLike, LibInfo
+from preplib.logger import logger
+from preplib.timing import traced
+
+class Target(NamedTuple):
+  # the argument the user gave (file path or digest)
+  key: str
+  # md5 / build-id of the target. an image matches if it has any of them
+  digests: list[str]
+
+class SymbolQuery(NamedTuple):
+  name: str
+  # libraries are mapped at page boundaries, so the low 12 bits of a leaked address are the ones of the offset
+  low12: int
+
+  # <name>:<hex address or offset>, e.g. puts:e50 or puts:0x7f1234567e50
+  @classmethod
+  def parse(cls, query: str):
+    name, _, address = query.rpartition(":")
+    if name == "":
+      raise ValueError(f"invalid symbol query (expected <name>:<hex address>): {query}")
+    return cls(name, int(address, 16) & 0xfff)
+
+class SymbolIndexLike(Protocol):
+  def find_symbol(self, name: str, low12: int) -> list[Tuple[str, int]]: ...
+
+# libraries (by md5) ranked by the number of queries they satisfy, best first, with the matched offsets
+@traced("index")
+def rank_symbol_matches(index: SymbolIndexLike, queries: list[SymbolQuery]) -> list[Tuple[str, dict[SymbolQuery, int]]]:
+  matched: dict[str, dict[SymbolQuery, int]] = {}
+  for query in queries:
+    for md5, offset in index.find_symbol(query.name, query.low12):
+      matched.setdefault(md5, {}).setdefault(query, offset)
+  logger.debug(f"{len(matched)} libraries match some of {queries}")
+  return sorted(matched.items(), key=lambda item: len(item[1]), reverse=True)
+
+class Posting(NamedTuple):
+  # sorted image ids and the interned path of the library in each image
+  image_ids: array
+  path_ids: array
+
+def _intersect(small: array, large: array) -> array:
+  res = array("I")
+  lo = 0
+  for image_id in small:
+    lo = bisect_left(large, image_id, lo)
+    if lo == len(large): break
+    if large[lo] == image_id:
+      res.append(image_id)
+  return res
+
+# image identifiers and paths are interned to integers, and each digest maps to a sorted array of image ids
+class InvertedIndex:
+  def __init__(self):
+    self.images: list[str] = []
+    self._image_ids: dict[str, int] = {}
+    self.paths: list[str] = []
+    self._path_ids: dict[str, int] = {}
+    self.postings: dict[str, Posting] = {}
+
+  def _intern_image(self, image_identifier: str):
+    image_id = self._image_ids.get(image_identifier)
+    if image_id is None:
+      image_id = self._image_ids[image_identifier] = len(self.images)
+      self.images.append(image_identifier)
+    return image_id
+
+  def _intern_path(self, path: str):
+    path_id = self._path_ids.get(path)
+    if path_id is None:
+      path_id = self._path_ids[path] = len(self.paths)
+      self.paths.append(path)
+    return path_id
+
+  # postings are replaced rather than modified by add_rows, so a copy shares them with the original
+  def copy(self):
+    res = InvertedIndex()
+    res.images = self.images.copy()
+    res._image_ids = self._image_ids.copy()
+    res.paths = self.paths.copy()
+    res._path_ids = self._path_ids.copy()
+    res.postings = self.postings.copy()
+    return res
+
+  def add_rows(self, rows: Iterable[Tuple[str, LibInfo]]):
+    pending: dict[str, dict[int, int]] = {}
+    for digest, info in rows:
+      entries = pending.get(digest)
+      if entries is None:
+        entries = pending[digest] = {}
+        posting = self.postings.get(digest)
+        if posting is not None:
+          entries.update(zip(posting.image_ids, posting.path_ids))
+      # an image may have the same file in several paths (e.g. libc.so.6 -> libc-2.31.so). the first one is kept
+      entries.setdefault(self._intern_image(info.image_identifier), self._intern_path(info.path))
+    for digest, entries in pending.items():
+      image_ids = sorted(entries)
+      self.postings[digest] = Posting(array("I", image_ids), array("I", (entries[image_id] for image_id in image_ids)))
+
+  @classmethod
+  @traced("index")
+  def from_lib_index(cls, index: LibIndexLike, digests: Optional[list[str]]=None):
+    res = cls()
+    if digests is None:
+      # iter_all is only available on the local index
+      res.add_rows(index.iter_all()) # type: ignore
+    else:
+      loaded = index.load_many(digests)
+      res.add_rows((digest, info) for digest in digests for info in loaded[digest])
+    return res
+
+  def _target_posting(self, target: Target) -> Posting:
+    postings = [self.postings[digest] for digest in target.digests if digest in self.postings]
+    if len(postings) == 1:
+      return postings[0]
+    # md5 and build-id of a file usually point to the same images, merge them
+    entries: dict[int, int] = {}
+    for posting in postings:
+      for image_id, path_id in zip(posting.image_ids, posting.path_ids):
+        entries.setdefault(image_id, path_id)
+    image_ids = sorted(entries)
+    return Posting(array("I", image_ids), array("I", (entries[image_id] for image_id in image_ids)))
+
+  # returns {image identifier: {target key: path}} of the images that contain all of the targets
+  @traced("index")
+  def match(self, targets: list[Target]) -> dict[str, dict[str, str]]:
+    if len(targets) == 0:
+      return {}
+    postings = [(target, self._target_posting(target)) for target in targets]
+    # start from the rarest target, so that the candidates shrink as early as possible
+    postings.sort(key=lambda posting: len(posting[1].image_ids))
+    candidates = postings[0][1].image_ids
+    for _, posting in postings[1:]:
+      if len(candidates) == 0: break
+      candidates = _intersect(candidates, posting.image_ids)
+    logger.debug(f"{len(candidates)} images contain all of {[target.key for target in targets]}")
+
+    res: dict[str, dict[str, str]] = {}
+    for image_id in candidates:
+      files: dict[str, str] = {}
+      for target, posting in postings:
+        pos = bisect_left(posting.image_ids, image_id)
+        files[target.key] = self.paths[posting.path_ids[pos]]
+      # keep the argument order for display
+      res[self.images[image_id]] = { target.key: files[target.key] for target in targets }
+    return res
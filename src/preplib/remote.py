@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+import tempfile
+import time
+from typing import Any, Iterable, Optional, Union
+from urllib.error import HTTPError
+from urllib.request import Request, urlopen
+
+from preplib.index import ImageIndex, LibIndex, LibInfo, default_cache_dir
+from preplib.logger import logger
+from preplib.timing import span
+
+# layout under the server (and the directory written by export_shards):
+#   shards/meta.json                  {"version": 1, "lib_prefix_length": 3, "image_prefix_length": 2}
+#   shards/libs/<digest prefix>.json  {<digest>: [[image_name, image_digest, path], ...]}
+#   shards/images/<prefix>.json       {<image@digest>: [tags...]}, grouped by the prefix of the image digest
+SHARD_FORMAT_VERSION = 1
+default_remote_cache_dir = default_cache_dir.with_name(default_cache_dir.name + "-remote")
+
+def image_shard_key(image_identifier: str, prefix_length: int):
+  image_digest = image_identifier.rsplit("@", maxsplit=1)[-1]
+  return image_digest.split(":")[-1][:prefix_length]
+
+def _write_if_changed(path: Path, content: str):
+  # unchanged shards are left untouched, so that the published tree only changes where the index did
+  if path.exists() and path.read_text() == content:
+    return False
+  path.parent.mkdir(parents=True, exist_ok=True)
+  path.write_text(content)
+  return True
+
+def export_shards(index_dir: Union[PathLike, str], out_dir: Union[PathLike, str], lib_prefix_length=3, image_prefix_length=2):
+  out_dir = Path(out_dir)
+  lib_shards: dict[str, dict[str, list[list[str]]]] = {}
+  for digest, info in LibIndex(index_dir).iter_all():
+    lib_shards.setdefault(digest[:lib_prefix_length], {}).setdefault(digest, []).append(list(info))
+  image_shards: dict[str, dict[str, list[str]]] = {}
+  for image_identifier, tags in ImageIndex(index_dir).load().items():
+    image_shards.setdefault(image_shard_key(image_identifier, image_prefix_length), {})[image_identifier] = tags
+
+  changed = 0
+  for kind, shards in [("libs", lib_shards), ("images", image_shards)]:
+    for prefix, shard in shards.items():
+      changed += _write_if_changed(out_dir / kind / f"{prefix}.json", json.dumps(shard, sort_keys=True))
+    # drop the shards that no longer exist
+    if (out_dir / kind).is_dir():
+      for path in (out_dir / kind).iterdir():
+        if path.stem not in shards:
+          path.unlink()
+          changed += 1
+  _write_if_changed(out_dir / "meta.json", json.dumps({
+    "version": SHARD_FORMAT_VERSION,
+    "lib_prefix_length": lib_prefix_length,
+    "image_prefix_length": image_prefix_length,
+  }))
+  logger.info(f"exported {len(lib_shards)} library shards and {len(image_shards)} image shards ({changed} changed) into {out_dir}")
+
+class RemoteIndexClient:
+  # shards are cached under cache_dir. within `ttl` seconds they are used as is, then revalidated with ETag
+  def __init__(self, base_url: str, cache_dir: Union[PathLike, str]=default_remote_cache_dir, ttl: float=60 * 60, jobs=8):
+    self.base_url = base_url.rstrip("/")
+    self.cache_dir = Path(cache_dir) / hashlib.sha256(self.base_url.encode()).hexdigest()[:16]
+    self.ttl = ttl
+    self.jobs = jobs
+    self._meta: Optional[dict[str, Any]] = None
+
+  def _cache_paths(self, rel_path: str):
+    path = self.cache_dir / rel_path
+    return path, path.with_name(path.name + ".meta")
+
+  def fetch_json(self, rel_path: str) -> Optional[Any]:
+    body_path, meta_path = self._cache_paths(rel_path)
+    meta = None
+    if meta_path.exists() and body_path.exists():
+      try:
+        meta = json.loads(meta_path.read_text())
+      except ValueError:
+        meta = None
+    if meta is not None and time.time() - meta["fetched_at"] < self.ttl:
+      return json.loads(body_path.read_text()) if meta["found"] else None
+
+    url = f"{self.base_url}/{rel_path}"
+    request = Request(url)
+    if meta is not None and meta.get("etag"):
+      request.add_header("If-None-Match", meta["etag"])
+    logger.debug(f"fetching {url}...")
+    try:
+      with span("remote", "fetch", url=url) as span_args, urlopen(request, timeout=30) as res:
+        body = res.read()
+        etag = res.headers.get("ETag")
+        span_args["bytes_read"] = len(body)
+      found = True
+    except HTTPError as e:
+      if e.code == 304 and meta is not None:
+        body = body_path.read_bytes()
+        etag = meta.get("etag")
+        found = meta["found"]
+      elif e.code == 404:
+        # a shard without any entry is not published
+        body, etag, found = b"", None, False
+      else:
+        raise
+
+    body_path.parent.mkdir(parents=True, exist_ok=True)
+    with tempfile.NamedTemporaryFile(dir=body_path.parent, delete=False) as f:
+      f.write(body)
+    os.replace(f.name, body_path)
+    meta_path.write_text(json.dumps({ "etag": etag, "found": found, "fetched_at": time.time() }))
+    return json.loads(body) if found else None
+
+  def fetch_many(self, rel_paths: Iterable[str]) -> dict[str, Optional[Any]]:
+    rel_paths = list(set(rel_paths))
+    if len(rel_paths) <= 1:
+      return { rel_path: self.fetch_json(rel_path) for rel_path in rel_paths }
+    with ThreadPoolExecutor(min(self.jobs, len(rel_paths))) as executor:
+      return dict(zip(rel_paths, executor.map(self.fetch_json, rel_paths)))
+
+  def meta(self) -> dict[str, Any]:
+    if self._meta is None:
+      meta = self.fetch_json("shards/meta.json")
+      if meta is None:
+        raise ValueError(f"no index shards found on {self.base_url}")
+      if meta.get("version") != SHARD_FORMAT_VERSION:
+        raise ValueError(f"unsupported shard format version: {meta.get('version')}")
+      self._meta = meta
+    return self._meta
+
+class RemoteLibIndex:
+  def __init__(self, client: RemoteIndexClient):
+    self.client = client
+
+  def _shard_path(self, digest: str):
+    return f"shards/libs/{digest[:self.client.meta()['lib_prefix_length']]}.json"
+
+  def load(self, digest: str) -> list[LibInfo]:
+    return self.load_many([digest])[digest]
+
+  def load_many(self, digests: list[str]) -> dict[str, list[LibInfo]]:
+    shards = self.client.fetch_many(self._shard_path(digest) for digest in digests)
+    res = {}
+    for digest in digests:
+      shard = shards[self._shard_path(digest)] or {}
+      res[digest] = [LibInfo(*info) for info in shard.get(digest, [])]
+    return res
+
+class RemoteImageIndex:
+  def __init__(self, client: RemoteIndexClient):
+    self.client = client
+
+  def _shard_path(self, image_name: str):
+    return f"shards/images/{image_shard_key(image_name, self.client.meta()['image_prefix_length'])}.json"
+
+  def get(self, image_name: str) -> list[str]:
+    return self.get_many([image_name])[image_name]
+
+  def get_many(self, image_names: list[str]) -> dict[str, list[str]]:
+    shards = self.client.fetch_many(self._shard_path(image_name) for image_name in image_names)
+    return { image_name: (shards[self._shard_path(image_name)] or {}).get(image_name, []) for image_name in image_names }
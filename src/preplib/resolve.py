@@ -0,0 +1,126 @@
+from collections import deque
+import os
+from os import PathLike
+import posixpath
+from typing import Optional, Union
+
+from preplib.elf import ElfError, ElfFile
+from preplib.extract import BINARY_PATH_IN_IMAGE, find_libraries
+from preplib.index import ManifestEntry, default_cache_dir, find_manifest
+from preplib.logger import logger
+from preplib.timing import traced
+
+# searched by ld.so after DT_RPATH, DT_RUNPATH and ld.so.cache
+DEFAULT_LIBRARY_DIRS = ["/lib", "/usr/lib", "/lib64", "/usr/lib64"]
+
+def expand_search_path(search_path: Optional[str], origin: str) -> list[str]:
+  if not search_path:
+    return []
+  res = []
+  for d in search_path.split(":"):
+    if d == "": continue
+    d = d.replace("${ORIGIN}", origin).replace("$ORIGIN", origin)
+    res.append(posixpath.normpath(d))
+  return res
+
+class ManifestResolver:
+  def __init__(self, manifest: list[ManifestEntry]):
+    self.by_path: dict[str, ManifestEntry] = {}
+    # file name or soname -> entries, in the order of `ldconfig -p` (= ld.so.cache)
+    self.by_name: dict[str, list[ManifestEntry]] = {}
+    for entry in manifest:
+      self.by_path[entry.path] = entry
+      names = { posixpath.basename(entry.path) }
+      if entry.soname is not None:
+        names.add(entry.soname)
+      for name in names:
+        self.by_name.setdefault(name, []).append(entry)
+
+  def _find_in_dirs(self, name: str, dirs: list[str], arch: str) -> Optional[ManifestEntry]:
+    for d in dirs:
+      entry = self.by_path.get(posixpath.join(d, name))
+      if entry is not None and entry.arch in (arch, None):
+        return entry
+    return None
+
+  def find(self, name: str, arch: str, search_dirs: list[str]) -> Optional[ManifestEntry]:
+    if "/" in name:
+      return self.by_path.get(name)
+    entry = self._find_in_dirs(name, search_dirs, arch)
+    if entry is not None:
+      return entry
+    # ld.so.cache, which is where the manifest comes from
+    for entry in self.by_name.get(name, []):
+      if entry.arch in (arch, None) and posixpath.basename(entry.path) == name:
+        return entry
+    entry = self._find_in_dirs(name, DEFAULT_LIBRARY_DIRS, arch)
+    if entry is not None:
+      return entry
+    # musl images are listed from /lib and /usr/lib by file name, which may differ from the soname
+    return next((entry for entry in self.by_name.get(name, []) if entry.arch in (arch, None)), None)
+
+# the same paths as find_libraries would return, resolved from the image manifest on the host.
+# returns None if the manifest does not have enough data to resolve every dependency
+@traced("resolve")
+def resolve_libraries(binary_path: Union[PathLike, str], manifest: list[ManifestEntry]) -> Optional[list[str]]:
+  with ElfFile.open(binary_path) as elf:
+    info = elf.info()
+    arch = f"{64 if elf.is64 else 32}-{elf.machine}"
+  resolver = ManifestResolver(manifest)
+
+  lib_paths: list[str] = []
+  loaded: set[str] = set()
+  loaded_paths: set[str] = set()
+  if info.interp is not None:
+    interp = resolver.find(info.interp, arch, []) or resolver.find(posixpath.basename(info.interp), arch, [])
+    if interp is None:
+      logger.debug(f"loader {info.interp} is not in the manifest")
+      return None
+    # the loader is extracted by the path the binary asks for, as ldd reports it.
+    # libc needs it again by its soname, which is the same object
+    lib_paths.append(info.interp)
+    loaded.add(posixpath.basename(info.interp))
+    if interp.soname is not None:
+      loaded.add(interp.soname)
+    loaded_paths.add(interp.path)
+
+  # each dependency is searched in the DT_RPATH of the requesting object and its loaders, unless the
+  # requesting object has DT_RUNPATH, and then in the DT_RUNPATH of the requesting object
+  origin = posixpath.dirname(BINARY_PATH_IN_IMAGE)
+  rpaths = expand_search_path(info.rpath, origin)
+  runpath = expand_search_path(info.runpath, origin) if info.runpath is not None else None
+  queue = deque((name, rpaths, runpath) for name in info.needed)
+  while len(queue) != 0:
+    name, rpaths, runpath = queue.popleft()
+    # ld.so loads each soname once
+    if name in loaded: continue
+    entry = resolver.find(name, arch, (rpaths if runpath is None else []) + (runpath or []))
+    if entry is None or entry.needed is None:
+      logger.debug(f"{name} is not resolvable from the manifest")
+      return None
+    loaded.add(name)
+    if entry.soname is not None:
+      loaded.add(entry.soname)
+    if entry.path in loaded_paths: continue
+    loaded_paths.add(entry.path)
+    lib_paths.append(entry.path)
+
+    lib_origin = posixpath.dirname(entry.path)
+    child_rpaths = expand_search_path(entry.rpath, lib_origin) + rpaths
+    child_runpath = expand_search_path(entry.runpath, lib_origin) if entry.runpath is not None else None
+    for child in entry.needed:
+      queue.append((child, child_rpaths, child_runpath))
+  logger.debug(f"resolved {len(lib_paths)} libraries of {os.path.basename(binary_path)} from the manifest")
+  return lib_paths
+
+# resolved on the host from the index if possible, without running the binary's loader in a container
+def find_binary_libraries(image_name: str, binary_path: Union[PathLike, str], index_dir: Union[PathLike, str]=default_cache_dir) -> list[str]:
+  manifest = find_manifest(image_name, index_dir)
+  if len(manifest) != 0:
+    try:
+      resolved = resolve_libraries(binary_path, manifest)
+      if resolved is not None:
+        return resolved
+    except (ElfError, ValueError) as e:
+      logger.debug(f"failed to read {binary_path}: {e}")
+  return find_libraries(image_name, binary_path)
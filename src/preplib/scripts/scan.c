@@ -0,0 +1,955 @@
+// gcc -nostdlib -static -O2 -fno-builtin -fno-stack-protector -o scan scan.c
+//
+// usage: scan [-t build-id,md5,sha1,sha256,sha512,symbols] [-y name,...] [-] [file or directory]...
+//   -y          only report these symbols (default: every defined function and object)
+//   -           read `ldconfig -p` output (or one path per line) from stdin
+//   directory   scan regular files whose name contains ".so" (not recursive)
+//   file        scan the file
+//
+// every ELF file is mapped and read once, and one record is written per path:
+//   build-id=<hex>\tmd5=<hex>\t...\tsize=<bytes>\tarch=<class>-<e_machine>\tsoname=<DT_SONAME>\t
+//   needed=<DT_NEEDED>,...\trpath=<DT_RPATH>\trunpath=<DT_RUNPATH>\t<path>\n
+// soname, rpath and runpath are omitted for the files without them.
+// with the symbols type, the first record of each file is followed by its .dynsym entries:
+//   sym\t<st_value hex>\t<name>\n
+typedef unsigned long long uint64_t;
+typedef long long int64_t;
+typedef unsigned int uint32_t;
+typedef unsigned short uint16_t;
+typedef unsigned char uint8_t;
+typedef unsigned long size_t;
+
+#define SYS_read 0
+#define SYS_write 1
+#define SYS_open 2
+#define SYS_close 3
+#define SYS_fstat 5
+#define SYS_lstat 6
+#define SYS_mmap 9
+#define SYS_munmap 11
+#define SYS_exit 60
+#define SYS_getdents64 217
+
+#define O_RDONLY 0
+#define O_DIRECTORY 0200000
+
+#define PROT_READ 1
+#define PROT_WRITE 2
+#define MAP_PRIVATE 2
+#define MAP_ANONYMOUS 0x20
+
+#define S_IFMT 0170000
+#define S_IFREG 0100000
+
+#define DT_UNKNOWN 0
+#define DT_REG 8
+
+static inline long syscall6(long n, long a1, long a2, long a3, long a4, long a5, long a6) {
+    long ret;
+    register long r10 __asm__("r10") = a4;
+    register long r8 __asm__("r8") = a5;
+    register long r9 __asm__("r9") = a6;
+    __asm__ volatile (
+        "syscall"
+        : "=a" (ret)
+        : "a" (n), "D" (a1), "S" (a2), "d" (a3), "r" (r10), "r" (r8), "r" (r9)
+        : "rcx", "r11", "memory"
+    );
+    return ret;
+}
+
+static inline long syscall(long n, long a1, long a2, long a3) {
+    return syscall6(n, a1, a2, a3, 0, 0, 0);
+}
+
+// gcc may emit calls to these even with -fno-builtin
+void *memset(void *dst, int c, size_t n) {
+    uint8_t *d = dst;
+    while (n--) *d++ = (uint8_t)c;
+    return dst;
+}
+
+void *memcpy(void *dst, const void *src, size_t n) {
+    uint8_t *d = dst;
+    const uint8_t *s = src;
+    while (n--) *d++ = *s++;
+    return dst;
+}
+
+static void exit_(int code) {
+    syscall(SYS_exit, code, 0, 0);
+    __builtin_unreachable();
+}
+
+static long open_(const char *path, long flags) {
+    return syscall(SYS_open, (long)path, flags, 0);
+}
+
+static long read_(int fd, void *buf, size_t count) {
+    return syscall(SYS_read, fd, (long)buf, count);
+}
+
+static void close_(int fd) {
+    syscall(SYS_close, fd, 0, 0);
+}
+
+static void *mmap_(void *addr, size_t len, long prot, long flags, long fd, long off) {
+    return (void *)syscall6(SYS_mmap, (long)addr, len, prot, flags, fd, off);
+}
+
+static void munmap_(void *addr, size_t len) {
+    syscall(SYS_munmap, (long)addr, len, 0);
+}
+
+static int is_mmap_error(void *p) {
+    return (unsigned long)p > -4096UL;
+}
+
+static size_t strlen_(const char *s) {
+    size_t len = 0;
+    while (s[len]) len++;
+    return len;
+}
+
+static int streq(const char *a, const char *b) {
+    while (*a && *a == *b) { a++; b++; }
+    return *a == *b;
+}
+
+static int contains(const char *s, const char *needle) {
+    size_t n = strlen_(needle);
+    for (; *s; s++) {
+        size_t i = 0;
+        while (i < n && s[i] == needle[i]) i++;
+        if (i == n) return 1;
+    }
+    return 0;
+}
+
+// struct stat of x86-64
+struct stat_ {
+    uint64_t st_dev;
+    uint64_t st_ino;
+    uint64_t st_nlink;
+    uint32_t st_mode;
+    uint32_t st_uid;
+    uint32_t st_gid;
+    uint32_t pad0;
+    uint64_t st_rdev;
+    int64_t st_size;
+    int64_t st_blksize;
+    int64_t st_blocks;
+    uint64_t st_time[6];
+    int64_t reserved[3];
+};
+
+// buffered stdout
+
+static char out_buf[1 << 16];
+static size_t out_len = 0;
+
+static void flush_out(void) {
+    size_t off = 0;
+    while (off < out_len) {
+        long n = syscall(SYS_write, 1, (long)(out_buf + off), out_len - off);
+        if (n <= 0) exit_(2);
+        off += n;
+    }
+    out_len = 0;
+}
+
+static void out_write(const char *s, size_t len) {
+    while (len) {
+        if (out_len == sizeof(out_buf)) flush_out();
+        size_t n = sizeof(out_buf) - out_len;
+        if (len < n) n = len;
+        memcpy(out_buf + out_len, s, n);
+        out_len += n;
+        s += n;
+        len -= n;
+    }
+}
+
+static void out_str(const char *s) {
+    out_write(s, strlen_(s));
+}
+
+static const char hex_table[] = "0123456789abcdef";
+
+// hash functions
+
+static uint32_t rol32(uint32_t x, int n) { return (x << n) | (x >> (32 - n)); }
+static uint32_t ror32(uint32_t x, int n) { return (x >> n) | (x << (32 - n)); }
+static uint64_t ror64(uint64_t x, int n) { return (x >> n) | (x << (64 - n)); }
+
+static uint32_t load_le32(const uint8_t *p) {
+    return (uint32_t)p[0] | ((uint32_t)p[1] << 8) | ((uint32_t)p[2] << 16) | ((uint32_t)p[3] << 24);
+}
+
+static uint32_t load_be32(const uint8_t *p) {
+    return ((uint32_t)p[0] << 24) | ((uint32_t)p[1] << 16) | ((uint32_t)p[2] << 8) | (uint32_t)p[3];
+}
+
+static uint64_t load_be64(const uint8_t *p) {
+    return ((uint64_t)load_be32(p) << 32) | load_be32(p + 4);
+}
+
+static void store_le32(uint8_t *p, uint32_t v) {
+    for (int i = 0; i < 4; i++) p[i] = v >> (8 * i);
+}
+
+static void store_be32(uint8_t *p, uint32_t v) {
+    for (int i = 0; i < 4; i++) p[i] = v >> (24 - 8 * i);
+}
+
+static void store_be64(uint8_t *p, uint64_t v) {
+    for (int i = 0; i < 8; i++) p[i] = v >> (56 - 8 * i);
+}
+
+// feeds `data` followed by the Merkle-Damgard padding into `block_fn`
+static void md_hash(const uint8_t *data, uint64_t len, size_t block_size, int big_endian,
+                    void (*block_fn)(void *, const uint8_t *), void *state) {
+    uint64_t i = 0;
+    for (; i + block_size <= len; i += block_size) block_fn(state, data + i);
+
+    uint8_t tail[256];
+    size_t rest = len - i;
+    size_t len_size = block_size == 128 ? 16 : 8;
+    size_t tail_len = rest + 1 + len_size <= block_size ? block_size : block_size * 2;
+    memset(tail, 0, tail_len);
+    memcpy(tail, data + i, rest);
+    tail[rest] = 0x80;
+    uint64_t bits = len << 3;
+    if (big_endian) store_be64(tail + tail_len - 8, bits);
+    else {
+        store_le32(tail + tail_len - 8, (uint32_t)bits);
+        store_le32(tail + tail_len - 4, (uint32_t)(bits >> 32));
+    }
+    for (size_t j = 0; j < tail_len; j += block_size) block_fn(state, tail + j);
+}
+
+static const uint32_t md5_k[64] = {
+    0xd76aa478, 0xe8c7b756, 0x242070db, 0xc1bdceee, 0xf57c0faf, 0x4787c62a, 0xa8304613, 0xfd469501,
+    0x698098d8, 0x8b44f7af, 0xffff5bb1, 0x895cd7be, 0x6b901122, 0xfd987193, 0xa679438e, 0x49b40821,
+    0xf61e2562, 0xc040b340, 0x265e5a51, 0xe9b6c7aa, 0xd62f105d, 0x02441453, 0xd8a1e681, 0xe7d3fbc8,
+    0x21e1cde6, 0xc33707d6, 0xf4d50d87, 0x455a14ed, 0xa9e3e905, 0xfcefa3f8, 0x676f02d9, 0x8d2a4c8a,
+    0xfffa3942, 0x8771f681, 0x6d9d6122, 0xfde5380c, 0xa4beea44, 0x4bdecfa9, 0xf6bb4b60, 0xbebfbc70,
+    0x289b7ec6, 0xeaa127fa, 0xd4ef3085, 0x04881d05, 0xd9d4d039, 0xe6db99e5, 0x1fa27cf8, 0xc4ac5665,
+    0xf4292244, 0x432aff97, 0xab9423a7, 0xfc93a039, 0x655b59c3, 0x8f0ccc92, 0xffeff47d, 0x85845dd1,
+    0x6fa87e4f, 0xfe2ce6e0, 0xa3014314, 0x4e0811a1, 0xf7537e82, 0xbd3af235, 0x2ad7d2bb, 0xeb86d391,
+};
+
+static const int md5_r[64] = {
+    7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22, 7, 12, 17, 22,
+    5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20, 5, 9, 14, 20,
+    4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23, 4, 11, 16, 23,
+    6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21, 6, 10, 15, 21,
+};
+
+static void md5_block(void *state, const uint8_t *block) {
+    uint32_t *h = state;
+    uint32_t w[16];
+    for (int i = 0; i < 16; i++) w[i] = load_le32(block + i * 4);
+    uint32_t a = h[0], b = h[1], c = h[2], d = h[3];
+    for (int i = 0; i < 64; i++) {
+        uint32_t f;
+        int g;
+        if (i < 16) { f = (b & c) | (~b & d); g = i; }
+        else if (i < 32) { f = (d & b) | (~d & c); g = (5 * i + 1) & 15; }
+        else if (i < 48) { f = b ^ c ^ d; g = (3 * i + 5) & 15; }
+        else { f = c ^ (b | ~d); g = (7 * i) & 15; }
+        uint32_t tmp = d;
+        d = c;
+        c = b;
+        b = b + rol32(a + f + md5_k[i] + w[g], md5_r[i]);
+        a = tmp;
+    }
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d;
+}
+
+static void md5(const uint8_t *data, uint64_t len, uint8_t *out) {
+    uint32_t h[4] = { 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476 };
+    md_hash(data, len, 64, 0, md5_block, h);
+    for (int i = 0; i < 4; i++) store_le32(out + i * 4, h[i]);
+}
+
+static void sha1_block(void *state, const uint8_t *block) {
+    uint32_t *h = state;
+    uint32_t w[80];
+    for (int i = 0; i < 16; i++) w[i] = load_be32(block + i * 4);
+    for (int i = 16; i < 80; i++) w[i] = rol32(w[i - 3] ^ w[i - 8] ^ w[i - 14] ^ w[i - 16], 1);
+    uint32_t a = h[0], b = h[1], c = h[2], d = h[3], e = h[4];
+    for (int i = 0; i < 80; i++) {
+        uint32_t f, k;
+        if (i < 20) { f = (b & c) | (~b & d); k = 0x5a827999; }
+        else if (i < 40) { f = b ^ c ^ d; k = 0x6ed9eba1; }
+        else if (i < 60) { f = (b & c) | (b & d) | (c & d); k = 0x8f1bbcdc; }
+        else { f = b ^ c ^ d; k = 0xca62c1d6; }
+        uint32_t tmp = rol32(a, 5) + f + e + k + w[i];
+        e = d;
+        d = c;
+        c = rol32(b, 30);
+        b = a;
+        a = tmp;
+    }
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d; h[4] += e;
+}
+
+static void sha1(const uint8_t *data, uint64_t len, uint8_t *out) {
+    uint32_t h[5] = { 0x67452301, 0xefcdab89, 0x98badcfe, 0x10325476, 0xc3d2e1f0 };
+    md_hash(data, len, 64, 1, sha1_block, h);
+    for (int i = 0; i < 5; i++) store_be32(out + i * 4, h[i]);
+}
+
+static const uint32_t sha256_k[64] = {
+    0x428a2f98, 0x71374491, 0xb5c0fbcf, 0xe9b5dba5, 0x3956c25b, 0x59f111f1, 0x923f82a4, 0xab1c5ed5,
+    0xd807aa98, 0x12835b01, 0x243185be, 0x550c7dc3, 0x72be5d74, 0x80deb1fe, 0x9bdc06a7, 0xc19bf174,
+    0xe49b69c1, 0xefbe4786, 0x0fc19dc6, 0x240ca1cc, 0x2de92c6f, 0x4a7484aa, 0x5cb0a9dc, 0x76f988da,
+    0x983e5152, 0xa831c66d, 0xb00327c8, 0xbf597fc7, 0xc6e00bf3, 0xd5a79147, 0x06ca6351, 0x14292967,
+    0x27b70a85, 0x2e1b2138, 0x4d2c6dfc, 0x53380d13, 0x650a7354, 0x766a0abb, 0x81c2c92e, 0x92722c85,
+    0xa2bfe8a1, 0xa81a664b, 0xc24b8b70, 0xc76c51a3, 0xd192e819, 0xd6990624, 0xf40e3585, 0x106aa070,
+    0x19a4c116, 0x1e376c08, 0x2748774c, 0x34b0bcb5, 0x391c0cb3, 0x4ed8aa4a, 0x5b9cca4f, 0x682e6ff3,
+    0x748f82ee, 0x78a5636f, 0x84c87814, 0x8cc70208, 0x90befffa, 0xa4506ceb, 0xbef9a3f7, 0xc67178f2,
+};
+
+static void sha256_block(void *state, const uint8_t *block) {
+    uint32_t *h = state;
+    uint32_t w[64];
+    for (int i = 0; i < 16; i++) w[i] = load_be32(block + i * 4);
+    for (int i = 16; i < 64; i++) {
+        uint32_t s0 = ror32(w[i - 15], 7) ^ ror32(w[i - 15], 18) ^ (w[i - 15] >> 3);
+        uint32_t s1 = ror32(w[i - 2], 17) ^ ror32(w[i - 2], 19) ^ (w[i - 2] >> 10);
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    uint32_t a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], hh = h[7];
+    for (int i = 0; i < 64; i++) {
+        uint32_t s1 = ror32(e, 6) ^ ror32(e, 11) ^ ror32(e, 25);
+        uint32_t ch = (e & f) ^ (~e & g);
+        uint32_t t1 = hh + s1 + ch + sha256_k[i] + w[i];
+        uint32_t s0 = ror32(a, 2) ^ ror32(a, 13) ^ ror32(a, 22);
+        uint32_t maj = (a & b) ^ (a & c) ^ (b & c);
+        uint32_t t2 = s0 + maj;
+        hh = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d; h[4] += e; h[5] += f; h[6] += g; h[7] += hh;
+}
+
+static void sha256(const uint8_t *data, uint64_t len, uint8_t *out) {
+    uint32_t h[8] = {
+        0x6a09e667, 0xbb67ae85, 0x3c6ef372, 0xa54ff53a, 0x510e527f, 0x9b05688c, 0x1f83d9ab, 0x5be0cd19,
+    };
+    md_hash(data, len, 64, 1, sha256_block, h);
+    for (int i = 0; i < 8; i++) store_be32(out + i * 4, h[i]);
+}
+
+static const uint64_t sha512_k[80] = {
+    0x428a2f98d728ae22ULL, 0x7137449123ef65cdULL, 0xb5c0fbcfec4d3b2fULL, 0xe9b5dba58189dbbcULL,
+    0x3956c25bf348b538ULL, 0x59f111f1b605d019ULL, 0x923f82a4af194f9bULL, 0xab1c5ed5da6d8118ULL,
+    0xd807aa98a3030242ULL, 0x12835b0145706fbeULL, 0x243185be4ee4b28cULL, 0x550c7dc3d5ffb4e2ULL,
+    0x72be5d74f27b896fULL, 0x80deb1fe3b1696b1ULL, 0x9bdc06a725c71235ULL, 0xc19bf174cf692694ULL,
+    0xe49b69c19ef14ad2ULL, 0xefbe4786384f25e3ULL, 0x0fc19dc68b8cd5b5ULL, 0x240ca1cc77ac9c65ULL,
+    0x2de92c6f592b0275ULL, 0x4a7484aa6ea6e483ULL, 0x5cb0a9dcbd41fbd4ULL, 0x76f988da831153b5ULL,
+    0x983e5152ee66dfabULL, 0xa831c66d2db43210ULL, 0xb00327c898fb213fULL, 0xbf597fc7beef0ee4ULL,
+    0xc6e00bf33da88fc2ULL, 0xd5a79147930aa725ULL, 0x06ca6351e003826fULL, 0x142929670a0e6e70ULL,
+    0x27b70a8546d22ffcULL, 0x2e1b21385c26c926ULL, 0x4d2c6dfc5ac42aedULL, 0x53380d139d95b3dfULL,
+    0x650a73548baf63deULL, 0x766a0abb3c77b2a8ULL, 0x81c2c92e47edaee6ULL, 0x92722c851482353bULL,
+    0xa2bfe8a14cf10364ULL, 0xa81a664bbc423001ULL, 0xc24b8b70d0f89791ULL, 0xc76c51a30654be30ULL,
+    0xd192e819d6ef5218ULL, 0xd69906245565a910ULL, 0xf40e35855771202aULL, 0x106aa07032bbd1b8ULL,
+    0x19a4c116b8d2d0c8ULL, 0x1e376c085141ab53ULL, 0x2748774cdf8eeb99ULL, 0x34b0bcb5e19b48a8ULL,
+    0x391c0cb3c5c95a63ULL, 0x4ed8aa4ae3418acbULL, 0x5b9cca4f7763e373ULL, 0x682e6ff3d6b2b8a3ULL,
+    0x748f82ee5defb2fcULL, 0x78a5636f43172f60ULL, 0x84c87814a1f0ab72ULL, 0x8cc702081a6439ecULL,
+    0x90befffa23631e28ULL, 0xa4506cebde82bde9ULL, 0xbef9a3f7b2c67915ULL, 0xc67178f2e372532bULL,
+    0xca273eceea26619cULL, 0xd186b8c721c0c207ULL, 0xeada7dd6cde0eb1eULL, 0xf57d4f7fee6ed178ULL,
+    0x06f067aa72176fbaULL, 0x0a637dc5a2c898a6ULL, 0x113f9804bef90daeULL, 0x1b710b35131c471bULL,
+    0x28db77f523047d84ULL, 0x32caab7b40c72493ULL, 0x3c9ebe0a15c9bebcULL, 0x431d67c49c100d4cULL,
+    0x4cc5d4becb3e42b6ULL, 0x597f299cfc657e2aULL, 0x5fcb6fab3ad6faecULL, 0x6c44198c4a475817ULL,
+};
+
+static void sha512_block(void *state, const uint8_t *block) {
+    uint64_t *h = state;
+    uint64_t w[80];
+    for (int i = 0; i < 16; i++) w[i] = load_be64(block + i * 8);
+    for (int i = 16; i < 80; i++) {
+        uint64_t s0 = ror64(w[i - 15], 1) ^ ror64(w[i - 15], 8) ^ (w[i - 15] >> 7);
+        uint64_t s1 = ror64(w[i - 2], 19) ^ ror64(w[i - 2], 61) ^ (w[i - 2] >> 6);
+        w[i] = w[i - 16] + s0 + w[i - 7] + s1;
+    }
+    uint64_t a = h[0], b = h[1], c = h[2], d = h[3], e = h[4], f = h[5], g = h[6], hh = h[7];
+    for (int i = 0; i < 80; i++) {
+        uint64_t s1 = ror64(e, 14) ^ ror64(e, 18) ^ ror64(e, 41);
+        uint64_t ch = (e & f) ^ (~e & g);
+        uint64_t t1 = hh + s1 + ch + sha512_k[i] + w[i];
+        uint64_t s0 = ror64(a, 28) ^ ror64(a, 34) ^ ror64(a, 39);
+        uint64_t maj = (a & b) ^ (a & c) ^ (b & c);
+        uint64_t t2 = s0 + maj;
+        hh = g; g = f; f = e; e = d + t1;
+        d = c; c = b; b = a; a = t1 + t2;
+    }
+    h[0] += a; h[1] += b; h[2] += c; h[3] += d; h[4] += e; h[5] += f; h[6] += g; h[7] += hh;
+}
+
+static void sha512(const uint8_t *data, uint64_t len, uint8_t *out) {
+    uint64_t h[8] = {
+        0x6a09e667f3bcc908ULL, 0xbb67ae8584caa73bULL, 0x3c6ef372fe94f82bULL, 0xa54ff53a5f1d36f1ULL,
+        0x510e527fade682d1ULL, 0x9b05688c2b3e6c1fULL, 0x1f83d9abfb41bd6bULL, 0x5be0cd19137e2179ULL,
+    };
+    md_hash(data, len, 128, 1, sha512_block, h);
+    for (int i = 0; i < 8; i++) store_be64(out + i * 8, h[i]);
+}
+
+// ELF
+
+#define EI_CLASS 4
+#define ELFCLASS32 1
+#define ELFCLASS64 2
+#define SHT_NOTE 7
+#define SHT_DYNSYM 11
+#define STT_OBJECT 1
+#define STT_FUNC 2
+#define STT_GNU_IFUNC 10
+#define PT_LOAD 1
+#define PT_DYNAMIC 2
+#define PT_NOTE 4
+#define NT_GNU_BUILD_ID 3
+#define DT_NULL 0
+#define DT_NEEDED 1
+#define DT_STRTAB 5
+#define DT_SONAME 14
+#define DT_RPATH 15
+#define DT_RUNPATH 29
+#define NEEDED_MAX 128
+
+static uint64_t read_uint(const uint8_t *p, int size) {
+    uint64_t v = 0;
+    for (int i = size - 1; i >= 0; i--) v = (v << 8) | p[i];
+    return v;
+}
+
+// searches the notes in [off, off+size) for the GNU build-id
+static int find_build_id_note(const uint8_t *data, uint64_t len, uint64_t off, uint64_t size,
+                              const uint8_t **desc, uint32_t *desc_size) {
+    if (off > len || size > len - off) return 0;
+    uint64_t p = off, end = off + size;
+    while (p + 12 <= end) {
+        uint32_t namesz = load_le32(data + p);
+        uint32_t descsz = load_le32(data + p + 4);
+        uint32_t type = load_le32(data + p + 8);
+        uint64_t name_off = p + 12;
+        uint64_t desc_off = name_off + (((uint64_t)namesz + 3) & ~3ULL);
+        uint64_t next = desc_off + (((uint64_t)descsz + 3) & ~3ULL);
+        if (next > end) return 0;
+        if (type == NT_GNU_BUILD_ID && namesz == 4 &&
+            data[name_off] == 'G' && data[name_off + 1] == 'N' && data[name_off + 2] == 'U') {
+            *desc = data + desc_off;
+            *desc_size = descsz;
+            return 1;
+        }
+        p = next;
+    }
+    return 0;
+}
+
+static int find_build_id(const uint8_t *data, uint64_t len, const uint8_t **desc, uint32_t *desc_size) {
+    int is64 = data[EI_CLASS] == ELFCLASS64;
+    if (!is64 && data[EI_CLASS] != ELFCLASS32) return 0;
+    int word = is64 ? 8 : 4;
+    if (len < (is64 ? 64 : 52)) return 0;
+
+    // e_phoff, e_shoff, e_phentsize, e_phnum, e_shentsize, e_shnum
+    uint64_t phoff = read_uint(data + (is64 ? 32 : 28), word);
+    uint64_t shoff = read_uint(data + (is64 ? 40 : 32), word);
+    uint16_t phentsize = read_uint(data + (is64 ? 54 : 42), 2);
+    uint16_t phnum = read_uint(data + (is64 ? 56 : 44), 2);
+    uint16_t shentsize = read_uint(data + (is64 ? 58 : 46), 2);
+    uint16_t shnum = read_uint(data + (is64 ? 60 : 48), 2);
+
+    for (uint16_t i = 0; i < shnum; i++) {
+        uint64_t sh = shoff + (uint64_t)i * shentsize;
+        if (sh + (is64 ? 64 : 40) > len) break;
+        if (load_le32(data + sh + 4) != SHT_NOTE) continue;
+        uint64_t off = read_uint(data + sh + (is64 ? 24 : 16), word);
+        uint64_t size = read_uint(data + sh + (is64 ? 32 : 20), word);
+        if (find_build_id_note(data, len, off, size, desc, desc_size)) return 1;
+    }
+    // stripped section headers: fall back to the program headers
+    for (uint16_t i = 0; i < phnum; i++) {
+        uint64_t ph = phoff + (uint64_t)i * phentsize;
+        if (ph + (is64 ? 56 : 32) > len) break;
+        if (load_le32(data + ph) != PT_NOTE) continue;
+        uint64_t off = read_uint(data + ph + (is64 ? 8 : 4), word);
+        uint64_t size = read_uint(data + ph + (is64 ? 32 : 16), word);
+        if (find_build_id_note(data, len, off, size, desc, desc_size)) return 1;
+    }
+    return 0;
+}
+
+// translates a virtual address into a file offset by the PT_LOAD segments
+static int vaddr_to_offset(const uint8_t *data, uint64_t len, uint64_t vaddr, uint64_t *off) {
+    int is64 = data[EI_CLASS] == ELFCLASS64;
+    int word = is64 ? 8 : 4;
+    uint64_t phoff = read_uint(data + (is64 ? 32 : 28), word);
+    uint16_t phentsize = read_uint(data + (is64 ? 54 : 42), 2);
+    uint16_t phnum = read_uint(data + (is64 ? 56 : 44), 2);
+    for (uint16_t i = 0; i < phnum; i++) {
+        uint64_t ph = phoff + (uint64_t)i * phentsize;
+        if (ph + (is64 ? 56 : 32) > len) break;
+        if (load_le32(data + ph) != PT_LOAD) continue;
+        uint64_t p_offset = read_uint(data + ph + (is64 ? 8 : 4), word);
+        uint64_t p_vaddr = read_uint(data + ph + (is64 ? 16 : 8), word);
+        uint64_t p_filesz = read_uint(data + ph + (is64 ? 32 : 16), word);
+        if (p_vaddr <= vaddr && vaddr - p_vaddr < p_filesz) {
+            *off = vaddr - p_vaddr + p_offset;
+            return 1;
+        }
+    }
+    return 0;
+}
+
+struct dynamic_info {
+    uint64_t strtab;
+    int has_strtab;
+    uint64_t soname;
+    int has_soname;
+    uint64_t rpath;
+    int has_rpath;
+    uint64_t runpath;
+    int has_runpath;
+    uint64_t needed[NEEDED_MAX];
+    int needed_len;
+};
+
+static int read_dynamic(const uint8_t *data, uint64_t len, struct dynamic_info *info) {
+    int is64 = data[EI_CLASS] == ELFCLASS64;
+    int word = is64 ? 8 : 4;
+    if (len < (is64 ? 64 : 52)) return 0;
+    uint64_t phoff = read_uint(data + (is64 ? 32 : 28), word);
+    uint16_t phentsize = read_uint(data + (is64 ? 54 : 42), 2);
+    uint16_t phnum = read_uint(data + (is64 ? 56 : 44), 2);
+
+    info->has_strtab = info->has_soname = info->has_rpath = info->has_runpath = 0;
+    info->needed_len = 0;
+    for (uint16_t i = 0; i < phnum; i++) {
+        uint64_t ph = phoff + (uint64_t)i * phentsize;
+        if (ph + (is64 ? 56 : 32) > len) break;
+        if (load_le32(data + ph) != PT_DYNAMIC) continue;
+        uint64_t off = read_uint(data + ph + (is64 ? 8 : 4), word);
+        uint64_t size = read_uint(data + ph + (is64 ? 32 : 16), word);
+        if (off > len || size > len - off) return 0;
+        for (uint64_t p = off; p + 2 * word <= off + size; p += 2 * word) {
+            uint64_t tag = read_uint(data + p, word);
+            uint64_t val = read_uint(data + p + word, word);
+            if (tag == DT_NULL) break;
+            if (tag == DT_STRTAB) { info->strtab = val; info->has_strtab = 1; }
+            else if (tag == DT_SONAME) { info->soname = val; info->has_soname = 1; }
+            else if (tag == DT_RPATH) { info->rpath = val; info->has_rpath = 1; }
+            else if (tag == DT_RUNPATH) { info->runpath = val; info->has_runpath = 1; }
+            else if (tag == DT_NEEDED && info->needed_len < NEEDED_MAX) info->needed[info->needed_len++] = val;
+        }
+        if (!info->has_strtab) return 0;
+        // DT_STRTAB holds a virtual address
+        return vaddr_to_offset(data, len, info->strtab, &info->strtab);
+    }
+    return 0;
+}
+
+// returns the NUL-terminated string at strtab + index, or 0 if it runs off the file
+static const char *dynamic_string(const uint8_t *data, uint64_t len, const struct dynamic_info *info, uint64_t index) {
+    if (info->strtab > len || index >= len - info->strtab) return 0;
+    for (uint64_t p = info->strtab + index; p < len; p++) {
+        if (data[p] == 0) return (const char *)(data + info->strtab + index);
+    }
+    return 0;
+}
+
+// options
+
+#define TYPE_BUILD_ID 1
+#define TYPE_MD5 2
+#define TYPE_SHA1 4
+#define TYPE_SHA256 8
+#define TYPE_SHA512 16
+#define TYPE_SYMBOLS 32
+
+static int hash_types = TYPE_BUILD_ID | TYPE_MD5;
+
+#define SYMBOL_FILTER_MAX 256
+static char *symbol_filter[SYMBOL_FILTER_MAX];
+static int symbol_filter_len = 0;
+
+static void parse_symbol_filter(char *s) {
+    while (*s && symbol_filter_len < SYMBOL_FILTER_MAX) {
+        symbol_filter[symbol_filter_len++] = s;
+        while (*s && *s != ',') s++;
+        if (*s) *s++ = 0;
+    }
+}
+
+static int parse_types(char *s) {
+    int types = 0;
+    while (*s) {
+        char *name = s;
+        while (*s && *s != ',') s++;
+        if (*s) *s++ = 0;
+        if (streq(name, "build-id")) types |= TYPE_BUILD_ID;
+        else if (streq(name, "md5")) types |= TYPE_MD5;
+        else if (streq(name, "sha1")) types |= TYPE_SHA1;
+        else if (streq(name, "sha256")) types |= TYPE_SHA256;
+        else if (streq(name, "sha512")) types |= TYPE_SHA512;
+        else if (streq(name, "symbols")) types |= TYPE_SYMBOLS;
+        else return -1;
+    }
+    return types;
+}
+
+// ldconfig paths are mostly symlinks to a few files, so records are memoized by inode
+
+#define RECORD_CACHE_SIZE 4096
+#define RECORD_MAX 2048
+
+struct record {
+    uint64_t dev;
+    uint64_t ino;
+    size_t len;
+    char fields[RECORD_MAX];
+};
+
+static struct record *record_cache;
+static size_t record_cache_len = 0;
+
+static struct record *find_record(uint64_t dev, uint64_t ino) {
+    for (size_t i = 0; i < record_cache_len; i++) {
+        if (record_cache[i].dev == dev && record_cache[i].ino == ino) return &record_cache[i];
+    }
+    return 0;
+}
+
+static void append_field(struct record *r, const char *name, const uint8_t *digest, size_t len) {
+    size_t name_len = strlen_(name);
+    if (r->len + name_len + 1 + len * 2 + 1 > RECORD_MAX) return;
+    memcpy(r->fields + r->len, name, name_len);
+    r->len += name_len;
+    r->fields[r->len++] = '=';
+    for (size_t i = 0; i < len; i++) {
+        r->fields[r->len++] = hex_table[digest[i] >> 4];
+        r->fields[r->len++] = hex_table[digest[i] & 0xf];
+    }
+    r->fields[r->len++] = '\t';
+}
+
+static void append_string_field(struct record *r, const char *name, const char *value) {
+    size_t name_len = strlen_(name);
+    size_t value_len = strlen_(value);
+    if (r->len + name_len + 1 + value_len + 1 > RECORD_MAX) return;
+    // the record is tab separated
+    for (size_t i = 0; i < value_len; i++) {
+        if (value[i] == '\t' || value[i] == '\n') return;
+    }
+    memcpy(r->fields + r->len, name, name_len);
+    r->len += name_len;
+    r->fields[r->len++] = '=';
+    memcpy(r->fields + r->len, value, value_len);
+    r->len += value_len;
+    r->fields[r->len++] = '\t';
+}
+
+static void append_uint_digits(char *buf, size_t *len, uint64_t value) {
+    char digits[20];
+    size_t n = 0;
+    do {
+        digits[n++] = '0' + value % 10;
+        value /= 10;
+    } while (value);
+    while (n) buf[(*len)++] = digits[--n];
+}
+
+static void append_uint_field(struct record *r, const char *name, uint64_t value) {
+    char buf[21];
+    size_t len = 0;
+    append_uint_digits(buf, &len, value);
+    buf[len] = 0;
+    append_string_field(r, name, buf);
+}
+
+// returns 0 for the files that are not ELF
+static int compute_record(int fd, uint64_t size, struct record *r) {
+    r->len = 0;
+    if (size < 16) return 0;
+    uint8_t *data = mmap_(0, size, PROT_READ, MAP_PRIVATE, fd, 0);
+    if (is_mmap_error(data)) return 0;
+    if (data[0] != 0x7f || data[1] != 'E' || data[2] != 'L' || data[3] != 'F') {
+        munmap_(data, size);
+        return 0;
+    }
+
+    uint8_t digest[64];
+    if (hash_types & TYPE_BUILD_ID) {
+        const uint8_t *desc;
+        uint32_t desc_size;
+        if (find_build_id(data, size, &desc, &desc_size) && desc_size <= 64) {
+            append_field(r, "build-id", desc, desc_size);
+        }
+    }
+    if (hash_types & TYPE_MD5) { md5(data, size, digest); append_field(r, "md5", digest, 16); }
+    if (hash_types & TYPE_SHA1) { sha1(data, size, digest); append_field(r, "sha1", digest, 20); }
+    if (hash_types & TYPE_SHA256) { sha256(data, size, digest); append_field(r, "sha256", digest, 32); }
+    if (hash_types & TYPE_SHA512) { sha512(data, size, digest); append_field(r, "sha512", digest, 64); }
+
+    append_uint_field(r, "size", size);
+    char buf[RECORD_MAX];
+    size_t buf_len = 0;
+    append_uint_digits(buf, &buf_len, data[EI_CLASS] == ELFCLASS64 ? 64 : 32);
+    buf[buf_len++] = '-';
+    append_uint_digits(buf, &buf_len, read_uint(data + 18, 2));
+    buf[buf_len] = 0;
+    append_string_field(r, "arch", buf);
+
+    // static files have no dynamic section, and need nothing
+    static struct dynamic_info info;
+    if (!read_dynamic(data, size, &info)) {
+        append_string_field(r, "needed", "");
+    } else {
+        const char *str;
+        if (info.has_soname && (str = dynamic_string(data, size, &info, info.soname))) append_string_field(r, "soname", str);
+        // a truncated list must not look complete, so the field is left out if it does not fit
+        int complete = 1;
+        buf_len = 0;
+        for (int i = 0; i < info.needed_len && complete; i++) {
+            str = dynamic_string(data, size, &info, info.needed[i]);
+            size_t len = str ? strlen_(str) : 0;
+            if (!str || buf_len + len + 2 > sizeof(buf)) { complete = 0; break; }
+            if (i) buf[buf_len++] = ',';
+            memcpy(buf + buf_len, str, len);
+            buf_len += len;
+        }
+        buf[buf_len] = 0;
+        if (complete) append_string_field(r, "needed", buf);
+        if (info.has_rpath && (str = dynamic_string(data, size, &info, info.rpath))) append_string_field(r, "rpath", str);
+        if (info.has_runpath && (str = dynamic_string(data, size, &info, info.runpath))) append_string_field(r, "runpath", str);
+    }
+
+    munmap_(data, size);
+    return 1;
+}
+
+static int symbol_wanted(const char *name) {
+    if (!symbol_filter_len) return 1;
+    for (int i = 0; i < symbol_filter_len; i++) {
+        if (streq(symbol_filter[i], name)) return 1;
+    }
+    return 0;
+}
+
+static void out_hex(uint64_t value) {
+    char buf[16];
+    size_t n = 0;
+    do {
+        buf[n++] = hex_table[value & 0xf];
+        value >>= 4;
+    } while (value);
+    while (n) out_write(&buf[--n], 1);
+}
+
+// defined functions and objects in .dynsym. libraries keep their section headers, so only those are read
+static void emit_symbols(int fd, uint64_t len) {
+    if (len < 64) return;
+    uint8_t *data = mmap_(0, len, PROT_READ, MAP_PRIVATE, fd, 0);
+    if (is_mmap_error(data)) return;
+    int is64 = data[EI_CLASS] == ELFCLASS64;
+    int word = is64 ? 8 : 4;
+    uint64_t shoff = read_uint(data + (is64 ? 40 : 32), word);
+    uint16_t shentsize = read_uint(data + (is64 ? 58 : 46), 2);
+    uint16_t shnum = read_uint(data + (is64 ? 60 : 48), 2);
+    uint64_t shdr_size = is64 ? 64 : 40;
+
+    for (uint16_t i = 0; i < shnum; i++) {
+        uint64_t sh = shoff + (uint64_t)i * shentsize;
+        if (sh + shdr_size > len) break;
+        if (load_le32(data + sh + 4) != SHT_DYNSYM) continue;
+        uint64_t off = read_uint(data + sh + (is64 ? 24 : 16), word);
+        uint64_t size = read_uint(data + sh + (is64 ? 32 : 20), word);
+        uint32_t link = load_le32(data + sh + (is64 ? 40 : 24));
+        uint64_t entsize = read_uint(data + sh + (is64 ? 56 : 36), word);
+        uint64_t strtab_sh = shoff + (uint64_t)link * shentsize;
+        if (entsize == 0 || off > len || size > len - off || strtab_sh + shdr_size > len) break;
+        uint64_t strtab = read_uint(data + strtab_sh + (is64 ? 24 : 16), word);
+        uint64_t strtab_size = read_uint(data + strtab_sh + (is64 ? 32 : 20), word);
+        if (strtab > len || strtab_size > len - strtab) break;
+
+        for (uint64_t p = off; p + entsize <= off + size; p += entsize) {
+            // Elf64_Sym: name, info, other, shndx, value / Elf32_Sym: name, value, size, info, other, shndx
+            uint32_t name = load_le32(data + p);
+            uint8_t info = data[p + (is64 ? 4 : 12)];
+            uint16_t shndx = read_uint(data + p + (is64 ? 6 : 14), 2);
+            uint64_t value = read_uint(data + p + (is64 ? 8 : 4), word);
+            uint8_t type = info & 0xf;
+            if (shndx == 0 || name == 0 || name >= strtab_size) continue;
+            if (type != STT_FUNC && type != STT_OBJECT && type != STT_GNU_IFUNC) continue;
+            const char *str = (const char *)(data + strtab + name);
+            size_t str_len = 0;
+            while (name + str_len < strtab_size && str[str_len]) str_len++;
+            if (name + str_len == strtab_size || !symbol_wanted(str)) continue;
+            out_str("sym\t");
+            out_hex(value);
+            out_write("\t", 1);
+            out_write(str, str_len);
+            out_write("\n", 1);
+        }
+        break;
+    }
+    munmap_(data, len);
+}
+
+static void scan_file(const char *path) {
+    int fd = open_(path, O_RDONLY);
+    if (fd < 0) return;
+    struct stat_ st;
+    if (syscall(SYS_fstat, fd, (long)&st, 0) < 0 || (st.st_mode & S_IFMT) != S_IFREG) {
+        close_(fd);
+        return;
+    }
+
+    struct record tmp;
+    struct record *r = find_record(st.st_dev, st.st_ino);
+    int first = !r;
+    if (!r) {
+        r = record_cache_len < RECORD_CACHE_SIZE ? &record_cache[record_cache_len++] : &tmp;
+        r->dev = st.st_dev;
+        r->ino = st.st_ino;
+        // len == -1 marks the files that are not ELF
+        if (!compute_record(fd, st.st_size, r)) r->len = (size_t)-1;
+    }
+
+    if (r->len != (size_t)-1) {
+        out_write(r->fields, r->len);
+        out_str(path);
+        out_write("\n", 1);
+        // the other paths of the same file have the same symbols
+        if (first && (hash_types & TYPE_SYMBOLS)) emit_symbols(fd, st.st_size);
+    }
+    close_(fd);
+}
+
+static char path_buf[4096];
+
+static void scan_dir(const char *dir) {
+    int fd = open_(dir, O_RDONLY | O_DIRECTORY);
+    if (fd < 0) return;
+    size_t dir_len = strlen_(dir);
+    if (dir_len + 2 >= sizeof(path_buf)) {
+        close_(fd);
+        return;
+    }
+    uint8_t buf[8192];
+    for (;;) {
+        long n = syscall(SYS_getdents64, fd, (long)buf, sizeof(buf));
+        if (n <= 0) break;
+        for (long off = 0; off < n;) {
+            // struct linux_dirent64 { ino; off; reclen; type; name[] }
+            uint16_t reclen = read_uint(buf + off + 16, 2);
+            uint8_t type = buf[off + 18];
+            const char *name = (const char *)(buf + off + 19);
+            off += reclen;
+
+            if (!contains(name, ".so")) continue;
+            size_t name_len = strlen_(name);
+            if (dir_len + 1 + name_len + 1 > sizeof(path_buf)) continue;
+            memcpy(path_buf, dir, dir_len);
+            path_buf[dir_len] = '/';
+            memcpy(path_buf + dir_len + 1, name, name_len + 1);
+
+            // only regular files, as `ls -la` listing for musl images did
+            if (type == DT_UNKNOWN) {
+                struct stat_ st;
+                if (syscall(SYS_lstat, (long)path_buf, (long)&st, 0) < 0) continue;
+                if ((st.st_mode & S_IFMT) != S_IFREG) continue;
+            } else if (type != DT_REG) {
+                continue;
+            }
+            scan_file(path_buf);
+        }
+    }
+    close_(fd);
+}
+
+#define STDIN_MAX (64 << 20)
+
+// accepts both `ldconfig -p` lines ("\tlibc.so.6 (libc6,x86-64) => /lib/.../libc.so.6") and plain paths
+static void scan_stdin(void) {
+    char *buf = mmap_(0, STDIN_MAX, PROT_READ | PROT_WRITE, MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (is_mmap_error(buf)) exit_(3);
+    size_t len = 0;
+    for (;;) {
+        if (len == STDIN_MAX - 1) break;
+        long n = read_(0, buf + len, STDIN_MAX - 1 - len);
+        if (n <= 0) break;
+        len += n;
+    }
+    buf[len] = 0;
+
+    char *line = buf;
+    while (*line) {
+        char *end = line;
+        while (*end && *end != '\n') end++;
+        int last = *end == 0;
+        *end = 0;
+
+        char *path = 0;
+        for (char *p = line; p[0]; p++) {
+            if (p[0] == ' ' && p[1] == '=' && p[2] == '>' && p[3] == ' ') {
+                path = p + 4;
+                break;
+            }
+        }
+        if (!path && line[0] == '/') path = line;
+        if (path) {
+            while (*path == ' ') path++;
+            scan_file(path);
+        }
+
+        if (last) break;
+        line = end + 1;
+    }
+}
+
+__attribute__((used)) void scan_main(long *sp) {
+    long argc = sp[0];
+    char **argv = (char **)(sp + 1);
+
+    record_cache = mmap_(0, sizeof(struct record) * RECORD_CACHE_SIZE, PROT_READ | PROT_WRITE,
+                         MAP_PRIVATE | MAP_ANONYMOUS, -1, 0);
+    if (is_mmap_error(record_cache)) exit_(3);
+
+    for (long i = 1; i < argc; i++) {
+        char *arg = argv[i];
+        if (streq(arg, "-t") && i + 1 < argc) {
+            hash_types = parse_types(argv[++i]);
+            if (hash_types < 0) exit_(1);
+        } else if (streq(arg, "-y") && i + 1 < argc) {
+            parse_symbol_filter(argv[++i]);
+        } else if (streq(arg, "-")) {
+            scan_stdin();
+        } else {
+            int fd = open_(arg, O_RDONLY | O_DIRECTORY);
+            if (fd >= 0) {
+                close_(fd);
+                scan_dir(arg);
+            } else {
+                scan_file(arg);
+            }
+        }
+    }
+
+    flush_out();
+    exit_(0);
+}
+
+__asm__(
+    ".global _start\n"
+    "_start:\n"
+    "    xor %rbp, %rbp\n"
+    "    mov %rsp, %rdi\n"
+    "    and $-16, %rsp\n"
+    "    call scan_main\n"
+    "    hlt\n"
+);
@@ -0,0 +1,208 @@
+from argparse import ArgumentParser
+import hashlib
+import json
+import logging
+import os
+from os import PathLike
+from pathlib import Path
+import signal
+import socket
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from typing import Any, Optional, Union
+
+from preplib.index import ImageIndex, LibIndex, default_cache_dir
+from preplib.logger import logger
+from preplib.query import InvertedIndex, Target
+from preplib.timing import span
+
+# protocol: one json object per line in both directions
+#   {"op": "ping"}
+#   {"op": "digest", "digest": <digest>}                    -> [[image_name, image_digest, path], ...]
+#   {"op": "match", "targets": [[<key>, [<digest>...]]...]}  -> {<image@digest>: {<key>: <path>}}
+#   {"op": "tags", "images": [<image@digest>...]}            -> {<image@digest>: [<tag>...]}
+#   {"op": "find_images", "tag": <tag>}                      -> [<image@digest>...]
+# responses are {"ok": true, "result": ...} or {"ok": false, "error": <message>}
+
+def default_socket_path(index_dir: Union[PathLike, str]):
+  runtime_dir = os.environ.get("XDG_RUNTIME_DIR", tempfile.gettempdir())
+  # one daemon per index directory
+  key = hashlib.sha256(str(Path(index_dir).absolute()).encode()).hexdigest()[:12]
+  return Path(runtime_dir) / f"preplib-{os.getuid()}-{key}.sock"
+
+class IndexState:
+  def __init__(self, index_dir: Union[PathLike, str]):
+    self.lib_index = LibIndex(index_dir)
+    self.image_index = ImageIndex(index_dir)
+    self.inverted_index = InvertedIndex()
+    self._last_rowid = 0
+    self._row_count = 0
+    # PRAGMA data_version is per connection, and LibIndex connections are per thread.
+    # the first refresh() from another thread only costs an extra row count check
+    self._data_version: Optional[int] = None
+    self._image_signature = None
+    self.refresh()
+
+  # handler threads keep reading the index they got, so new rows go into a copy that then replaces it
+  def _load_rows(self, inverted_index: InvertedIndex) -> InvertedIndex:
+    rows = self.lib_index.rows_after(self._last_rowid)
+    if len(rows) == 0: return inverted_index
+    inverted_index = inverted_index.copy()
+    inverted_index.add_rows((digest, info) for _, digest, info in rows)
+    self._last_rowid = rows[-1][0]
+    self._row_count += len(rows)
+    logger.info(f"loaded {len(rows)} rows (total: {self._row_count})")
+    return inverted_index
+
+  def refresh(self):
+    data_version = self.lib_index.data_version()
+    if data_version != self._data_version:
+      self._data_version = data_version
+      inverted_index = self._load_rows(self.inverted_index)
+      if self.lib_index.row_count() != self._row_count:
+        # rows were deleted (LibIndex.dump), which can not be followed incrementally
+        logger.info("index rows were removed, reloading everything...")
+        self._last_rowid = 0
+        self._row_count = 0
+        inverted_index = self._load_rows(InvertedIndex())
+      self.inverted_index = inverted_index
+    image_signature = self.image_index.signature()
+    if image_signature != self._image_signature:
+      self._image_signature = image_signature
+      self.image_index.reload()
+
+  def watch(self, interval: float):
+    while True:
+      time.sleep(interval)
+      try:
+        self.refresh()
+      except Exception as e:
+        logger.warning(f"failed to reload the index: {e!r}")
+
+  def handle(self, request: dict[str, Any]):
+    op = request.get("op")
+    if op == "ping":
+      return "pong"
+    if op == "digest":
+      # one snapshot of the index for the whole request
+      inverted_index = self.inverted_index
+      posting = inverted_index.postings.get(request["digest"])
+      if posting is None:
+        return []
+      res = []
+      for image_id, path_id in zip(posting.image_ids, posting.path_ids):
+        image_name, image_digest = inverted_index.images[image_id].split("@", maxsplit=1)
+        res.append([image_name, image_digest, inverted_index.paths[path_id]])
+      return res
+    if op == "match":
+      return self.inverted_index.match([Target(key, digests) for key, digests in request["targets"]])
+    if op == "tags":
+      return { image: self.image_index.get(image) for image in request["images"] }
+    if op == "find_images":
+      return self.image_index.find_images(request["tag"])
+    raise ValueError(f"unknown op: {op}")
+
+class RequestHandler(socketserver.StreamRequestHandler):
+  server: "IndexServer"
+
+  def handle(self):
+    for line in self.rfile:
+      try:
+        response = { "ok": True, "result": self.server.state.handle(json.loads(line)) }
+      except Exception as e:
+        logger.debug(f"failed to handle {line!r}: {e!r}")
+        response = { "ok": False, "error": f"{type(e).__name__}: {e}" }
+      self.wfile.write(json.dumps(response).encode() + b"\n")
+      self.wfile.flush()
+
+class IndexServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path: Path, state: IndexState):
+    self.state = state
+    super().__init__(str(socket_path), RequestHandler)
+
+class DaemonClient:
+  def __init__(self, sock: socket.socket):
+    self.sock = sock
+    self.file = sock.makefile("rwb")
+
+  @classmethod
+  def connect(cls, socket_path: Union[PathLike, str]) -> Optional["DaemonClient"]:
+    if not Path(socket_path).exists():
+      return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+      sock.connect(str(socket_path))
+    except OSError:
+      sock.close()
+      return None
+    return cls(sock)
+
+  def request(self, op: str, **params):
+    message = json.dumps({ "op": op, **params }).encode() + b"\n"
+    with span("daemon", op, bytes_written=len(message)) as span_args:
+      self.file.write(message)
+      self.file.flush()
+      line = self.file.readline()
+      span_args["bytes_read"] = len(line)
+    if not line:
+      raise ConnectionError("daemon closed the connection")
+    response = json.loads(line)
+    if not response["ok"]:
+      raise RuntimeError(f"daemon error: {response['error']}")
+    return response["result"]
+
+  def match(self, targets: list[Target]) -> dict[str, dict[str, str]]:
+    return self.request("match", targets=[[target.key, target.digests] for target in targets])
+
+  def get_many(self, image_names: list[str]) -> dict[str, list[str]]:
+    return self.request("tags", images=image_names)
+
+  def get(self, image_name: str) -> list[str]:
+    return self.get_many([image_name])[image_name]
+
+  def close(self):
+    self.file.close()
+    self.sock.close()
+
+def serve(index_dir: Union[PathLike, str], socket_path: Union[PathLike, str], reload_interval: float=1):
+  socket_path = Path(socket_path)
+  if socket_path.exists():
+    client = DaemonClient.connect(socket_path)
+    if client is not None:
+      client.close()
+      logger.error(f"another daemon is already serving on {socket_path}")
+      exit(1)
+    # left over by a daemon that did not exit cleanly
+    socket_path.unlink()
+
+  logger.info(f"loading the index in {index_dir}...")
+  state = IndexState(index_dir)
+  # additions to the index are picked up in the background
+  threading.Thread(target=state.watch, args=(reload_interval,), daemon=True).start()
+  server = IndexServer(socket_path, state)
+  socket_path.chmod(0o600)
+  # remove the socket on `kill` as well as on ^C
+  signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+  logger.info(f"serving on {socket_path}")
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
+  finally:
+    server.server_close()
+    socket_path.unlink(missing_ok=True)
+
+def serve_main(argv: list[str]):
+  parser = ArgumentParser(prog="preplib serve")
+  parser.add_argument("--index-dir", nargs="?", help="index directory (default: user-cache-dir)", default=str(default_cache_dir))
+  parser.add_argument("--socket", help="unix socket path (default: per-index-dir path under $XDG_RUNTIME_DIR)")
+  parser.add_argument("--verbose", "-v", action="store_true", help="enable verbose output")
+  args = parser.parse_args(argv)
+  if args.verbose:
+    logger.setLevel(logging.DEBUG)
+  serve(args.index_dir, args.socket or default_socket_path(args.index_dir))
@@ -0,0 +1,329 @@
+from bisect import bisect_left
+import hashlib
+import mmap
+import os
+from os import PathLike
+from pathlib import Path
+import shutil
+import struct
+import tempfile
+from typing import Any, Callable, Iterator, Optional, Protocol, Tuple, Union
+
+from preplib.logger import logger
+from preplib.timing import traced
+
+# snapshot.bin: the libs table and the image index frozen into one immutable file. it is read through mmap, so that
+# opening it parses nothing and every lookup is a binary search. the file only depends on its content, so that an
+# unchanged index exports the same bytes and the data repository does not get a new blob every night.
+#   header     magic, version, digest width, number of sections, and the first 8 bytes of the sha256 of the rest
+#   sections   (offset, count) of each section in SNAPSHOT_SECTIONS. every section starts 8-byte aligned
+# all integers are little endian. strings and images are referred to by their position (u32)
+SNAPSHOT_MAGIC = b"PLSN"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_HEADER = struct.Struct("<4sIIIQ")
+SNAPSHOT_SECTION = struct.Struct("<QQ")
+SNAPSHOT_SECTIONS = [
+  # every distinct digest in sorted order, NUL-padded to the width
+  "digests",
+  # the first posting of each digest, and the number of postings at the end (u64)
+  "posting_starts",
+  # (image, path string) of each digest (u32 pairs)
+  "postings",
+  # the end of each string in string_data (u64), starting with 0
+  "string_ends",
+  "string_data",
+  # the identifier string (image@digest) of each image (u32)
+  "images",
+  # the images sorted by the identifier (u32)
+  "image_order",
+  # the first tag of each image, and the number of tags at the end (u64)
+  "image_tag_starts",
+  # tag strings (u32)
+  "image_tags",
+  # tag strings sorted by the tag (u32)
+  "tags",
+  # the first image of each tag, and the number of images at the end (u64)
+  "tag_image_starts",
+  # images (u32)
+  "tag_images",
+]
+(
+  DIGESTS, POSTING_STARTS, POSTINGS, STRING_ENDS, STRING_DATA, IMAGES, IMAGE_ORDER,
+  IMAGE_TAG_STARTS, IMAGE_TAGS, TAGS, TAG_IMAGE_STARTS, TAG_IMAGES,
+) = range(len(SNAPSHOT_SECTIONS))
+U32 = struct.Struct("<I")
+U64 = struct.Struct("<Q")
+POSTING = struct.Struct("<II")
+
+# LibIndex
+class SnapshotSource(Protocol):
+  cache_dir: Path
+  def max_digest_length(self) -> int: ...
+  # (digest, (image name, image digest, path)) sorted by the digest
+  def iter_all(self) -> Iterator[Tuple[str, Tuple[str, str, str]]]: ...
+
+# a sorted section seen as a sequence of keys, for bisect
+class _Keys:
+  def __init__(self, count: int, key: Callable[[int], Any]):
+    self.count = count
+    self.key = key
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, i):
+    return self.key(i)
+
+class Snapshot:
+  def __init__(self, path: Union[PathLike, str]):
+    self.path = Path(path)
+    with open(self.path, "rb") as f:
+      self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+      magic, version, self.width, section_count, self.content_hash = SNAPSHOT_HEADER.unpack_from(self._mmap, 0)
+      if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION or section_count != len(SNAPSHOT_SECTIONS):
+        raise ValueError(f"not a snapshot of version {SNAPSHOT_VERSION}: {self.path}")
+      self._offsets: list[int] = []
+      self._counts: list[int] = []
+      for i in range(section_count):
+        offset, count = SNAPSHOT_SECTION.unpack_from(self._mmap, SNAPSHOT_HEADER.size + i * SNAPSHOT_SECTION.size)
+        self._offsets.append(offset)
+        self._counts.append(count)
+    except (ValueError, struct.error):
+      self._mmap.close()
+      raise
+    self.digest_count = self._counts[DIGESTS]
+    self.posting_count = self._counts[POSTINGS]
+    self.image_count = self._counts[IMAGES]
+    self._digest_keys = _Keys(self.digest_count, self._digest_bytes)
+    self._image_keys = _Keys(self.image_count, lambda i: self.image_identifier(self._u32(IMAGE_ORDER, i)))
+    self._tag_keys = _Keys(self._counts[TAGS], lambda i: self.string(self._u32(TAGS, i)))
+
+  @staticmethod
+  def get_path(index_dir: Union[PathLike, str]):
+    return Path(index_dir) / "snapshot.bin"
+
+  # the snapshot in the index directory, or None if there is none (or it is of another version)
+  @classmethod
+  def open(cls, index_dir: Union[PathLike, str]) -> Optional["Snapshot"]:
+    path = cls.get_path(index_dir)
+    if not path.exists():
+      return None
+    try:
+      return cls(path)
+    except ValueError as e:
+      logger.warning(f"ignoring the snapshot: {e}")
+      return None
+
+  def _u32(self, section: int, i: int) -> int:
+    return U32.unpack_from(self._mmap, self._offsets[section] + i * 4)[0]
+
+  def _u64(self, section: int, i: int) -> int:
+    return U64.unpack_from(self._mmap, self._offsets[section] + i * 8)[0]
+
+  def _digest_bytes(self, i: int) -> bytes:
+    offset = self._offsets[DIGESTS] + i * self.width
+    return self._mmap[offset:offset + self.width]
+
+  def digest(self, i: int) -> str:
+    return self._digest_bytes(i).rstrip(b"\0").decode()
+
+  def string(self, i: int) -> str:
+    start, end = self._u64(STRING_ENDS, i), self._u64(STRING_ENDS, i + 1)
+    offset = self._offsets[STRING_DATA]
+    return self._mmap[offset + start:offset + end].decode()
+
+  def image_identifier(self, image: int) -> str:
+    return self.string(self._u32(IMAGES, image))
+
+  # the position of the digest in the digest table
+  def find(self, digest: str) -> Optional[int]:
+    key = digest.encode()
+    if self.width < len(key):
+      return None
+    key = key.ljust(self.width, b"\0")
+    i = bisect_left(self._digest_keys, key)
+    if i < self.digest_count and self._digest_bytes(i) == key:
+      return i
+    return None
+
+  def _postings(self, i: int) -> Iterator[Tuple[str, str, str]]:
+    for j in range(self._u64(POSTING_STARTS, i), self._u64(POSTING_STARTS, i + 1)):
+      image, path = POSTING.unpack_from(self._mmap, self._offsets[POSTINGS] + j * POSTING.size)
+      image_name, image_digest = self.image_identifier(image).rsplit("@", 1)
+      yield image_name, image_digest, self.string(path)
+
+  # (image name, image digest, path) of the digest
+  @traced("index", "Snapshot.load")
+  def load(self, digest: str) -> list[Tuple[str, str, str]]:
+    i = self.find(digest)
+    if i is None:
+      return []
+    return list(self._postings(i))
+
+  def iter_digests(self) -> Iterator[str]:
+    for i in range(self.digest_count):
+      yield self.digest(i)
+
+  def iter_all(self) -> Iterator[Tuple[str, Tuple[str, str, str]]]:
+    for i in range(self.digest_count):
+      digest = self.digest(i)
+      for info in self._postings(i):
+        yield digest, info
+
+  def _tags_of(self, image: int) -> list[str]:
+    start, end = self._u64(IMAGE_TAG_STARTS, image), self._u64(IMAGE_TAG_STARTS, image + 1)
+    return [self.string(self._u32(IMAGE_TAGS, j)) for j in range(start, end)]
+
+  def image_tags(self, image_identifier: str) -> list[str]:
+    i = bisect_left(self._image_keys, image_identifier)
+    if i < self.image_count:
+      image = self._u32(IMAGE_ORDER, i)
+      if self.image_identifier(image) == image_identifier:
+        return self._tags_of(image)
+    return []
+
+  def find_images(self, tag: str) -> list[str]:
+    i = bisect_left(self._tag_keys, tag)
+    if i < len(self._tag_keys) and self._tag_keys[i] == tag:
+      start, end = self._u64(TAG_IMAGE_STARTS, i), self._u64(TAG_IMAGE_STARTS, i + 1)
+      return [self.image_identifier(self._u32(TAG_IMAGES, j)) for j in range(start, end)]
+    return []
+
+  # {image identifier: [tags...]} of the tagged images, as ImageIndex.load returns
+  def images(self) -> dict[str, list[str]]:
+    res = {}
+    for image in range(self.image_count):
+      tags = self._tags_of(image)
+      if len(tags) != 0:
+        res[self.image_identifier(image)] = tags
+    return res
+
+  def close(self):
+    self._mmap.close()
+
+def _pad(f, alignment=8):
+  f.write(b"\0" * (-f.tell() % alignment))
+
+# writes the rows of `source` and the tags of `images` ({image identifier: [tags...]}) into a new snapshot, which
+# replaces the one at `path` (default: snapshot.bin in the index directory) at once
+@traced("index")
+def export_snapshot(source: SnapshotSource, images: dict[str, list[str]], path: Optional[Union[PathLike, str]]=None):
+  path = Path(path) if path is not None else Snapshot.get_path(source.cache_dir)
+  width = max(source.max_digest_length(), 1)
+  strings: dict[str, int] = {}
+  def string_id(s: str):
+    i = strings.get(s)
+    if i is None:
+      i = strings[s] = len(strings)
+    return i
+  # by the order they are first seen. image_order sorts them afterwards
+  image_ids: dict[str, int] = {}
+  image_strings: list[int] = []
+  def image_id(identifier: str):
+    i = image_ids.get(identifier)
+    if i is None:
+      i = image_ids[identifier] = len(image_ids)
+      image_strings.append(string_id(identifier))
+    return i
+
+  path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = path.with_name(path.name + ".tmp")
+  # the two large sections are streamed into temporary files, and the rest is kept in memory
+  with tempfile.TemporaryFile() as digests, tempfile.TemporaryFile() as postings:
+    posting_starts = bytearray()
+    digest_count = posting_count = 0
+    current = None
+    for digest, (image_name, image_digest, lib_path) in source.iter_all():
+      if digest != current:
+        digests.write(digest.encode().ljust(width, b"\0"))
+        posting_starts += U64.pack(posting_count)
+        digest_count += 1
+        current = digest
+      postings.write(POSTING.pack(image_id(f"{image_name}@{image_digest}"), string_id(lib_path)))
+      posting_count += 1
+    posting_starts += U64.pack(posting_count)
+
+    image_tags: dict[int, list[int]] = {}
+    tag_images: dict[str, list[int]] = {}
+    for identifier, tags in images.items():
+      image = image_id(identifier)
+      for tag in tags:
+        image_tags.setdefault(image, []).append(string_id(tag))
+        tag_images.setdefault(tag, []).append(image)
+    image_tag_starts, image_tag_list = bytearray(), bytearray()
+    count = 0
+    for image in range(len(image_ids)):
+      image_tag_starts += U64.pack(count)
+      for tag in image_tags.get(image, []):
+        image_tag_list += U32.pack(tag)
+        count += 1
+    image_tag_starts += U64.pack(count)
+    sorted_tags = sorted(tag_images)
+    tag_image_starts, tag_image_list = bytearray(), bytearray()
+    count = 0
+    for tag in sorted_tags:
+      tag_image_starts += U64.pack(count)
+      for image in tag_images[tag]:
+        tag_image_list += U32.pack(image)
+        count += 1
+    tag_image_starts += U64.pack(count)
+
+    string_ends, string_data = bytearray(U64.pack(0)), bytearray()
+    for s in strings:
+      string_data += s.encode()
+      string_ends += U64.pack(len(string_data))
+    image_order = sorted(image_ids)
+
+    # (content, count) in the order of SNAPSHOT_SECTIONS
+    sections = [
+      (digests, digest_count),
+      (bytes(posting_starts), digest_count + 1),
+      (postings, posting_count),
+      (bytes(string_ends), len(strings) + 1),
+      (bytes(string_data), len(string_data)),
+      (b"".join(U32.pack(s) for s in image_strings), len(image_strings)),
+      (b"".join(U32.pack(image_ids[identifier]) for identifier in image_order), len(image_order)),
+      (bytes(image_tag_starts), len(image_ids) + 1),
+      (bytes(image_tag_list), len(image_tag_list) // 4),
+      (b"".join(U32.pack(strings[tag]) for tag in sorted_tags), len(sorted_tags)),
+      (bytes(tag_image_starts), len(sorted_tags) + 1),
+      (bytes(tag_image_list), len(tag_image_list) // 4),
+    ]
+    with open(tmp_path, "w+b") as f:
+      f.write(b"\0" * SNAPSHOT_HEADER.size)
+      table_offset = f.tell()
+      f.write(b"\0" * (SNAPSHOT_SECTION.size * len(sections)))
+      table = bytearray()
+      for content, count in sections:
+        _pad(f)
+        table += SNAPSHOT_SECTION.pack(f.tell(), count)
+        if isinstance(content, bytes):
+          f.write(content)
+        else:
+          content.seek(0)
+          shutil.copyfileobj(content, f)
+      f.seek(table_offset)
+      f.write(table)
+      f.seek(table_offset)
+      h = hashlib.sha256()
+      while chunk := f.read(1 << 20):
+        h.update(chunk)
+      content_hash = U64.unpack(h.digest()[:8])[0]
+      f.seek(0)
+      f.write(SNAPSHOT_HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, width, len(sections), content_hash))
+  # an unchanged file is left as it is
+  try:
+    previous = Snapshot(path) if path.exists() else None
+  except ValueError:
+    previous = None
+  if previous is not None:
+    unchanged = previous.content_hash == content_hash
+    previous.close()
+    if unchanged:
+      tmp_path.unlink()
+      logger.info(f"{path} is up to date ({digest_count} digests, {posting_count} rows and {len(image_ids)} images)")
+      return path
+  os.replace(tmp_path, path)
+  logger.info(f"exported {digest_count} digests, {posting_count} rows and {len(image_ids)} images into {path}")
+  return path
@@ -0,0 +1,206 @@
+import gzip
+import hashlib
+import json
+import os
+from os import PathLike
+from pathlib import Path
+import shutil
+import time
+from typing import Any, Optional, Tuple, Union
+from urllib.error import HTTPError
+from urllib.request import urlopen
+
+from preplib.index import ImageIndex, LibIndex, LibInfo, ManifestEntry
+from preplib.logger import logger
+from preplib.timing import span, traced
+
+# append-only deltas of the index, written by the indexer next to the shards:
+#   deltas/manifest.json             {"version": 1, "stream": <id>, "lib_rowid": <last exported rowid of the libs table>,
+#                                     "images": {<image>: [<published tag>...]},
+#                                     "segments": [{"id", "path", "sha256", "size", "libs", "images", "manifests", "symbols", "created_at"}, ...]}
+#   deltas/segments/<id>.json.gz     {"libs": [[digest, image_name, image_digest, path], ...], "images": [[image, tag], ...],
+#                                     "manifests": [[image_digest, *ManifestEntry], ...], "symbols": [[name, offset, md5], ...]}
+# the manifests and symbols of a segment are those of the images and libraries its rows add.
+# segments are numbered from 1 and never rewritten. the first one of a stream holds the whole index, the others only
+# the rows added since the previous one. a new stream (with a new id) starts over when the history can not be followed
+DELTA_FORMAT_VERSION = 1
+
+def _segment_path(segment_id: int):
+  return f"segments/{segment_id:06}.json.gz"
+
+def _read_manifest(delta_dir: Path) -> Optional[dict[str, Any]]:
+  manifest_path = delta_dir / "manifest.json"
+  if not manifest_path.exists(): return None
+  manifest = json.loads(manifest_path.read_text())
+  if manifest.get("version") != DELTA_FORMAT_VERSION:
+    raise ValueError(f"unsupported delta format version: {manifest.get('version')}")
+  return manifest
+
+def _read_segment(data: bytes) -> dict[str, list[list[str]]]:
+  return json.loads(gzip.decompress(data))
+
+@traced("index")
+def export_deltas(lib_index: LibIndex, image_index: ImageIndex, delta_dir: Union[PathLike, str]):
+  delta_dir = Path(delta_dir)
+  manifest = _read_manifest(delta_dir)
+  if manifest is not None and lib_index.max_rowid() < manifest["lib_rowid"]:
+    # the libs table was rebuilt, so its rowids no longer continue the published ones
+    logger.warning(f"the index has fewer rows than {delta_dir} has published. starting a new delta stream")
+    manifest = None
+  if manifest is None:
+    shutil.rmtree(delta_dir / "segments", ignore_errors=True)
+    manifest = { "version": DELTA_FORMAT_VERSION, "stream": os.urandom(8).hex(), "lib_rowid": 0, "images": {}, "segments": [] }
+  if "images" not in manifest:
+    # written before the published tags were kept in the manifest
+    manifest["images"] = {}
+    for segment in manifest["segments"]:
+      for image, tag in _read_segment((delta_dir / segment["path"]).read_bytes())["images"]:
+        manifest["images"].setdefault(image, []).append(tag)
+
+  published: set[Tuple[str, str]] = { (image, tag) for image, tags in manifest["images"].items() for tag in tags }
+  images = [[image, tag] for image, tags in image_index.load().items() for tag in tags if (image, tag) not in published]
+  rows = lib_index.rows_after(manifest["lib_rowid"])
+  if len(rows) == 0 and len(images) == 0:
+    logger.info(f"no changes to publish into {delta_dir}")
+    return None
+
+  image_digests = sorted({ info.image_digest for _, _, info in rows })
+  manifests = [[image_digest, *entry] for image_digest in image_digests for entry in lib_index.load_manifest(image_digest)]
+  symbols = [list(symbol) for symbol in lib_index.load_symbols({ digest for _, digest, _ in rows })]
+
+  segment_id = len(manifest["segments"]) + 1
+  rel_path = _segment_path(segment_id)
+  content = { "libs": [[digest, *info] for _, digest, info in rows], "images": images, "manifests": manifests, "symbols": symbols }
+  # mtime=0 keeps the same content byte-identical
+  data = gzip.compress(json.dumps(content).encode(), mtime=0)
+  segment_path = delta_dir / rel_path
+  segment_path.parent.mkdir(parents=True, exist_ok=True)
+  segment_path.write_bytes(data)
+  manifest["segments"].append({
+    "id": segment_id,
+    "path": rel_path,
+    "sha256": hashlib.sha256(data).hexdigest(),
+    "size": len(data),
+    "libs": len(rows),
+    "images": len(images),
+    "manifests": len(manifests),
+    "symbols": len(symbols),
+    "created_at": int(time.time()),
+  })
+  if len(rows) != 0:
+    manifest["lib_rowid"] = rows[-1][0]
+  for image, tag in images:
+    manifest["images"].setdefault(image, []).append(tag)
+  # the manifest is replaced last, so that it never lists a segment that is not there
+  tmp_path = delta_dir / "manifest.json.tmp"
+  tmp_path.write_text(json.dumps(manifest, indent=1))
+  os.replace(tmp_path, delta_dir / "manifest.json")
+  logger.info(f"published delta segment {segment_id} ({len(rows)} library rows, {len(images)} image tags, {len(manifests)} manifest entries, {len(symbols)} symbols, {len(data)} bytes) into {delta_dir}")
+  return segment_id
+
+# a directory (such as a clone of the data repository) or an http(s) base URL with deltas/ under it
+class DeltaSource:
+  def __init__(self, base: str):
+    self.base = base.rstrip("/")
+
+  def is_remote(self):
+    return self.base.startswith("http://") or self.base.startswith("https://")
+
+  def read(self, rel_path: str) -> bytes:
+    if not self.is_remote():
+      return (Path(self.base) / "deltas" / rel_path).read_bytes()
+    url = f"{self.base}/deltas/{rel_path}"
+    logger.debug(f"fetching {url}...")
+    try:
+      with span("remote", "fetch", url=url) as span_args, urlopen(url, timeout=60) as res:
+        body = res.read()
+        span_args["bytes_read"] = len(body)
+        return body
+    except HTTPError as e:
+      if e.code == 404:
+        raise FileNotFoundError(f"{url} not found")
+      raise
+
+  def manifest(self) -> dict[str, Any]:
+    try:
+      manifest = json.loads(self.read("manifest.json"))
+    except FileNotFoundError:
+      raise ValueError(f"no delta segments published in {self.base}")
+    if manifest.get("version") != DELTA_FORMAT_VERSION:
+      raise ValueError(f"unsupported delta format version: {manifest.get('version')}")
+    return manifest
+
+# sync.json: the source, its stream and the last segment applied to the index in the directory
+def _get_sync_state_path(index_dir: Union[PathLike, str]):
+  return Path(index_dir) / "sync.json"
+
+def load_sync_state(index_dir: Union[PathLike, str]) -> dict[str, Any]:
+  state_path = _get_sync_state_path(index_dir)
+  if not state_path.exists(): return {}
+  try:
+    return json.loads(state_path.read_text())
+  except ValueError:
+    logger.warning(f"corrupt sync state: {state_path}")
+    return {}
+
+def dump_sync_state(index_dir: Union[PathLike, str], state: dict[str, Any]):
+  state_path = _get_sync_state_path(index_dir)
+  state_path.parent.mkdir(parents=True, exist_ok=True)
+  tmp_path = state_path.with_name(state_path.name + ".tmp")
+  tmp_path.write_text(json.dumps(state))
+  os.replace(tmp_path, state_path)
+
+# apply the segments after the local watermark. both tables ignore rows they already have, so a segment that
+# was applied twice (e.g. after a crash before the state was written) changes nothing
+@traced("index")
+def sync_index(source: str, index_dir: Union[PathLike, str]) -> int:
+  delta_source = DeltaSource(source)
+  manifest = delta_source.manifest()
+  state = load_sync_state(index_dir)
+  watermark = state.get("segment", 0)
+  # the watermark describes the database, which may have been removed since
+  if not LibIndex(index_dir).exists():
+    watermark = 0
+  # a clone and a mirror of the same data publish the same stream, so only the stream decides where to continue
+  if state.get("stream") != manifest["stream"]:
+    if watermark != 0:
+      logger.info(f"{delta_source.base} publishes another delta stream. syncing it from the start")
+    watermark = 0
+
+  segments = [segment for segment in manifest["segments"] if watermark < segment["id"]]
+  if len(segments) == 0:
+    logger.info(f"the index in {index_dir} is up to date (segment {watermark})")
+    return 0
+  logger.info(f"fetching {len(segments)} delta segments ({sum(segment['size'] for segment in segments)} bytes) from {delta_source.base}...")
+
+  lib_index = LibIndex(index_dir)
+  image_index = ImageIndex(index_dir)
+  for segment in segments:
+    data = delta_source.read(segment["path"])
+    if hashlib.sha256(data).hexdigest() != segment["sha256"]:
+      raise ValueError(f"delta segment {segment['id']} does not match its sha256")
+    content = _read_segment(data)
+    # segments published before manifests and symbols were included have neither
+    lib_index.add_many(
+      ((digest, LibInfo(*info)) for digest, *info in content["libs"]),
+      ((image_digest, ManifestEntry(*entry)) for image_digest, *entry in content.get("manifests", [])),
+      ((name, offset, md5) for name, offset, md5 in content.get("symbols", [])),
+    )
+    for image, tag in content["images"]:
+      image_index.add(image, tag)
+    dump_sync_state(index_dir, { "source": delta_source.base, "stream": manifest["stream"], "segment": segment["id"] })
+    logger.debug(f"applied delta segment {segment['id']} ({segment['libs']} library rows, {segment['images']} image tags)")
+  image_index.compact()
+  logger.info(f"synced {index_dir} to segment {segments[-1]['id']}")
+  return len(segments)
+
+# snapshot.bin and the legacy layout carry the library rows only, and the manifests and symbols are published in the
+# delta segments alone. an index directory with deltas/ of its own (a clone of the data repository, or the indexer's)
+# follows them, so that its database has the manifests and symbols too
+def sync_local_deltas(index_dir: Union[PathLike, str]) -> int:
+  manifest = _read_manifest(Path(index_dir) / "deltas")
+  if manifest is None or len(manifest["segments"]) == 0: return 0
+  state = load_sync_state(index_dir)
+  if LibIndex(index_dir).exists() and state.get("stream") == manifest["stream"] and manifest["segments"][-1]["id"] <= state.get("segment", 0):
+    return 0
+  return sync_index(str(index_dir), index_dir)
@@ -0,0 +1,194 @@
+from contextlib import contextmanager
+from functools import wraps
+import json
+import os
+from os import PathLike
+import subprocess
+import sys
+import threading
+import time
+from typing import Any, Callable, Iterator, NamedTuple, Optional, TextIO, Union
+
+class Span(NamedTuple):
+  # "phase" for the steps of a command, "subprocess", "index" or "remote" for the operations inside them
+  category: str
+  name: str
+  # seconds since the recorder was created
+  start: float
+  duration: float
+  thread_id: int
+  # e.g. the command line, bytes_read and bytes_written, results
+  args: dict[str, Any]
+
+class Recorder:
+  def __init__(self):
+    self.origin = time.perf_counter()
+    self.spans: list[Span] = []
+    self._lock = threading.Lock()
+    self._phase: Optional[tuple[str, float]] = None
+
+  def _append(self, category: str, name: str, start: float, end: float, args: dict[str, Any]):
+    with self._lock:
+      self.spans.append(Span(category, name, start - self.origin, end - start, threading.get_ident(), args))
+
+  @contextmanager
+  def span(self, category: str, name: str, **args: Any) -> Iterator[dict[str, Any]]:
+    start = time.perf_counter()
+    try:
+      # the caller may add the sizes it finds out on the way
+      yield args
+    finally:
+      self._append(category, name, start, time.perf_counter(), args)
+
+  # ends the current phase and starts the next one. None only ends it
+  def phase(self, name: Optional[str]):
+    now = time.perf_counter()
+    if self._phase is not None:
+      self._append("phase", self._phase[0], self._phase[1], now, {})
+    self._phase = (name, now) if name is not None else None
+
+  # the spans that ran inside `parent` on its thread
+  def children(self, parent: Span) -> list[Span]:
+    return [
+      span for span in self.spans
+      if span is not parent and span.thread_id == parent.thread_id and parent.start <= span.start < parent.start + parent.duration
+    ]
+
+  def wall_time(self):
+    return time.perf_counter() - self.origin
+
+  # [(phase span or None, [(category, name, count, total, max, bytes_read, bytes_written)])], in the order of the phases.
+  # an operation belongs to the phase it started in
+  def breakdown(self):
+    phases: list[Optional[Span]] = sorted((span for span in self.spans if span.category == "phase"), key=lambda span: span.start)
+    phases.append(None)
+    # by the position in `phases`
+    groups: list[dict[tuple[str, str], list[Span]]] = [{} for _ in phases]
+    for span in self.spans:
+      if span.category == "phase": continue
+      i = next((i for i, phase in enumerate(phases) if phase is None or phase.start <= span.start < phase.start + phase.duration), len(phases) - 1)
+      groups[i].setdefault((span.category, span.name), []).append(span)
+    res = []
+    for phase, group in zip(phases, groups):
+      rows = []
+      for (category, name), spans in group.items():
+        rows.append((
+          category, name, len(spans), sum(span.duration for span in spans), max(span.duration for span in spans),
+          sum(span.args.get("bytes_read", 0) for span in spans), sum(span.args.get("bytes_written", 0) for span in spans),
+        ))
+      rows.sort(key=lambda row: -row[3])
+      if phase is not None or len(rows) != 0:
+        res.append((phase, rows))
+    return res
+
+  def print_breakdown(self, file: TextIO=sys.stderr):
+    print(f"profile: {self.wall_time():.3f}s since start", file=file)
+    for phase, rows in self.breakdown():
+      if phase is not None:
+        print(f"  {phase.name:54} {phase.duration:9.3f}s", file=file)
+      else:
+        print("  (outside of the phases)", file=file)
+      for category, name, count, total, longest, bytes_read, bytes_written in rows:
+        sizes = ""
+        if bytes_read or bytes_written:
+          sizes = f"  read {format_size(bytes_read)}, written {format_size(bytes_written)}"
+        print(f"    {category + ' ' + name:52} {total:9.3f}s {count:5}x  max {longest:.3f}s{sizes}", file=file)
+
+  # the Trace Event Format of chrome://tracing and https://ui.perfetto.dev
+  def chrome_trace(self):
+    pid = os.getpid()
+    return {
+      "traceEvents": [
+        {
+          "name": span.name, "cat": span.category, "ph": "X", "pid": pid, "tid": span.thread_id,
+          "ts": round(span.start * 1e6, 3), "dur": round(span.duration * 1e6, 3), "args": span.args,
+        }
+        for span in sorted(self.spans, key=lambda span: span.start)
+      ],
+      "displayTimeUnit": "ms",
+    }
+
+  def to_json(self):
+    return {
+      "wall_time": self.wall_time(),
+      "phases": [
+        {
+          "name": phase.name if phase is not None else None,
+          "duration": phase.duration if phase is not None else None,
+          "operations": [
+            { "category": category, "name": name, "count": count, "total": total, "max": longest, "bytes_read": bytes_read, "bytes_written": bytes_written }
+            for category, name, count, total, longest, bytes_read, bytes_written in rows
+          ],
+        }
+        for phase, rows in self.breakdown()
+      ],
+      "spans": [span._asdict() for span in sorted(self.spans, key=lambda span: span.start)],
+    }
+
+  # chrome: the trace of every span. json: the breakdown and the spans
+  def dump(self, path: Union[PathLike, str], format="chrome"):
+    data = self.chrome_trace() if format == "chrome" else self.to_json()
+    with open(path, "w") as f:
+      json.dump(data, f, default=str)
+
+def format_size(size: float):
+  for unit in ["B", "KB", "MB"]:
+    if size < 1024:
+      return f"{size:.0f}{unit}" if unit == "B" else f"{size:.1f}{unit}"
+    size /= 1024
+  return f"{size:.1f}GB"
+
+_recorder: Optional[Recorder] = None
+
+def get_recorder():
+  return _recorder
+
+# None (the default) disables the recording, and then the helpers below only run the operations
+def set_recorder(recorder: Optional[Recorder]):
+  global _recorder
+  _recorder = recorder
+
+@contextmanager
+def span(category: str, name: str, **args: Any) -> Iterator[dict[str, Any]]:
+  recorder = _recorder
+  if recorder is None:
+    yield args
+    return
+  with recorder.span(category, name, **args) as span_args:
+    yield span_args
+
+def phase(name: Optional[str]):
+  if _recorder is not None:
+    _recorder.phase(name)
+
+# records every call of the function, with the number of results if it returns a collection
+def traced(category: str, name: Optional[str]=None):
+  def decorator(fn: Callable):
+    span_name = name or fn.__qualname__
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+      recorder = _recorder
+      if recorder is None:
+        return fn(*args, **kwargs)
+      with recorder.span(category, span_name) as span_args:
+        res = fn(*args, **kwargs)
+        if hasattr(res, "__len__"):
+          span_args["results"] = len(res)
+        return res
+    return wrapper
+  return decorator
+
+# subprocess.check_output, recorded with the command line and the size of its input and output
+def check_output(command: list[str], label: Optional[str]=None, **kwargs: Any) -> bytes:
+  recorder = _recorder
+  if recorder is None:
+    return subprocess.check_output(command, **kwargs)
+  command_line = " ".join(command)
+  if len(command_line) > 1000:
+    command_line = command_line[:1000] + "..."
+  with recorder.span("subprocess", label or " ".join(command[:2]), command=command_line) as span_args:
+    if kwargs.get("input") is not None:
+      span_args["bytes_written"] = len(kwargs["input"])
+    output = subprocess.check_output(command, **kwargs)
+    span_args["bytes_read"] = len(output)
+    return output
@@ -1,8 +1,19 @@
+from contextlib import contextmanager
 from dataclasses import dataclass
+import fcntl
+import os
 from os import PathLike
 from pathlib import Path
-from subprocess import check_output
-from typing import Union
+import shutil
+import stat
+import subprocess
+from subprocess import CalledProcessError
+import threading
+from typing import Iterator, Optional, Union
+
+from preplib.logger import logger
+from preplib.metacache import get_metadata_cache
+from preplib.timing import check_output, span
 
 @dataclass
 class MountOption:
@@ -16,24 +27,122 @@ dest_scripts_path = Path("/preplib_scripts")
 def get_script_path(script_name):
   return str(dest_scripts_path / script_name)
 
-def run_docker(image_name: str, *commands: str, extra_args=[], mounts: list[MountOption]=[], mount_scripts=False):
-  run_command = ["docker", "run", *extra_args, "--rm"]
+def _mount_args(mounts: list[MountOption], mount_scripts: bool):
   if mount_scripts:
     mounts = mounts + [MountOption(source_scripts_path, dest_scripts_path)]
+  args = []
   for mount in mounts:
     assert ":" not in f"{mount.source}" and ":" not in f"{mount.dest}"
     if mount.allow_write:
-      run_command += ["-v", f"{mount.source}:{mount.dest}"]
+      args += ["-v", f"{mount.source}:{mount.dest}"]
     else:
-      run_command += ["-v", f"{mount.source}:{mount.dest}:ro"]
-  run_command += [image_name]
-  run_command += commands
-  
-  return check_output(run_command)
+      args += ["-v", f"{mount.source}:{mount.dest}:ro"]
+  return args
+
+def docker_run_command(image_name: str, *commands: str, extra_args=[], mounts: list[MountOption]=[], mount_scripts=False):
+  return ["docker", "run", *extra_args, "--rm", *_mount_args(mounts, mount_scripts), image_name, *commands]
+
+# a session container is removed by itself after this, in case the process that started it was killed
+SESSION_TIMEOUT = 60 * 60
+
+# one container of the image that stays up while the session is open, so that every command runs by `docker exec`
+# instead of starting a container of its own. the mounts are attached when it starts, which is on the first command
+class ContainerSession:
+  def __init__(self, image_name: str, mounts: list[MountOption]=[], mount_scripts=True):
+    self.image_name = image_name
+    self.mounts = mounts
+    self.mount_scripts = mount_scripts
+    self.container_id: Optional[str] = None
+    # e.g. the image has no `sleep` (distroless). the commands are run in their own containers then
+    self.failed = False
+
+  def covers(self, mounts: list[MountOption], mount_scripts: bool):
+    return (self.mount_scripts or not mount_scripts) and all(mount in self.mounts for mount in mounts)
+
+  def start(self):
+    if self.container_id is None and not self.failed:
+      command = [
+        "docker", "run", "-d", "--rm", *_mount_args(self.mounts, self.mount_scripts),
+        "--entrypoint", "sleep", self.image_name, str(SESSION_TIMEOUT)
+      ]
+      try:
+        self.container_id = check_output(command, label="docker run session", stderr=subprocess.PIPE).decode().strip()
+        logger.debug(f"started a session container {self.container_id} of {self.image_name}")
+      except CalledProcessError as e:
+        logger.debug(f"could not start a session container of {self.image_name}: {e.stderr.decode(errors='replace').strip()}")
+        self.failed = True
+    return self.container_id is not None
+
+  def exec_command(self, *commands: str):
+    assert self.container_id is not None
+    return ["docker", "exec", self.container_id, *commands]
+
+  def close(self):
+    if self.container_id is None: return
+    with span("subprocess", "docker rm", command=f"docker rm -f {self.container_id}"):
+      subprocess.run(["docker", "rm", "-f", self.container_id], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    self.container_id = None
+
+# the sessions opened by container_session in this thread, by image name
+_sessions = threading.local()
+
+def get_container_session(image_name: str) -> Optional[ContainerSession]:
+  return getattr(_sessions, "by_image", {}).get(image_name)
 
+# while this is open, run_docker and extract_libraries of the image share one container.
+# the commands that need other mounts than `mounts` still start their own
+@contextmanager
+def container_session(image_name: str, mounts: list[MountOption]=[], mount_scripts=True) -> Iterator[ContainerSession]:
+  sessions = getattr(_sessions, "by_image", None)
+  if sessions is None:
+    sessions = _sessions.by_image = {}
+  if image_name in sessions:
+    yield sessions[image_name]
+    return
+  session = sessions[image_name] = ContainerSession(image_name, mounts, mount_scripts)
+  try:
+    yield session
+  finally:
+    del sessions[image_name]
+    session.close()
+
+# `docker exec` in the session of the image if one is open and has the mounts, otherwise `docker run`.
+# returns the command and "exec" or "run"
+def docker_command(image_name: str, *commands: str, mounts: list[MountOption]=[], mount_scripts=False):
+  session = get_container_session(image_name)
+  if session is not None and session.covers(mounts, mount_scripts) and session.start():
+    return session.exec_command(*commands), "exec"
+  return docker_run_command(image_name, *commands, mounts=mounts, mount_scripts=mount_scripts), "run"
+
+# `label` names the command in the profile, e.g. "ldd" is recorded as "docker exec ldd" or "docker run ldd"
+def run_docker(image_name: str, *commands: str, extra_args=[], mounts: list[MountOption]=[], mount_scripts=False, label: Optional[str]=None):
+  if len(extra_args) != 0:
+    command, how = docker_run_command(image_name, *commands, extra_args=extra_args, mounts=mounts, mount_scripts=mount_scripts), "run"
+  else:
+    command, how = docker_command(image_name, *commands, mounts=mounts, mount_scripts=mount_scripts)
+  return check_output(command, label=f"docker {how} {label or Path(commands[0]).name}")
+
+_resolved_digests: dict[str, str] = {}
+_resolved_lock = threading.Lock()
+
+# the digest of the image the tag points at right now. a tag moves on `docker pull`, so it is asked on every run and only
+# kept for the rest of this process, unless the metadata cache is disabled. images without a repository digest (e.g. built locally) are keyed by their id
 def get_image_digest(image_name: str):
-  # RepoDigests returns the list of repository@sha256:... style string
-  return check_output(["docker", "inspect", "--format={{index .RepoDigests 0}}", image_name]).decode().strip().split("@")[1]
+  # the indexer disables the cache, and it pulls tags while it runs
+  memoize = get_metadata_cache() is not None
+  with _resolved_lock:
+    if memoize and image_name in _resolved_digests:
+      return _resolved_digests[image_name]
+  output = check_output(["docker", "inspect", "--format={{range .RepoDigests}}{{.}} {{end}}{{.Id}}", image_name], label="docker inspect").decode().split()
+  repo_digests, image_id = output[:-1], output[-1]
+  repository = image_name.rsplit(":", 1)[0] if ":" in image_name.split("/")[-1] else image_name
+  # RepoDigests lists every repository the image was pulled from, so prefer the one that was asked for
+  matched = [repo_digest for repo_digest in repo_digests if repo_digest.rsplit("@", 1)[0] in (repository, f"docker.io/{repository}", f"docker.io/library/{repository}")]
+  image_digest = (matched or repo_digests or [f"@{image_id}"])[0].rsplit("@", 1)[1]
+  if memoize:
+    with _resolved_lock:
+      _resolved_digests[image_name] = image_digest
+  return image_digest
 
 def parse_image_name(image_name: str):
   last_part = image_name.split("/")[-1]
@@ -53,3 +162,27 @@ def is_digest_like(s: str):
   if not all(c in "0123456789abcdef" for c in s):
     return False
   return len(s) in [32, 40, 64, 128]
+
+# shorter prefixes match too many digests to be useful
+MIN_DIGEST_PREFIX_LENGTH = 8
+
+def is_digest_prefix_like(s: str):
+  if not all(c in "0123456789abcdef" for c in s.lower()):
+    return False
+  return MIN_DIGEST_PREFIX_LENGTH <= len(s) <= 128
+
+# linux/fs.h
+FICLONE = 0x40049409
+
+# copy a cached file into an output directory. the copy is a reflink where the filesystem supports it (btrfs, xfs),
+# and never shares its inode with the cache, so patching or editing the output leaves the cache intact.
+# the owner can write the copy even if the cached file is read-only
+def copy_file(src: Union[PathLike, str], dst: Union[PathLike, str]):
+  # dst may be a hardlink to a cached file made by an older version
+  Path(dst).unlink(missing_ok=True)
+  with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+    try:
+      fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+    except OSError:
+      shutil.copyfileobj(fsrc, fdst, 1 << 20)
+  os.chmod(dst, stat.S_IMODE(os.stat(src).st_mode) | stat.S_IWUSR)
@@ -0,0 +1,197 @@
+import hashlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+from pathlib import Path
+import threading
+import time
+from typing import Any, Optional
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from preplib.elf import ElfFile
+
+FAKE_DOCKER_DIR = Path(__file__).parent.parent / "benchmarks" / "fake_docker"
+
+def tag_info(name: str, last_updated: str, size=1_000_000):
+  digest = "sha256:" + hashlib.sha256(name.encode()).hexdigest()
+  return {
+    "name": name,
+    "last_updated": last_updated,
+    "digest": digest,
+    "full_size": size,
+    "images": [{ "architecture": "amd64", "digest": digest, "size": size }],
+  }
+
+# a stand-in for the tag listing of Docker Hub and the release list of endoflife.date. the files under `root` are
+# served as well, e.g. the published data repository or the /buildid/ tree of a debuginfod server
+class Hub:
+  def __init__(self):
+    # repository -> tag infos, newest first as ordering=last_updated lists them
+    self.tags: dict[str, list[dict[str, Any]]] = {}
+    self.releases: dict[str, list[dict[str, str]]] = { "ubuntu": [{ "codename": "Jammy Jellyfish", "cycle": "22.04" }] }
+    self.page_size = 2
+    # path (with the query) -> connections to close without a response
+    self.drops: dict[str, int] = {}
+    self.requests: list[str] = []
+    # the status of each response, in the order they were sent
+    self.statuses: list[int] = []
+    self.url = ""
+    self.root: Optional[Path] = None
+    # seconds each response is held back, and the most requests that were in flight at once
+    self.delay = 0.0
+    self.in_flight = 0
+    self.max_in_flight = 0
+    self.lock = threading.Lock()
+
+  def body(self, path: str) -> Optional[bytes]:
+    url = urlparse(path)
+    if self.root is not None:
+      file_path = self.root / url.path.lstrip("/")
+      return file_path.read_bytes() if file_path.is_file() else None
+    if url.path.startswith("/api/") and url.path.endswith(".json"):
+      releases = self.releases.get(url.path[len("/api/"):-len(".json")])
+      return json.dumps(releases).encode() if releases is not None else None
+    parts = url.path.strip("/").split("/")
+    if len(parts) != 5 or parts[:2] != ["v2", "repositories"] or parts[4] != "tags":
+      return None
+    repository = f"{parts[2]}/{parts[3]}"
+    query = parse_qs(url.query)
+    page, page_size = int(query["page"][0]), int(query["page_size"][0])
+    # the page size of the client is ignored, so that a few tags span several pages
+    page_size = min(page_size, self.page_size)
+    tags = self.tags.get(repository, [])
+    results = tags[(page - 1) * page_size:page * page_size]
+    nxt = None
+    if page * page_size < len(tags):
+      nxt = f"{self.url}/v2/repositories/{repository}/tags?ordering=last_updated&page={page + 1}&page_size={page_size}"
+    return json.dumps({ "count": len(tags), "next": nxt, "results": results }).encode()
+
+  def pages_requested(self, repository: str):
+    return [parse_qs(urlparse(path).query)["page"][0] for path in self.requests if f"/repositories/{repository}/tags" in path]
+
+class HubHandler(BaseHTTPRequestHandler):
+  server: "HubServer"
+
+  def do_GET(self):
+    hub = self.server.hub
+    with hub.lock:
+      hub.requests.append(self.path)
+      hub.in_flight += 1
+      hub.max_in_flight = max(hub.max_in_flight, hub.in_flight)
+    try:
+      time.sleep(hub.delay)
+      self.respond(hub)
+    finally:
+      with hub.lock:
+        hub.in_flight -= 1
+
+  def respond(self, hub: Hub):
+    if hub.drops.get(self.path, 0) != 0:
+      # the connection is closed before any response
+      hub.drops[self.path] -= 1
+      self.close_connection = True
+      return
+    body = hub.body(self.path)
+    if body is None:
+      hub.statuses.append(404)
+      self.send_error(404)
+      return
+    etag = '"' + hashlib.sha256(body).hexdigest() + '"'
+    if self.headers.get("If-None-Match") == etag:
+      hub.statuses.append(304)
+      self.send_response(304)
+      self.send_header("ETag", etag)
+      self.end_headers()
+      return
+    hub.statuses.append(200)
+    self.send_response(200)
+    self.send_header("Content-Type", "application/json")
+    self.send_header("Content-Length", str(len(body)))
+    self.send_header("ETag", etag)
+    self.end_headers()
+    self.wfile.write(body)
+
+  def log_message(self, format, *args):
+    pass
+
+class HubServer(ThreadingHTTPServer):
+  daemon_threads = True
+
+  def __init__(self, hub: Hub):
+    self.hub = hub
+    super().__init__(("127.0.0.1", 0), HubHandler)
+
+# starts another Hub on each call
+@pytest.fixture
+def make_hub():
+  servers: list[HubServer] = []
+  def make():
+    hub = Hub()
+    server = HubServer(hub)
+    hub.url = f"http://127.0.0.1:{server.server_address[1]}"
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    servers.append(server)
+    return hub
+  yield make
+  for server in servers:
+    server.shutdown()
+    server.server_close()
+
+@pytest.fixture
+def hub(make_hub):
+  return make_hub()
+
+# benchmarks/fake_docker/docker first in PATH, with its own state directory and command log
+class FakeDocker:
+  def __init__(self, monkeypatch: pytest.MonkeyPatch, work_dir: Path):
+    self.monkeypatch = monkeypatch
+    self.log_path = work_dir / "docker.log"
+    monkeypatch.setenv("PATH", f"{FAKE_DOCKER_DIR}{os.pathsep}{os.environ['PATH']}")
+    monkeypatch.setenv("PREPLIB_FAKE_DOCKER_STATE", str(work_dir / "docker-state"))
+    monkeypatch.setenv("PREPLIB_FAKE_DOCKER_LOG", str(self.log_path))
+    # few libraries and symbols keep an image scan fast
+    monkeypatch.setenv("PREPLIB_FAKE_DOCKER_LIBS", "10")
+    monkeypatch.setenv("PREPLIB_FAKE_DOCKER_SYMS", "20")
+
+  def fail(self, *rules: str):
+    self.monkeypatch.setenv("PREPLIB_FAKE_DOCKER_FAIL", ",".join(rules))
+
+  def commands(self, name: Optional[str]=None) -> list[str]:
+    if not self.log_path.exists(): return []
+    lines = self.log_path.read_text().splitlines()
+    return [line for line in lines if name is None or line.startswith(name + " ")]
+
+@pytest.fixture
+def fake_docker(monkeypatch: pytest.MonkeyPatch, tmp_path: Path):
+  return FakeDocker(monkeypatch, tmp_path)
+
+@pytest.fixture
+def no_backoff(monkeypatch: pytest.MonkeyPatch):
+  import indexer
+  monkeypatch.setattr(indexer.time, "sleep", lambda seconds: None)
+
+# a Crawler of the stand-in hub with small limits
+def make_crawler(index_dir: Path, hub: Hub, **kwargs):
+  from indexer import Crawler, HttpClient
+  options = dict(jobs=2, prefetch=2, max_pulls=2, disk_budget=1024 ** 3, retries=2, batch_size=2)
+  options.update(kwargs)
+  return Crawler(index_dir, HttpClient(None), hub_url=hub.url, endoflife_url=hub.url, **options)
+
+# small shared objects of the host, for the synthetic images and debug files of the tests
+def host_libraries(count: int, with_build_id=False) -> list[bytes]:
+  found: dict[str, bytes] = {}
+  for d in ["/lib/x86_64-linux-gnu", "/usr/lib/x86_64-linux-gnu", "/lib64", "/usr/lib64", "/lib", "/usr/lib"]:
+    if not os.path.isdir(d): continue
+    for name in os.listdir(d):
+      path = os.path.realpath(os.path.join(d, name))
+      if ".so" not in name or path in found or not os.path.isfile(path) or 1 << 20 < os.path.getsize(path): continue
+      with open(path, "rb") as f:
+        data = f.read()
+      if data.startswith(b"\x7fELF") and (not with_build_id or ElfFile(data).build_id() is not None):
+        found[path] = data
+  if len(found) < count:
+    pytest.skip("not enough shared objects on this host")
+  # the same ones on every run, and all different
+  return [data for _, data in sorted(found.items())[:count]]
@@ -0,0 +1,119 @@
+import json
+from pathlib import Path
+import threading
+import time
+
+import pytest
+
+import indexer
+from indexer import DiskBudget, HttpClient
+from preplib.index import ImageIndex
+
+from conftest import make_crawler, tag_info
+
+REPOSITORY = "library/ubuntu"
+
+def test_http_client_retries_dropped_connections(hub, tmp_path: Path):
+  path = "/api/ubuntu.json"
+  hub.drops[path] = 2
+  http = HttpClient(tmp_path / "http-cache")
+  assert http.get_json(hub.url + path) == hub.releases["ubuntu"]
+  assert hub.requests.count(path) == 3
+
+def test_failed_pull_is_retried(hub, fake_docker, no_backoff, tmp_path: Path):
+  hub.tags[REPOSITORY] = [tag_info("jammy-20240102", "2024-01-02T00:00:00Z"), tag_info("jammy-20240101", "2024-01-01T00:00:00Z")]
+  fake_docker.fail("pull ubuntu:jammy-20240102=1")
+  crawler = make_crawler(tmp_path, hub)
+  crawler.run([REPOSITORY], set())
+  assert sorted(crawler.indexed) == ["jammy-20240101", "jammy-20240102"]
+  assert crawler.failed == []
+  assert fake_docker.commands("pull").count("pull ubuntu:jammy-20240102") == 2
+  assert "jammy-20240102" in sum(ImageIndex(tmp_path).load().values(), [])
+
+def test_image_that_keeps_failing_does_not_abort_the_run(hub, fake_docker, no_backoff, tmp_path: Path):
+  hub.tags[REPOSITORY] = [tag_info("jammy-20240102", "2024-01-02T00:00:00Z"), tag_info("jammy-20240101", "2024-01-01T00:00:00Z")]
+  fake_docker.fail("pull ubuntu:jammy-20240102")
+  crawler = make_crawler(tmp_path, hub)
+  crawler.run([REPOSITORY], set())
+  assert crawler.indexed == ["jammy-20240101"]
+  assert [task.tag_name for task in crawler.failed] == ["jammy-20240102"]
+  assert fake_docker.commands("pull").count("pull ubuntu:jammy-20240102") == 2
+
+def test_disk_budget_blocks_until_released():
+  budget = DiskBudget(100)
+  budget.acquire(60)
+  acquired = threading.Event()
+  def acquire():
+    budget.acquire(60)
+    acquired.set()
+  thread = threading.Thread(target=acquire)
+  thread.start()
+  assert not acquired.wait(0.2)
+  budget.release(60)
+  assert acquired.wait(5)
+  thread.join()
+  assert budget.used == 60
+
+def test_disk_budget_admits_an_oversized_image_alone():
+  budget = DiskBudget(100)
+  budget.acquire(500)
+  assert budget.used == 500
+  budget.adjust(500, 80)
+  assert budget.used == 80
+
+class RecordingDiskBudget(DiskBudget):
+  def __init__(self, budget: int):
+    super().__init__(budget)
+    self.peak = 0
+    self.images = 0
+    self.peak_images = 0
+
+  def acquire(self, size: int):
+    super().acquire(size)
+    with self._cond:
+      self.images += 1
+      self.peak_images = max(self.peak_images, self.images)
+      self.peak = max(self.peak, self.used)
+    # keep the image on disk for a while, so that the others would overlap with it
+    time.sleep(0.05)
+
+  def release(self, size: int):
+    with self._cond:
+      self.images -= 1
+    super().release(size)
+
+def test_crawler_keeps_pulled_images_within_the_disk_budget(hub, fake_docker, tmp_path: Path):
+  size = 1_000_000
+  hub.tags[REPOSITORY] = [tag_info(f"jammy-2024010{i}", f"2024-01-0{i}T00:00:00Z", size) for i in range(6, 0, -1)]
+  # every image reserves its estimated size until `docker image inspect` tells the actual one,
+  # so this budget has room for one image at a time
+  budget = size * indexer.SIZE_ESTIMATE_FACTOR + 1
+  for index_dir, disk_budget in [(tmp_path / "tight", budget), (tmp_path / "loose", 100 * budget)]:
+    index_dir.mkdir()
+    crawler = make_crawler(index_dir, hub, jobs=2, prefetch=2, max_pulls=4)
+    crawler.disk_budget = RecordingDiskBudget(disk_budget)
+    crawler.run([REPOSITORY], set())
+    assert len(crawler.indexed) == 6
+    assert crawler.disk_budget.peak <= disk_budget
+    assert crawler.disk_budget.used == 0
+    if index_dir.name == "tight":
+      assert crawler.disk_budget.peak_images == 1
+    else:
+      # without the budget the images do overlap
+      assert 2 <= crawler.disk_budget.peak_images
+
+def test_results_are_written_in_batches(hub, fake_docker, tmp_path: Path, monkeypatch: pytest.MonkeyPatch):
+  hub.tags[REPOSITORY] = [tag_info(f"jammy-2024010{i}", f"2024-01-0{i}T00:00:00Z") for i in range(5, 0, -1)]
+  crawler = make_crawler(tmp_path, hub, batch_size=2)
+  writes = []
+  add_many = crawler.lib_index.add_many
+  def record_add_many(entries, manifests=(), symbols=()):
+    entries = list(entries)
+    writes.append({ image_digest for _, (_, image_digest, _) in entries })
+    add_many(entries, manifests, symbols)
+  monkeypatch.setattr(crawler.lib_index, "add_many", record_add_many)
+  crawler.run([REPOSITORY], set())
+  # two full batches and the rest at the end of the run
+  assert [len(images) for images in writes] == [2, 2, 1]
+  tags = json.loads((tmp_path / "image_index.json").read_text())
+  assert sorted(tag for image_tags in tags.values() for tag in image_tags if tag.startswith("jammy-")) == sorted(task["name"] for task in hub.tags[REPOSITORY])
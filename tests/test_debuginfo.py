@@ -0,0 +1,96 @@
+import os
+from pathlib import Path
+import time
+
+import pytest
+
+from preplib.debuginfo import MISSING_TTL, DebugInfoCache, build_id_debug_path, fetch_debuginfo
+from preplib.elf import ElfFile
+
+from conftest import host_libraries
+
+# debug files are ELF files with the build id of their library, which the libraries themselves are
+@pytest.fixture(scope="module")
+def debug_files():
+  return { ElfFile(data).build_id(): data for data in host_libraries(3, with_build_id=True) }
+
+def serve(hub, tmp_path: Path, files: dict[str, bytes]):
+  hub.root = tmp_path / f"debuginfod-{hub.url.rsplit(':', 1)[1]}"
+  for build_id, data in files.items():
+    path = hub.root / "buildid" / build_id / "debuginfo"
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_bytes(data)
+  return hub.url
+
+def placed(outdir: Path, build_id: str):
+  return outdir / ".debug" / build_id_debug_path(build_id)
+
+def test_next_server_is_asked_after_a_404(make_hub, debug_files, tmp_path: Path):
+  empty, full = make_hub(), make_hub()
+  urls = [serve(empty, tmp_path, {}), serve(full, tmp_path, debug_files)]
+  cache = DebugInfoCache(tmp_path / "cache")
+  fetched = fetch_debuginfo(list(debug_files), tmp_path / "out", urls, cache)
+  for build_id, data in debug_files.items():
+    assert fetched[build_id] == placed(tmp_path / "out", build_id)
+    assert placed(tmp_path / "out", build_id).read_bytes() == data
+  assert empty.statuses == [404] * len(debug_files)
+  assert full.statuses == [200] * len(debug_files)
+
+  # the cached files are placed without asking the servers again
+  fetched = fetch_debuginfo(list(debug_files), tmp_path / "out2", urls, cache)
+  assert all(path is not None and path.read_bytes() == debug_files[build_id] for build_id, path in fetched.items())
+  assert len(empty.requests) + len(full.requests) == 2 * len(debug_files)
+
+def test_file_with_another_build_id_is_rejected(make_hub, debug_files, tmp_path: Path):
+  (build_id, data), (_, other) = list(debug_files.items())[:2]
+  wrong, right = make_hub(), make_hub()
+  urls = [serve(wrong, tmp_path, { build_id: other }), serve(right, tmp_path, { build_id: data })]
+  fetched = fetch_debuginfo([build_id], tmp_path / "out", urls, None)
+  assert fetched[build_id] is not None and fetched[build_id].read_bytes() == data
+  assert wrong.statuses == [200]
+
+  # nothing is left behind when no server has the right one
+  fetched = fetch_debuginfo([build_id], tmp_path / "out2", urls[:1], None)
+  assert fetched == { build_id: None }
+  assert [path for path in (tmp_path / "out2").rglob("*") if path.is_file()] == []
+
+def test_missing_build_id_is_not_asked_again_within_the_ttl(hub, debug_files, tmp_path: Path):
+  build_id, data = next(iter(debug_files.items()))
+  url = serve(hub, tmp_path, {})
+  cache = DebugInfoCache(tmp_path / "cache")
+  assert fetch_debuginfo([build_id], tmp_path / "out", [url], cache) == { build_id: None }
+  assert cache.is_missing(build_id)
+  assert fetch_debuginfo([build_id], tmp_path / "out", [url], cache) == { build_id: None }
+  assert hub.statuses == [404]
+
+  # once the marker is older than the ttl, the servers are asked again
+  serve(hub, tmp_path, { build_id: data })
+  marker = tmp_path / "cache" / build_id / "missing"
+  expired = time.time() - MISSING_TTL - 1
+  os.utime(marker, (expired, expired))
+  assert fetch_debuginfo([build_id], tmp_path / "out", [url], cache) == { build_id: placed(tmp_path / "out", build_id) }
+  assert hub.statuses == [404, 200]
+  assert not marker.exists()
+
+def test_least_recently_used_files_are_evicted(hub, debug_files, tmp_path: Path):
+  build_ids = list(debug_files)
+  url = serve(hub, tmp_path, debug_files)
+  cache = DebugInfoCache(tmp_path / "cache")
+  fetch_debuginfo(build_ids, tmp_path / "out", [url], cache)
+  assert all(cache.get(build_id) is not None for build_id in build_ids)
+
+  # the first one is the least recently used, and the last one was used just now
+  for i, build_id in enumerate(build_ids):
+    used_at = time.time() - 1000 * (len(build_ids) - i)
+    os.utime(tmp_path / "cache" / build_id / "debuginfo", (used_at, used_at))
+  cache.get(build_ids[-1])
+  cache.size_limit = sum(len(debug_files[build_id]) for build_id in build_ids[1:])
+  cache.evict()
+  assert cache.get(build_ids[0]) is None
+  assert all(cache.get(build_id) is not None for build_id in build_ids[1:])
+
+  cache.size_limit = 0
+  cache.evict()
+  assert all(cache.get(build_id) is None for build_id in build_ids)
+  # the placed copies are not affected
+  assert all(placed(tmp_path / "out", build_id).read_bytes() == debug_files[build_id] for build_id in build_ids)
@@ -0,0 +1,50 @@
+from pathlib import Path
+
+import pytest
+
+from preplib.digests import AmbiguousDigestError
+from preplib.index import LibIndex, LibInfo, find_image, migrate_legacy_index
+
+def write_legacy_cache(index_dir: Path, digest: str, info: list[LibInfo]):
+  legacy_dir = index_dir / "cache"
+  legacy_dir.mkdir(parents=True, exist_ok=True)
+  (legacy_dir / digest).write_text("\n".join(f"{i.image_name}@{i.image_digest} {repr(i.path)}" for i in info))
+
+LEGACY_INFO = LibInfo("ubuntu:18.04", "sha256:" + "1" * 64, "/lib/x86_64-linux-gnu/libc-2.27.so")
+NEW_INFO = LibInfo("ubuntu:22.04", "sha256:" + "2" * 64, "/usr/lib/x86_64-linux-gnu/libc.so.6")
+
+def test_first_write_keeps_the_legacy_rows(tmp_path: Path):
+  write_legacy_cache(tmp_path, "a" * 32, [LEGACY_INFO])
+  assert LibIndex(tmp_path).load("a" * 32) == [LEGACY_INFO]
+
+  LibIndex(tmp_path).add("b" * 32, NEW_INFO)
+  index = LibIndex(tmp_path)
+  assert index.exists()
+  assert index.load("a" * 32) == [LEGACY_INFO]
+  assert index.load("b" * 32) == [NEW_INFO]
+
+def test_migrate_legacy_index(tmp_path: Path):
+  write_legacy_cache(tmp_path, "a" * 32, [LEGACY_INFO])
+  write_legacy_cache(tmp_path, "c" * 32, [LEGACY_INFO, NEW_INFO])
+  assert migrate_legacy_index(tmp_path, remove_legacy=True) == 2
+  assert not (tmp_path / "cache").exists()
+  index = LibIndex(tmp_path)
+  assert index.load("a" * 32) == [LEGACY_INFO]
+  assert index.load("c" * 32) == [LEGACY_INFO, NEW_INFO]
+
+  # files added to cache/ later are copied into the existing database
+  write_legacy_cache(tmp_path, "d" * 32, [NEW_INFO])
+  assert migrate_legacy_index(tmp_path) == 1
+  assert LibIndex(tmp_path).load("d" * 32) == [NEW_INFO]
+
+def test_prefix_lookup_in_an_empty_index_dir(tmp_path: Path):
+  with pytest.raises(ValueError, match="no indexed digest"):
+    find_image("a" * 8, tmp_path / "nonexistent")
+
+def test_prefix_lookup_in_the_legacy_layout(tmp_path: Path):
+  write_legacy_cache(tmp_path, "a" * 32, [LEGACY_INFO])
+  write_legacy_cache(tmp_path, "a" * 8 + "b" * 24, [NEW_INFO])
+  assert find_image("a" * 9, tmp_path) == [LEGACY_INFO]
+  assert find_image("a" * 8 + "b", tmp_path) == [NEW_INFO]
+  with pytest.raises(AmbiguousDigestError):
+    find_image("a" * 8, tmp_path)
@@ -0,0 +1,174 @@
+import json
+from pathlib import Path
+import shutil
+import sqlite3
+
+import pytest
+
+import indexer
+from indexer import HttpClient, load_crawl_state
+from preplib.index import ImageIndex, LibIndex
+from preplib.sync import sync_index, sync_local_deltas
+
+from conftest import make_crawler, tag_info
+
+REPOSITORY = "library/ubuntu"
+TAGS = [f"jammy-2024010{i}" for i in range(5, 0, -1)]
+
+@pytest.fixture
+def index_dir(tmp_path: Path):
+  index_dir = tmp_path / "preplib-data"
+  index_dir.mkdir()
+  return index_dir
+
+@pytest.fixture
+def hub_tags(hub):
+  # amd64/ubuntu lists nothing
+  hub.tags[REPOSITORY] = [tag_info(tag, f"2024-01-0{tag[-1]}T00:00:00Z") for tag in TAGS]
+  return hub
+
+def run_indexer(monkeypatch: pytest.MonkeyPatch, hub, index_dir: Path, *args: str):
+  monkeypatch.setattr("sys.argv", [
+    "indexer.py", "--index-dir", str(index_dir), "--hub-url", hub.url, "--endoflife-url", hub.url,
+    "--http-cache", str(index_dir.parent / "http-cache"), "--batch-size", "2", "--retries", "1", *args,
+  ])
+  indexer.main()
+
+def indexed_tags(index_dir: Path):
+  return sorted(tag for tags in ImageIndex(index_dir).load().values() for tag in tags if tag.startswith("jammy-"))
+
+def pulled(fake_docker):
+  return [command.split(":")[-1] for command in fake_docker.commands("pull")]
+
+def test_http_client_revalidates_the_cached_response(hub, tmp_path: Path):
+  url = hub.url + "/api/ubuntu.json"
+  HttpClient(tmp_path / "http-cache").get_json(url)
+  http = HttpClient(tmp_path / "http-cache")
+  assert http.get_json(url) == hub.releases["ubuntu"]
+  assert http.not_modified == 1
+  # within max_age the server is not asked at all
+  assert http.get_json(url, max_age=60) == hub.releases["ubuntu"]
+  assert http.requests == 1
+
+def test_crawl_stops_at_the_high_water_mark(hub, fake_docker, tmp_path: Path):
+  # two tags per page
+  hub.tags[REPOSITORY] = [tag_info(f"jammy-2024010{i}", f"2024-01-0{i}T00:00:00Z") for i in range(5, 0, -1)]
+  make_crawler(tmp_path, hub).run([REPOSITORY], set())
+  assert load_crawl_state(tmp_path) == { REPOSITORY: { "last_updated": "2024-01-05T00:00:00Z" } }
+  assert hub.pages_requested(REPOSITORY) == ["1", "2", "3"]
+
+  hub.requests.clear()
+  hub.tags[REPOSITORY].insert(0, tag_info("jammy-20240106", "2024-01-06T00:00:00Z"))
+  indexed = { f"jammy-2024010{i}" for i in range(1, 6) }
+  crawler = make_crawler(tmp_path, hub)
+  crawler.run([REPOSITORY], indexed)
+  assert crawler.indexed == ["jammy-20240106"]
+  # the first tag older than the mark is on the second page, and the third one is not read
+  assert hub.pages_requested(REPOSITORY) == ["1", "2"]
+  assert load_crawl_state(tmp_path) == { REPOSITORY: { "last_updated": "2024-01-06T00:00:00Z" } }
+
+  hub.requests.clear()
+  make_crawler(tmp_path, hub).run([REPOSITORY], indexed | { "jammy-20240106" }, full=True)
+  assert hub.pages_requested(REPOSITORY) == ["1", "2", "3"]
+
+def test_high_water_mark_stays_at_a_failed_image(hub, fake_docker, no_backoff, tmp_path: Path):
+  hub.tags[REPOSITORY] = [
+    tag_info("jammy-20240103", "2024-01-03T00:00:00Z"),
+    tag_info("jammy-20240102", "2024-01-02T00:00:00Z"),
+    tag_info("jammy-20240101", "2024-01-01T00:00:00Z"),
+  ]
+  fake_docker.fail("pull ubuntu:jammy-20240102")
+  make_crawler(tmp_path, hub).run([REPOSITORY], set())
+  assert load_crawl_state(tmp_path) == { REPOSITORY: { "last_updated": "2024-01-02T00:00:00Z" } }
+
+  # the next crawl reaches the failed image again
+  fake_docker.fail()
+  crawler = make_crawler(tmp_path, hub)
+  crawler.run([REPOSITORY], { "jammy-20240101", "jammy-20240103" })
+  assert crawler.indexed == ["jammy-20240102"]
+  assert load_crawl_state(tmp_path) == { REPOSITORY: { "last_updated": "2024-01-03T00:00:00Z" } }
+
+def test_failed_image_does_not_hold_back_its_batch(monkeypatch: pytest.MonkeyPatch, hub_tags, fake_docker, index_dir: Path):
+  fake_docker.fail("pull ubuntu:jammy-20240103")
+  run_indexer(monkeypatch, hub_tags, index_dir)
+  # the other image of the batch is written
+  assert indexed_tags(index_dir) == ["jammy-20240101", "jammy-20240102", "jammy-20240104", "jammy-20240105"]
+  assert load_crawl_state(index_dir) == { REPOSITORY: { "last_updated": "2024-01-03T00:00:00Z" } }
+  manifest = json.loads((index_dir / "deltas" / "manifest.json").read_text())
+  # each image is tagged with its date-pinned tag, jammy and 22.04
+  assert [segment["images"] for segment in manifest["segments"]] == [4 * 3]
+
+  # the next run only pulls the failed image
+  fake_docker.fail()
+  fake_docker.log_path.unlink()
+  run_indexer(monkeypatch, hub_tags, index_dir)
+  assert pulled(fake_docker) == ["jammy-20240103"]
+  assert indexed_tags(index_dir) == sorted(TAGS)
+  assert load_crawl_state(index_dir) == { REPOSITORY: { "last_updated": "2024-01-05T00:00:00Z" } }
+  manifest = json.loads((index_dir / "deltas" / "manifest.json").read_text())
+  assert [segment["images"] for segment in manifest["segments"]] == [4 * 3, 3]
+
+  # a mirror that follows the deltas ends up with the same index
+  mirror_dir = index_dir.parent / "mirror"
+  sync_index(str(index_dir), mirror_dir)
+  assert indexed_tags(mirror_dir) == sorted(TAGS)
+  assert LibIndex(mirror_dir).row_count() == LibIndex(index_dir).row_count()
+
+def test_run_resumes_after_a_failed_batch_write(monkeypatch: pytest.MonkeyPatch, hub_tags, fake_docker, index_dir: Path):
+  add_many = LibIndex.add_many
+  calls = []
+  def failing_add_many(self, *args, **kwargs):
+    calls.append(len(calls))
+    # the first batch is written, every later one fails
+    if 2 <= len(calls):
+      raise sqlite3.OperationalError("disk I/O error")
+    return add_many(self, *args, **kwargs)
+  monkeypatch.setattr(LibIndex, "add_many", failing_add_many)
+  with pytest.raises(sqlite3.OperationalError):
+    run_indexer(monkeypatch, hub_tags, index_dir)
+  written = indexed_tags(index_dir)
+  assert len(written) == 2
+  # the run stopped before the high-water mark and the exports
+  assert load_crawl_state(index_dir) == {}
+  assert not (index_dir / "deltas").exists()
+  # the tags are only written after the library rows of their images
+  image_digests = { image.split("@")[1] for image in ImageIndex(index_dir).load() }
+  assert { info.image_digest for _, _, info in LibIndex(index_dir).rows_after(0) } == image_digests
+
+  monkeypatch.setattr(LibIndex, "add_many", add_many)
+  fake_docker.log_path.unlink()
+  run_indexer(monkeypatch, hub_tags, index_dir)
+  assert sorted(pulled(fake_docker)) == sorted(set(TAGS) - set(written))
+  assert indexed_tags(index_dir) == sorted(TAGS)
+  assert load_crawl_state(index_dir) == { REPOSITORY: { "last_updated": "2024-01-05T00:00:00Z" } }
+  assert (index_dir / "snapshot.bin").exists()
+
+def index_content(index_dir: Path):
+  lib_index = LibIndex(index_dir)
+  rows = sorted((digest, *info) for _, digest, info in lib_index.rows_after(0))
+  manifests = { image_digest: lib_index.load_manifest(image_digest) for _, _, image_digest, _ in rows }
+  symbols = sorted(lib_index.load_symbols({ digest for digest, *_ in rows }))
+  lib_index.close()
+  return rows, manifests, symbols
+
+def test_database_is_rebuilt_from_the_published_files(monkeypatch: pytest.MonkeyPatch, hub_tags, fake_docker, index_dir: Path):
+  run_indexer(monkeypatch, hub_tags, index_dir)
+  rows, manifests, symbols = index_content(index_dir)
+  assert all(len(manifest) != 0 for manifest in manifests.values())
+  assert len(symbols) != 0
+
+  # a clone of the data repository has what is committed only
+  clone_dir = index_dir.parent / "clone"
+  shutil.copytree(index_dir, clone_dir, ignore=shutil.ignore_patterns(*indexer.UNPUBLISHED_FILES))
+  assert not LibIndex(clone_dir).exists()
+  sync_local_deltas(clone_dir)
+  assert index_content(clone_dir) == (rows, manifests, symbols)
+
+  # the indexer whose cached database was evicted
+  for path in index_dir.glob("lib_index.sqlite3*"):
+    path.unlink()
+  run_indexer(monkeypatch, hub_tags, index_dir)
+  assert index_content(index_dir) == (rows, manifests, symbols)
+  # the rebuilt database continues the published delta stream
+  manifest = json.loads((index_dir / "deltas" / "manifest.json").read_text())
+  assert len(manifest["segments"]) == 1
@@ -0,0 +1,218 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+from pathlib import Path
+import platform
+import subprocess
+import tarfile
+from typing import Union
+
+import pytest
+
+from preplib.extract import parse_scan_output
+from preplib.index import LibIndex, scan_image_layers
+from preplib.utils import source_scripts_path
+
+from conftest import host_libraries
+
+HASH_TYPES = ["build-id", "md5", "symbols"]
+
+# a layer from {path: bytes of a file | "-> target" of a symlink}
+def make_layer(files: dict[str, Union[bytes, str]]) -> bytes:
+  buf = io.BytesIO()
+  with tarfile.open(fileobj=buf, mode="w", format=tarfile.PAX_FORMAT) as tar:
+    dirs: set[str] = set()
+    for path, content in files.items():
+      parts = path.split("/")[:-1]
+      for i in range(1, len(parts) + 1):
+        d = "/".join(parts[:i])
+        if d in dirs: continue
+        dirs.add(d)
+        info = tarfile.TarInfo(d)
+        info.type = tarfile.DIRTYPE
+        info.mode = 0o755
+        tar.addfile(info)
+      info = tarfile.TarInfo(path)
+      if isinstance(content, str):
+        info.type = tarfile.SYMTYPE
+        info.linkname = content[len("-> "):]
+        tar.addfile(info)
+      else:
+        info.size = len(content)
+        info.mode = 0o644
+        tar.addfile(info, io.BytesIO(content))
+  return buf.getvalue()
+
+def sha256(data: bytes):
+  return "sha256:" + hashlib.sha256(data).hexdigest()
+
+def write_blob(layout_dir: Path, data: bytes):
+  digest = sha256(data)
+  path = layout_dir / "blobs" / "sha256" / digest.split(":")[1]
+  path.parent.mkdir(parents=True, exist_ok=True)
+  path.write_bytes(data)
+  return digest
+
+def make_oci_layout(layout_dir: Path, layers: list[bytes], ref: str, compress=True):
+  descriptors = []
+  for layer in layers:
+    blob = gzip.compress(layer, mtime=0) if compress else layer
+    media_type = "application/vnd.oci.image.layer.v1.tar" + ("+gzip" if compress else "")
+    descriptors.append({ "mediaType": media_type, "digest": write_blob(layout_dir, blob), "size": len(blob) })
+  config = json.dumps({ "architecture": "amd64", "os": "linux", "rootfs": { "type": "layers", "diff_ids": [sha256(layer) for layer in layers] } }).encode()
+  manifest = json.dumps({
+    "schemaVersion": 2,
+    "mediaType": "application/vnd.oci.image.manifest.v1+json",
+    "config": { "mediaType": "application/vnd.oci.image.config.v1+json", "digest": write_blob(layout_dir, config), "size": len(config) },
+    "layers": descriptors,
+  }).encode()
+  (layout_dir / "oci-layout").write_text(json.dumps({ "imageLayoutVersion": "1.0.0" }))
+  (layout_dir / "index.json").write_text(json.dumps({ "schemaVersion": 2, "manifests": [{
+    "mediaType": "application/vnd.oci.image.manifest.v1+json",
+    "digest": write_blob(layout_dir, manifest),
+    "size": len(manifest),
+    "annotations": { "org.opencontainers.image.ref.name": ref },
+  }] }))
+  return descriptors
+
+def make_docker_archive(path: Path, layers: list[bytes], repo_tag: str):
+  config = json.dumps({ "architecture": "amd64", "os": "linux", "rootfs": { "type": "layers", "diff_ids": [sha256(layer) for layer in layers] } }).encode()
+  config_name = f"{hashlib.sha256(config).hexdigest()}.json"
+  layer_names = [f"{hashlib.sha256(layer).hexdigest()}/layer.tar" for layer in layers]
+  members = { config_name: config, **dict(zip(layer_names, layers)) }
+  members["manifest.json"] = json.dumps([{ "Config": config_name, "RepoTags": [repo_tag], "Layers": layer_names }]).encode()
+  with tarfile.open(path, "w") as tar:
+    for name, data in members.items():
+      info = tarfile.TarInfo(name)
+      info.size = len(data)
+      tar.addfile(info, io.BytesIO(data))
+
+@pytest.fixture(scope="module")
+def image():
+  libz, libm, libold, libnew, libdl, libc = host_libraries(6)
+  base = make_layer({
+    "etc/ld.so.conf": b"include /etc/ld.so.conf.d/*.conf\n",
+    "etc/ld.so.conf.d/opt.conf": b"# the libraries of the application\n/opt/app/lib\n",
+    # merged /usr
+    "lib": "-> usr/lib",
+    "usr/lib/libz.so.1.2.13": libz,
+    "usr/lib/libz.so.1": "-> libz.so.1.2.13",
+    "usr/lib/libm.so.6": libm,
+    "usr/lib/libc.so.6": libc,
+    # a linker script, not a library
+    "usr/lib/libc.so": b"GROUP ( /lib/libc.so.6 )\n",
+    "opt/app/lib/libold.so.1": libold,
+  })
+  update = make_layer({
+    "usr/lib/.wh.libm.so.6": b"",
+    "opt/app/lib/.wh..wh..opq": b"",
+    "opt/app/lib/libnew.so.1": libnew,
+    "usr/lib/libdl.so.2": libdl,
+  })
+  # the file system of a container of the image
+  rootfs = {
+    "etc/ld.so.conf": b"include /etc/ld.so.conf.d/*.conf\n",
+    "etc/ld.so.conf.d/opt.conf": b"# the libraries of the application\n/opt/app/lib\n",
+    "lib": "-> usr/lib",
+    "usr/lib/libz.so.1.2.13": libz,
+    "usr/lib/libz.so.1": "-> libz.so.1.2.13",
+    "usr/lib/libc.so.6": libc,
+    "usr/lib/libc.so": b"GROUP ( /lib/libc.so.6 )\n",
+    "usr/lib/libdl.so.2": libdl,
+    "opt/app/lib/libnew.so.1": libnew,
+  }
+  return [base, update], rootfs
+
+def records_by_path(scan):
+  return { entry.path: entry for entry in scan.manifest }
+
+def symbols_by_md5(scan):
+  res: dict[str, set[tuple[str, int]]] = {}
+  for name, offset, md5 in scan.symbols:
+    res.setdefault(md5, set()).add((name, offset))
+  return res
+
+# what `preplib --index` records with docker: scripts/scan over the libraries that ldconfig lists in a container
+def docker_scan(tmp_path: Path, rootfs: dict[str, Union[bytes, str]], lib_paths: list[str]):
+  if platform.system() != "Linux" or platform.machine() != "x86_64":
+    pytest.skip("scripts/scan is built for x86-64 Linux")
+  root = tmp_path / "rootfs"
+  for path, content in rootfs.items():
+    (root / path).parent.mkdir(parents=True, exist_ok=True)
+    if isinstance(content, str):
+      os.symlink(content[len("-> "):], root / path)
+    else:
+      (root / path).write_bytes(content)
+  listing = "".join(f"\t{os.path.basename(path)} (libc6,x86-64) => {root}{path}\n" for path in lib_paths)
+  output = subprocess.run(
+    [str(source_scripts_path / "scan"), "-t", ",".join(HASH_TYPES), "-y", "", "-"],
+    input=listing.encode(), stdout=subprocess.PIPE, check=True,
+  ).stdout.decode()
+  return [record._replace(path=record.path[len(str(root)):]) for record in parse_scan_output(output)]
+
+def test_oci_layout_matches_the_docker_scan(image, tmp_path: Path):
+  layers, rootfs = image
+  make_oci_layout(tmp_path / "layout", layers, "22.04")
+  scan = scan_image_layers(f"oci:{tmp_path / 'layout'}:22.04", HASH_TYPES)
+  assert scan.repository_name == "layout"
+  assert scan.image_tag == "22.04"
+
+  # /lib links to usr/lib, so its libraries are listed under /lib as ldconfig does. the whited out libm and
+  # the libraries under the opaque directory are gone
+  assert sorted(records_by_path(scan)) == ["/lib/libc.so.6", "/lib/libdl.so.2", "/lib/libz.so.1", "/lib/libz.so.1.2.13", "/opt/app/lib/libnew.so.1"]
+  docker_records = docker_scan(tmp_path, rootfs, ["/opt/app/lib/libnew.so.1", "/lib/libz.so.1", "/lib/libdl.so.2", "/lib/libc.so.6"])
+  assert len(docker_records) == 4
+  layer_records = records_by_path(scan)
+  for record in docker_records:
+    entry = layer_records[record.path]
+    assert (entry.build_id, entry.md5, entry.size, entry.arch, entry.soname, entry.needed, entry.rpath, entry.runpath) == (
+      record.digests.get("build-id"), record.digests["md5"], record.size, record.arch, record.soname, record.needed, record.rpath, record.runpath
+    )
+  # only libc has its symbols recorded
+  libc_md5 = layer_records["/lib/libc.so.6"].md5
+  docker_libc = next(record for record in docker_records if record.path == "/lib/libc.so.6")
+  assert symbols_by_md5(scan) == { libc_md5: set(docker_libc.symbols or []) }
+  assert len(symbols_by_md5(scan)[libc_md5]) != 0
+
+def test_docker_archive_matches_the_oci_layout(image, tmp_path: Path):
+  layers, _ = image
+  make_oci_layout(tmp_path / "layout", layers, "22.04")
+  make_docker_archive(tmp_path / "image.tar", layers, "example/app:1.0")
+  oci_scan = scan_image_layers(f"oci:{tmp_path / 'layout'}:22.04", HASH_TYPES)
+  archive_scan = scan_image_layers(f"docker-archive:{tmp_path / 'image.tar'}", HASH_TYPES)
+  assert (archive_scan.repository_name, archive_scan.image_tag) == ("example/app", "1.0")
+  assert archive_scan.manifest == oci_scan.manifest
+  assert sorted(archive_scan.symbols) == sorted(oci_scan.symbols)
+
+def test_layers_are_read_once(image, tmp_path: Path):
+  layers, _ = image
+  descriptors = make_oci_layout(tmp_path / "layout", layers, "22.04")
+  lib_index = LibIndex(tmp_path / "index")
+  first = scan_image_layers(f"oci:{tmp_path / 'layout'}", HASH_TYPES, lib_index=lib_index)
+  # the blobs are not read again once their entries are recorded
+  for descriptor in descriptors:
+    (tmp_path / "layout" / "blobs" / "sha256" / descriptor["digest"].split(":")[1]).unlink()
+  second = scan_image_layers(f"oci:{tmp_path / 'layout'}", HASH_TYPES, lib_index=lib_index)
+  assert second.manifest == first.manifest
+  assert sorted(second.symbols) == sorted(first.symbols)
+
+def test_corrupted_blob_is_rejected(image, tmp_path: Path):
+  layers, _ = image
+  descriptors = make_oci_layout(tmp_path / "layout", layers, "22.04", compress=False)
+  blob_path = tmp_path / "layout" / "blobs" / "sha256" / descriptors[1]["digest"].split(":")[1]
+  data = bytearray(blob_path.read_bytes())
+  # in the end-of-archive blocks, which tarfile stops before
+  data[-1] ^= 1
+  blob_path.write_bytes(bytes(data))
+  with pytest.raises(ValueError, match="does not match its digest"):
+    scan_image_layers(f"oci:{tmp_path / 'layout'}", HASH_TYPES)
+
+def test_image_is_chosen_by_its_ref(image, tmp_path: Path):
+  layers, _ = image
+  make_oci_layout(tmp_path / "layout", layers, "22.04")
+  with pytest.raises(ValueError, match="has 0 images named 24.04"):
+    scan_image_layers(f"oci:{tmp_path / 'layout'}:24.04", HASH_TYPES)
+  # the only image of the layout needs no ref
+  assert scan_image_layers(f"oci:{tmp_path / 'layout'}", HASH_TYPES).image_tag == "22.04"
@@ -0,0 +1,60 @@
+import json
+from pathlib import Path
+import shutil
+
+import pytest
+
+from patchlib.batch import STATE_NAME, batch_main
+from preplib.elf import read_elf_info
+
+def make_challenge(challenge_dir: Path):
+  binary = shutil.which("true")
+  ld = Path("/lib64/ld-linux-x86-64.so.2")
+  if binary is None or not ld.exists():
+    pytest.skip("needs a dynamically linked x86-64 `true`")
+  (challenge_dir / "lib").mkdir(parents=True)
+  shutil.copy(binary, challenge_dir / "chall")
+  shutil.copy(ld, challenge_dir / "lib" / ld.name)
+  return challenge_dir / "chall"
+
+def test_first_patch_runs_patchelf_and_a_repatch_is_in_place(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]):
+  if shutil.which("patchelf") is None:
+    pytest.skip("patchelf is not installed")
+  binary = make_challenge(tmp_path / "chal-a")
+  assert read_elf_info(binary).runpath is None
+
+  # a binary without RUNPATH has no room for one
+  batch_main([str(tmp_path / "chal-a")])
+  assert "patched (patchelf," in capsys.readouterr().out
+  info = read_elf_info(binary)
+  assert info.runpath == str(tmp_path / "chal-a" / "lib")
+  assert info.interp == str(tmp_path / "chal-a" / "lib" / "ld-linux-x86-64.so.2")
+
+  # moved to a path of the same length, the recorded patch is rewritten without patchelf
+  shutil.move(tmp_path / "chal-a", tmp_path / "chal-b")
+  monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+  batch_main([str(tmp_path / "chal-b")])
+  assert "patched (in-place," in capsys.readouterr().out
+  info = read_elf_info(tmp_path / "chal-b" / "chall")
+  assert info.runpath == str(tmp_path / "chal-b" / "lib")
+  assert info.interp == str(tmp_path / "chal-b" / "lib" / "ld-linux-x86-64.so.2")
+  state = json.loads((tmp_path / "chal-b" / "lib" / STATE_NAME).read_text())
+  assert [entry["runpath"] for entry in state.values()] == [info.runpath]
+
+  # and the next run has nothing to do
+  batch_main([str(tmp_path / "chal-b")])
+  assert "0 patched, 1 already patched" in capsys.readouterr().out
+
+def test_longer_path_needs_patchelf(tmp_path: Path, monkeypatch: pytest.MonkeyPatch, capsys: pytest.CaptureFixture[str]):
+  if shutil.which("patchelf") is None:
+    pytest.skip("patchelf is not installed")
+  make_challenge(tmp_path / "chal")
+  batch_main([str(tmp_path / "chal")])
+  shutil.move(tmp_path / "chal", tmp_path / "challenge")
+  # the new path does not fit, and patchelf is not there to grow the file
+  monkeypatch.setenv("PATH", str(tmp_path / "empty"))
+  capsys.readouterr()
+  with pytest.raises(SystemExit):
+    batch_main([str(tmp_path / "challenge")])
+  assert "1 failed" in capsys.readouterr().out
+  assert read_elf_info(tmp_path / "challenge" / "chall").runpath == str(tmp_path / "chal" / "lib")
@@ -0,0 +1,99 @@
+import json
+from pathlib import Path
+import time
+
+import pytest
+
+from preplib.index import ImageIndex, LibIndex, LibInfo
+from preplib.remote import RemoteImageIndex, RemoteIndexClient, RemoteLibIndex, export_shards
+
+IMAGE_DIGESTS = ["sha256:" + c * 64 for c in "12"]
+LIB_DIGESTS = ["abc" + "0" * 29, "abc" + "1" * 29, "def" + "0" * 29, "123" + "0" * 29]
+
+@pytest.fixture
+def published(hub, tmp_path: Path):
+  index_dir = tmp_path / "index"
+  LibIndex(index_dir).add_many([
+    (digest, LibInfo("ubuntu:22.04", IMAGE_DIGESTS[i % 2], f"/lib/lib{i}.so")) for i, digest in enumerate(LIB_DIGESTS)
+  ])
+  image_index = ImageIndex(index_dir)
+  for image_digest, tag in zip(IMAGE_DIGESTS, ["jammy-20240101", "jammy-20240102"]):
+    image_index.add(f"ubuntu@{image_digest}", tag)
+  image_index.compact()
+  hub.root = tmp_path / "pub"
+  export_shards(index_dir, hub.root / "shards")
+  return index_dir
+
+def make_client(hub, tmp_path: Path, **kwargs):
+  return RemoteIndexClient(hub.url, cache_dir=tmp_path / "remote-cache", **kwargs)
+
+def test_export_shards(published: Path, tmp_path: Path):
+  shards_dir = tmp_path / "pub" / "shards"
+  assert json.loads((shards_dir / "meta.json").read_text()) == { "version": 1, "lib_prefix_length": 3, "image_prefix_length": 2 }
+  assert sorted(path.name for path in (shards_dir / "libs").iterdir()) == ["123.json", "abc.json", "def.json"]
+  assert sorted(json.loads((shards_dir / "libs" / "abc.json").read_text())) == LIB_DIGESTS[:2]
+  assert sorted(path.name for path in (shards_dir / "images").iterdir()) == ["11.json", "22.json"]
+
+  # unchanged shards are not rewritten, and the shards without entries are removed
+  mtime = (shards_dir / "libs" / "abc.json").stat().st_mtime_ns
+  LibIndex(published).dump(LIB_DIGESTS[3], [])
+  export_shards(published, shards_dir)
+  assert (shards_dir / "libs" / "abc.json").stat().st_mtime_ns == mtime
+  assert not (shards_dir / "libs" / "123.json").exists()
+
+def test_remote_lookups_match_the_local_index(hub, published: Path, tmp_path: Path):
+  client = make_client(hub, tmp_path)
+  lib_index = LibIndex(published)
+  assert RemoteLibIndex(client).load_many(LIB_DIGESTS) == lib_index.load_many(LIB_DIGESTS)
+  image_index = ImageIndex(published)
+  images = list(image_index.load())
+  assert RemoteImageIndex(client).get_many(images) == { image: image_index.get(image) for image in images }
+
+def test_shards_are_cached_within_the_ttl(hub, published: Path, tmp_path: Path):
+  make_client(hub, tmp_path).fetch_json("shards/libs/abc.json")
+  assert hub.statuses == [200]
+  # another client (and process) reads the same cache
+  assert sorted(make_client(hub, tmp_path).fetch_json("shards/libs/abc.json")) == LIB_DIGESTS[:2]
+  assert hub.statuses == [200]
+
+def test_stale_shards_are_revalidated(hub, published: Path, tmp_path: Path):
+  client = make_client(hub, tmp_path, ttl=0)
+  shard = client.fetch_json("shards/libs/abc.json")
+  assert client.fetch_json("shards/libs/abc.json") == shard
+  assert hub.statuses == [200, 304]
+  assert hub.requests.count("/shards/libs/abc.json") == 2
+
+  # a changed shard is downloaded again
+  (hub.root / "shards" / "libs" / "abc.json").write_text(json.dumps({ LIB_DIGESTS[0]: [] }))
+  assert client.fetch_json("shards/libs/abc.json") == { LIB_DIGESTS[0]: [] }
+  assert hub.statuses == [200, 304, 200]
+
+def test_missing_shard(hub, published: Path, tmp_path: Path):
+  client = make_client(hub, tmp_path)
+  assert RemoteLibIndex(client).load("fff" + "0" * 29) == []
+  assert hub.statuses[-1] == 404
+  # the absence is cached too
+  assert make_client(hub, tmp_path).fetch_json("shards/libs/fff.json") is None
+  assert hub.requests.count("/shards/libs/fff.json") == 1
+
+  # and revalidated once it is stale
+  (hub.root / "shards" / "libs" / "fff.json").write_text(json.dumps({ "fff": [] }))
+  assert make_client(hub, tmp_path, ttl=0).fetch_json("shards/libs/fff.json") == { "fff": [] }
+
+def test_missing_index(hub, tmp_path: Path):
+  hub.root = tmp_path / "empty"
+  with pytest.raises(ValueError, match="no index shards"):
+    RemoteLibIndex(make_client(hub, tmp_path)).load(LIB_DIGESTS[0])
+
+def test_fetch_many_runs_in_parallel(hub, published: Path, tmp_path: Path):
+  hub.delay = 0.3
+  client = make_client(hub, tmp_path, jobs=4)
+  rel_paths = [f"shards/libs/{prefix}.json" for prefix in ["abc", "def", "123", "fff"]]
+  start = time.monotonic()
+  shards = client.fetch_many(rel_paths + rel_paths)
+  assert time.monotonic() - start < len(rel_paths) * hub.delay
+  assert 2 <= hub.max_in_flight
+  # each shard is fetched once
+  assert sorted(hub.requests) == sorted("/" + rel_path for rel_path in rel_paths)
+  assert sorted(shards) == sorted(rel_paths)
+  assert shards["shards/libs/fff.json"] is None